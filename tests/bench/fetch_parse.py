@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+#
+# Measures parse time and peak memory of a large TrueNAS list response,
+# read whole the way fetch used to and streamed through fetch. Each mode
+# runs in its own interpreter so peak RSS isn't shared between them.
+#
+# python3 tests/bench/fetch_parse.py [snapshots]
+#
+
+from os import environ, path
+from time import perf_counter
+from unittest import mock
+import subprocess
+import resource
+import tempfile
+import json
+import sys
+import requests
+
+CSP = path.join(path.dirname(path.abspath(__file__)), '..', '..', 'truenascsp')
+
+MODES = [ 'buffered', 'streamed', 'buffered-one', 'streamed-one', 'streamed-first' ]
+
+# the ten snapshots of one volume
+VOLUME = 'tank/pvc-00000042'
+
+
+def snapshot(n):
+    dataset = 'tank/pvc-{d:08d}'.format(d=n // 10)
+    name = 'snapshot-{s:08d}'.format(s=n)
+
+    return {
+        'id': '{dataset}@{name}'.format(dataset=dataset, name=name),
+        'name': '{dataset}@{name}'.format(dataset=dataset, name=name),
+        'dataset': dataset,
+        'snapshot_name': name,
+        'pool': 'tank',
+        'type': 'SNAPSHOT',
+        'holds': { 'truenas-csp': 1 } if n % 7 == 0 else {},
+        'properties': {
+            'numclones': { 'value': '0', 'rawvalue': '0', 'parsed': 0, 'source': 'NONE' },
+            'creation': { 'value': 'Mon Jan  1 00:00 2024', 'rawvalue': str(1704067200 + n),
+                          'parsed': { '$date': 1704067200000 + n }, 'source': 'NONE' },
+            'used': { 'value': '0B', 'rawvalue': '0', 'parsed': 0, 'source': 'NONE' },
+            'referenced': { 'value': '1.2G', 'rawvalue': '1288490188', 'parsed': 1288490188, 'source': 'NONE' }
+        }
+    }
+
+
+def generate(filename, snapshots):
+    with open(filename, 'w') as f:
+        f.write('[')
+        for n in range(snapshots):
+            f.write(',' if n else '')
+            json.dump(snapshot(n), f)
+        f.write(']')
+
+
+class Response:
+    status_code = 200
+    reason = 'OK'
+    headers = {}
+
+    def __init__(self, filename):
+        self.raw = open(filename, 'rb')
+
+    def iter_content(self, chunk_size):
+        return iter(lambda: self.raw.read(chunk_size), b'')
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        self.raw.close()
+
+
+def run(mode, filename):
+    sys.path.insert(0, CSP)
+
+    import backend
+
+    api = backend.Handler()
+    api.backend = '192.0.2.1'
+    api.token = '1-' + 'a' * 64
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    started = perf_counter()
+
+    if mode.startswith('buffered'):
+        # what requests and fetch did before streaming, body, text and rows held at once
+        response = requests.models.Response()
+
+        with open(filename, 'rb') as f:
+            response._content = f.read()
+
+        if mode == 'buffered-one':
+            rows = [ item for item in response.json() if item.get('dataset') == VOLUME ]
+        else:
+            rows = [ item for item in response.json() if item.get('dataset').startswith('tank') ]
+    elif mode == 'streamed-one':
+        with mock.patch('requests.Session.request', side_effect=lambda *args, **kwargs: Response(filename)):
+            rows = api.fetch('zfs/snapshot', field='dataset', value=VOLUME,
+                             extras={ 'holds': True }, returnBy=list)
+    else:
+        with mock.patch('requests.Session.request', side_effect=lambda *args, **kwargs: Response(filename)):
+            rows = api.fetch('zfs/snapshot', field='dataset', value='tank', operator='^',
+                             extras={ 'holds': True }, returnBy=dict if mode == 'streamed-first' else list)
+
+    elapsed = perf_counter() - started
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    print(json.dumps({ 'seconds': elapsed, 'rss': (peak - baseline) * 1024,
+                       'rows': len(rows) if isinstance(rows, list) else 1 }))
+
+
+def main():
+    snapshots = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = path.join(directory, 'snapshots.json')
+        generate(filename, snapshots)
+
+        print('{snapshots} snapshots, {size:.1f}MiB response'.format(snapshots=snapshots,
+              size=path.getsize(filename) / 1024 ** 2))
+        print('{mode:<16} {seconds:>10} {rss:>14} {rows:>8}'.format(
+            mode='mode', seconds='parse', rss='peak rss', rows='rows'))
+
+        for mode in MODES:
+            out = subprocess.run([ sys.executable, __file__, '--run', mode, filename ],
+                    env=dict(environ, ADMISSION_CONTROL='false', JOURNAL_DIR=''),
+                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+            result = json.loads(out.stdout)
+
+            print('{mode:<16} {seconds:>9.2f}s {rss:>11.1f}MiB {rows:>8}'.format(
+                mode=mode, seconds=result.get('seconds'), rss=result.get('rss') / 1024 ** 2,
+                rows=result.get('rows')))
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == [ '--run' ]:
+        run(sys.argv[2], sys.argv[3])
+    else:
+        main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+#
+# Measures what logging costs per CSP request. Each logging configuration
+# runs in its own interpreter as log settings are read at import, backend
+# responses are canned and log output is discarded.
+#
+# python3 tests/bench/logging_overhead.py [requests]
+#
+
+from os import environ, path
+from time import perf_counter
+from unittest import mock
+import subprocess
+import logging
+import json
+import sys
+
+CSP = path.join(path.dirname(path.abspath(__file__)), '..', '..', 'truenascsp')
+
+CONFIGS = {
+    'info': {},
+    'debug': { 'LOG_DEBUG': '1' },
+    'debug-json': { 'LOG_DEBUG': '1', 'LOG_FORMAT': 'json' },
+    'debug-sampled-10%': { 'LOG_DEBUG': '1',
+        'LOG_PAYLOAD_SAMPLING': '{"GET /containers/v1/volumes": 0.1}' }
+}
+
+DATASET = {
+    'id': 'tank/vol0',
+    'name': 'tank/vol0',
+    'origin': { 'value': '' },
+    'comments': { 'value': 'Dataset created by HPE CSI Driver for Kubernetes' },
+    'volsize': { 'rawvalue': '1073741824' },
+    'compression': { 'value': 'LZ4' },
+    'deduplication': { 'value': 'OFF' },
+    'sync': { 'value': 'STANDARD' },
+    'volblocksize': { 'value': '8K' }
+}
+
+
+class Response:
+    status_code = 200
+    reason = 'OK'
+    headers = {}
+
+    def __init__(self, body):
+        self.content = json.dumps(body).encode('utf-8')
+        self.text = self.content.decode('utf-8')
+
+    def json(self):
+        return json.loads(self.text)
+
+    def iter_content(self, chunk_size):
+        return [ self.content ]
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def respond(method, url, **kwargs):
+    if url.endswith('core/ping'):
+        return Response('pong')
+    if url.endswith('pool/dataset'):
+        return Response([ DATASET ])
+    if url.endswith('iscsi/initiator'):
+        return Response([])
+
+    return Response({})
+
+
+def run(requests):
+    sys.path.insert(0, CSP)
+
+    import falcon.testing
+    import csp
+
+    client = falcon.testing.TestClient(csp.SERVE)
+    headers = { 'x-auth-token': 'secret', 'x-array-ip': '192.0.2.1' }
+
+    def measure():
+        started = perf_counter()
+        for _ in range(requests):
+            client.simulate_get('/containers/v1/volumes', params={ 'name': 'vol0' }, headers=headers)
+        return (perf_counter() - started) / requests
+
+    with mock.patch('requests.Session.request', side_effect=respond):
+        measure()
+        logging.disable(logging.CRITICAL)
+        baseline = measure()
+        logging.disable(logging.NOTSET)
+        logged = measure()
+
+    print(json.dumps({ 'baseline': baseline, 'logged': logged }))
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+
+    print('{config:<20} {baseline:>12} {logged:>12} {overhead:>12}'.format(
+        config='config', baseline='baseline', logged='logged', overhead='overhead'))
+
+    for config, env in CONFIGS.items():
+        out = subprocess.run([ sys.executable, __file__, '--run', str(requests) ],
+                env=dict(environ, ADMISSION_CONTROL='false', **env),
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+        result = json.loads(out.stdout)
+
+        print('{config:<20} {baseline:>10.1f}us {logged:>10.1f}us {overhead:>10.1f}us'.format(
+            config=config, baseline=result.get('baseline') * 1e6, logged=result.get('logged') * 1e6,
+            overhead=(result.get('logged') - result.get('baseline')) * 1e6))
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == [ '--run' ]:
+        run(int(sys.argv[2]))
+    else:
+        main()
@@ -0,0 +1,86 @@
+from os import path, environ
+import sys
+import tempfile
+
+tests = path.dirname(path.abspath(__file__))
+
+sys.path.insert(0, path.join(tests, '..', 'truenascsp'))
+sys.path.insert(0, path.join(tests, 'fake'))
+
+environ.setdefault('ADMISSION_CONTROL', 'false')
+environ.setdefault('JOURNAL_DIR', tempfile.mkdtemp(prefix='truenas-csp-journal-'))
+environ.setdefault('CACHE_DIR', tempfile.mkdtemp(prefix='truenas-csp-cache-'))
+environ.setdefault('ADMIN_TOKEN', 'admin-' + 'b' * 32)
+
+from contextlib import contextmanager
+from unittest import mock
+import io
+import json
+import pytest
+import requests
+
+TOKEN = '1-' + 'a' * 64
+
+
+class Recording:
+    """
+    Answers the backend requests of the CSP from the fake TrueNAS, which
+    records each call, and records sleeps instead of sleeping.
+    """
+
+    def __init__(self, flavour):
+        import truenas
+
+        self.fake = truenas.FakeTrueNAS(flavour=flavour, datasets=20, snapshots=2)
+        self.sleeps = []
+
+    def request(self, method, url, **kwargs):
+        body = kwargs.get('json')
+
+        if body is None and kwargs.get('data'):
+            body = json.loads(kwargs.get('data'))
+
+        status, payload = self.fake.handle(method, '/' + url.split('://', 1)[-1].split('/', 1)[-1], body or {})
+
+        resp = requests.models.Response()
+        resp.status_code = status
+        resp.reason = 'OK' if status == 200 else 'Error'
+        resp.url = url
+        resp.raw = io.BytesIO(payload)
+
+        return resp
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+
+
+@contextmanager
+def serving(recording, array):
+    """
+    Backend requests go to recording while the CSP is served in process to
+    the yielded client, addressing array.
+    """
+    import falcon.testing
+    import backend
+    import reconciler
+    import csp
+
+    with mock.patch('requests.Session.request', side_effect=recording.request), \
+            mock.patch.object(backend, 'sleep', side_effect=recording.sleep), \
+            mock.patch.object(reconciler, 'sleep', side_effect=recording.sleep):
+        yield falcon.testing.TestClient(csp.SERVE, headers={
+            'x-auth-token': TOKEN,
+            'x-array-ip': array
+        })
+
+
+@pytest.fixture
+def served(request):
+    """
+    A recording of the flavour in request.param (SCALE unless given) and a
+    client addressing the ARRAY of the test module.
+    """
+    recording = Recording(getattr(request, 'param', 'SCALE'))
+
+    with serving(recording, getattr(request.module, 'ARRAY', 'truenas-test')) as client:
+        yield recording, client
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+#
+# (C) Copyright 2024 Hewlett Packard Enterprise Development LP.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+#
+# Stand-in for the Kubernetes coordination.k8s.io/v1 Lease API, enough of
+# it for the lease locks of the CSP. Writes carrying a stale
+# resourceVersion are refused with 409 like the API server does.
+#
+
+from threading import Lock
+import copy
+import io
+import json
+import re
+import requests
+
+LEASE = re.compile('/apis/coordination.k8s.io/v1/namespaces/(?P<namespace>[^/]+)/leases(/(?P<name>[^/]+))?$')
+
+
+class FakeKubernetes:
+    def __init__(self):
+        self.leases = {}
+        self.version = 0
+        self.lock = Lock()
+        self.calls = []
+
+    def handle(self, method, path, body):
+        match = LEASE.match(path)
+
+        if not match:
+            return 404, { 'kind': 'Status', 'reason': 'NotFound' }
+
+        key = (match.group('namespace'), match.group('name') or body.get('metadata', {}).get('name'))
+
+        with self.lock:
+            self.calls.append((method, key[1]))
+            lease = self.leases.get(key)
+
+            if method == 'GET':
+                return (200, copy.deepcopy(lease)) if lease else (404, { 'reason': 'NotFound' })
+
+            if method == 'POST' and lease:
+                return 409, { 'reason': 'AlreadyExists' }
+
+            if method == 'PUT':
+                if not lease:
+                    return 404, { 'reason': 'NotFound' }
+
+                if body.get('metadata', {}).get('resourceVersion') != lease.get('metadata').get('resourceVersion'):
+                    return 409, { 'reason': 'Conflict' }
+
+            if method not in ('POST', 'PUT'):
+                return 405, { 'reason': 'MethodNotAllowed' }
+
+            self.version += 1
+            lease = copy.deepcopy(body)
+            lease['metadata'] = dict(lease.get('metadata', {}), namespace=key[0],
+                                     resourceVersion=str(self.version))
+            self.leases[key] = lease
+
+            return 201 if method == 'POST' else 200, copy.deepcopy(lease)
+
+    def request(self, method, url, **kwargs):
+        status, payload = self.handle(method, '/' + url.split('://', 1)[-1].split('/', 1)[-1],
+                                      kwargs.get('json') or {})
+
+        resp = requests.models.Response()
+        resp.status_code = status
+        resp.url = url
+        resp.raw = io.BytesIO(json.dumps(payload).encode('utf-8'))
+
+        return resp
@@ -0,0 +1,528 @@
+#!/usr/bin/env python3
+
+#
+# (C) Copyright 2024 Hewlett Packard Enterprise Development LP.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+#
+# Stand-in for the TrueNAS REST API v2.0, just enough of it for the CSP.
+# State lives in memory, nothing is persisted between runs.
+#
+# python3 tests/fake/truenas.py --port 8000 --flavour SCALE --datasets 1000
+#
+# Point the CSP at it with BACKEND_SCHEMA=http and X-Array-IP: 127.0.0.1:8000
+#
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import unquote
+from threading import Lock
+from time import time, sleep
+import argparse
+import random
+import json
+import re
+
+VERSIONS = {
+    'SCALE': 'TrueNAS-SCALE-24.04.2',
+    'CORE': 'TrueNAS-13.0-U6.1',
+    'LEGACY': 'FreeNAS-11.3-U5'
+}
+
+GiB = 1024 ** 3
+
+
+def prop(value, rawvalue=None):
+    return {
+        'value': str(value),
+        'rawvalue': str(value if rawvalue is None else rawvalue),
+        'parsed': value if rawvalue is None else rawvalue,
+        'source': 'LOCAL'
+    }
+
+
+def lookup(item, field):
+    for key in field.split('.'):
+        if not isinstance(item, dict):
+            return None
+        item = item.get(key)
+
+    return item
+
+
+def matches(item, filters):
+    for field, operator, value in filters:
+        actual = lookup(item, field)
+
+        if operator == '=' and actual != value:
+            return False
+        if operator == '!=' and actual == value:
+            return False
+        if operator == '^' and not str(actual or '').startswith(value):
+            return False
+        if operator == '$' and not str(actual or '').endswith(value):
+            return False
+        if operator == '~' and not re.search(value, str(actual or '')):
+            return False
+        if operator == 'in' and actual not in value:
+            return False
+
+    return True
+
+
+class Error(Exception):
+    def __init__(self, status, message):
+        super(Error, self).__init__(message)
+        self.status = status
+
+
+class FakeTrueNAS:
+    """
+    The resources and verbs the CSP uses. handle() maps a request to a
+    status and a JSON body and records it in calls.
+    """
+
+    def __init__(self, flavour='SCALE', root='tank', datasets=0, snapshots=0,
+                 latency=0.0, jitter=0.0, error_rate=0.0, error_status=503, seed=0,
+                 portal='hpe-csi', portal_ip='192.0.2.10'):
+        self.flavour = flavour
+        self.root = root
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.lock = Lock()
+        self.calls = []
+        self.ids = {}
+
+        self.tables = {
+            'pool/dataset': {},
+            'zfs/snapshot': {},
+            'iscsi/initiator': {},
+            'iscsi/target': {},
+            'iscsi/extent': {},
+            'iscsi/targetextent': {},
+            'iscsi/auth': {},
+            'iscsi/portal': {},
+            'interface': {}
+        }
+
+        self.iscsi_global = {
+            'id': 1,
+            'basename': 'iqn.2011-08.org.truenas.ctl',
+            'isns_servers': [],
+            'pool_avail_threshold': None,
+            'alua': False
+        }
+
+        self.insert('iscsi/portal', {
+            'comment': portal,
+            'listen': [ { 'ip': portal_ip, 'port': 3260 } ],
+            'discovery_authmethod': 'NONE',
+            'discovery_authgroup': None,
+            'tag': 1
+        })
+
+        self.insert('interface', {
+            'id': 'eth0',
+            'name': 'eth0',
+            'aliases': [ { 'type': 'INET', 'address': portal_ip, 'netmask': 24 } ]
+        }, key='eth0')
+
+        self.add_dataset(root, 'FILESYSTEM')
+
+        for n in range(datasets):
+            name = '{root}/pvc-{n:08d}'.format(root=root, n=n)
+            self.add_dataset(name, 'VOLUME', volsize=GiB, comments=(
+                'Dataset created by HPE CSI Driver for Kubernetes as pvc-{n:08d} '
+                'in default from data-{n}').format(n=n))
+
+            for s in range(snapshots):
+                self.add_snapshot(name, 'snapshot-{s}'.format(s=s))
+
+    def next_id(self, resource):
+        self.ids[resource] = self.ids.get(resource, 0) + 1
+
+        return self.ids.get(resource)
+
+    def insert(self, resource, item, key=None):
+        if key is None:
+            item['id'] = self.next_id(resource)
+            key = item.get('id')
+
+        self.tables[resource][key] = item
+
+        return item
+
+    def add_dataset(self, name, kind, volsize=0, origin='', comments='', **properties):
+        dataset = {
+            'id': name,
+            'name': name,
+            'pool': name.split('/')[0],
+            'type': kind,
+            'origin': prop(origin),
+            'comments': prop(comments),
+            'used': prop(0),
+            'available': prop(1024 * GiB),
+            'referenced': prop(0),
+            'logicalused': prop(0),
+            'usedbysnapshots': prop(0),
+            'compressratio': prop('1.00'),
+            'refreservation': prop(0),
+            'volsize': prop(volsize),
+            'volblocksize': prop(properties.get('volblocksize', '16K')),
+            'compression': prop(properties.get('compression', 'LZ4')),
+            'deduplication': prop(properties.get('deduplication', 'OFF')),
+            'sync': prop(properties.get('sync', 'STANDARD')),
+            'children': []
+        }
+
+        if properties.get('user_properties'):
+            dataset['user_properties'] = { p.get('key'): prop(p.get('value'))
+                                           for p in properties.get('user_properties') }
+
+        if kind == 'VOLUME' and not properties.get('sparse', True):
+            dataset['refreservation'] = prop(volsize)
+
+        self.tables['pool/dataset'][name] = dataset
+
+        return dataset
+
+    def add_snapshot(self, dataset, name):
+        snapshot_id = '{dataset}@{name}'.format(dataset=dataset, name=name)
+        snapshot = {
+            'id': snapshot_id,
+            'name': snapshot_id,
+            'dataset': dataset,
+            'snapshot_name': name,
+            'pool': dataset.split('/')[0],
+            'type': 'SNAPSHOT',
+            'holds': {},
+            'properties': {
+                'numclones': prop(0),
+                'creation': prop(int(time())),
+                'createtxg': prop(self.next_id('txg')),
+                'used': prop(0)
+            }
+        }
+        self.tables['zfs/snapshot'][snapshot_id] = snapshot
+
+        return snapshot
+
+    def query(self, resource, body):
+        filters = body.get('query-filters', []) if isinstance(body, dict) else []
+        options = body.get('query-options', {}) if isinstance(body, dict) else {}
+        items = [ item for item in self.tables.get(resource).values() if matches(item, filters) ]
+
+        if options.get('limit'):
+            items = items[:options.get('limit')]
+
+        if options.get('select'):
+            items = [ { key: item.get(key) for key in options.get('select') if key in item }
+                      for item in items ]
+
+        return items
+
+    def item(self, resource, key):
+        table = self.tables.get(resource)
+
+        if key in table:
+            return table.get(key)
+
+        if key.isdigit() and int(key) in table:
+            return table.get(int(key))
+
+        raise Error(404, '{resource} {key} does not exist'.format(resource=resource, key=key))
+
+    def split(self, path):
+        path = path.split('?')[0]
+        path = path[len('/api/v2.0/'):] if path.startswith('/api/v2.0/') else path.lstrip('/')
+        resource, _, key = path.partition('/id/')
+
+        return resource.rstrip('/'), unquote(key) if key else None
+
+    def handle(self, method, path, body):
+        resource, key = self.split(path)
+
+        delay = self.latency + self.random.uniform(0, self.jitter) if self.latency or self.jitter else 0
+
+        if delay:
+            sleep(delay)
+
+        with self.lock:
+            if self.error_rate and self.random.random() < self.error_rate:
+                status, result = self.error_status, { 'message': 'Injected error' }
+            else:
+                try:
+                    status, result = 200, self.dispatch(method, resource, key, body)
+                except Error as e:
+                    status, result = e.status, { 'message': str(e) }
+
+            payload = json.dumps(result).encode('utf-8')
+            self.calls.append({
+                'method': method,
+                'resource': resource,
+                'status': status,
+                'bytes': len(payload)
+            })
+
+        return status, payload
+
+    def dispatch(self, method, resource, key, body):
+        if resource == 'core/ping':
+            return 'pong'
+
+        if resource == 'system/version':
+            return VERSIONS.get(self.flavour)
+
+        if resource == 'iscsi/global':
+            return self.iscsi_global
+
+        if resource == 'zfs/dataset' and method == 'PUT':
+            dataset = self.item('pool/dataset', key)
+            for name, value in body.get('properties', {}).items():
+                dataset[name] = prop(value.get('value'))
+            return dataset
+
+        if resource == 'zfs/snapshot/clone' and method == 'POST':
+            return self.clone(body)
+
+        if resource == 'pool/dataset' and method == 'POST' and key and key.endswith('/promote'):
+            return self.promote(self.item(resource, key[:-len('/promote')]))
+
+        if resource in ('zfs/snapshot/hold', 'zfs/snapshot/release') and method == 'POST':
+            snapshot = self.item('zfs/snapshot', body.get('id'))
+            snapshot['holds'] = { 'truenas-csp': 1 } if resource.endswith('hold') else {}
+            return None
+
+        if resource not in self.tables:
+            raise Error(404, 'Not found: {resource}'.format(resource=resource))
+
+        if method == 'GET':
+            if key:
+                return self.item(resource, key)
+            return self.query(resource, body)
+
+        if method == 'POST':
+            return self.create(resource, body)
+
+        if method == 'PUT':
+            item = self.item(resource, key)
+            return self.update(resource, item, body)
+
+        if method == 'DELETE':
+            item = self.item(resource, key)
+            return self.remove(resource, item)
+
+        raise Error(405, 'Method not allowed')
+
+    def create(self, resource, body):
+        if resource == 'pool/dataset':
+            if body.get('name') in self.tables['pool/dataset']:
+                raise Error(422, 'Dataset {name} already exists'.format(name=body.get('name')))
+            return self.add_dataset(body.get('name'), body.get('type', 'FILESYSTEM'),
+                    volsize=int(body.get('volsize', 0)), comments=body.get('comments', ''),
+                    volblocksize=body.get('volblocksize', '16K'), compression=body.get('compression', 'LZ4'),
+                    deduplication=body.get('deduplication', 'OFF'), sync=body.get('sync', 'STANDARD'),
+                    sparse=body.get('sparse', True), user_properties=body.get('user_properties', []))
+
+        if resource == 'zfs/snapshot':
+            snapshot_id = '{dataset}@{name}'.format(dataset=body.get('dataset'), name=body.get('name'))
+            self.item('pool/dataset', body.get('dataset'))
+            if snapshot_id in self.tables['zfs/snapshot']:
+                raise Error(422, 'Snapshot {id} already exists'.format(id=snapshot_id))
+            return self.add_snapshot(body.get('dataset'), body.get('name'))
+
+        if resource == 'iscsi/target':
+            body = dict({ 'groups': [], 'auth_networks': [], 'alias': None, 'mode': 'ISCSI' }, **body)
+        elif resource == 'iscsi/extent':
+            body = dict({ 'naa': '0x6589cfc0000{n:021x}'.format(n=self.ids.get(resource, 0) + 1),
+                          'blocksize': 512, 'pblocksize': False, 'enabled': True }, **body)
+        elif resource == 'iscsi/initiator':
+            body = dict({ 'initiators': [], 'auth_network': [] }, **body)
+        elif resource == 'iscsi/auth':
+            # sent as a string, stored as an integer
+            body = dict(body, tag=int(body.get('tag')))
+
+        for item in self.tables.get(resource).values():
+            if body.get('name') and item.get('name') == body.get('name'):
+                raise Error(422, '{resource} {name} already exists'.format(resource=resource, name=body.get('name')))
+
+        return self.insert(resource, dict(body))
+
+    def update(self, resource, item, body):
+        if resource == 'pool/dataset':
+            for name, value in body.items():
+                if name in ('volsize', 'comments', 'compression', 'deduplication', 'sync', 'volblocksize'):
+                    item[name] = prop(value)
+            return item
+
+        item.update(body)
+
+        return item
+
+    def clone(self, body):
+        snapshot = self.item('zfs/snapshot', body.get('snapshot'))
+        origin = self.item('pool/dataset', snapshot.get('dataset'))
+
+        if body.get('dataset_dst') in self.tables['pool/dataset']:
+            raise Error(422, 'Dataset {name} already exists'.format(name=body.get('dataset_dst')))
+
+        dataset = self.add_dataset(body.get('dataset_dst'), origin.get('type'),
+                volsize=int(origin.get('volsize').get('rawvalue')), origin=snapshot.get('id'))
+
+        for name in ('volblocksize', 'compression', 'deduplication', 'sync'):
+            dataset[name] = dict(origin.get(name))
+
+        numclones = snapshot['properties']['numclones']
+        snapshot['properties']['numclones'] = prop(int(numclones.get('rawvalue')) + 1)
+
+        return True
+
+    def promote(self, clone):
+        origin_snapshot = self.tables['zfs/snapshot'].get(clone.get('origin').get('value'))
+
+        if not origin_snapshot:
+            raise Error(422, '{id} is not a clone'.format(id=clone.get('id')))
+
+        origin = self.item('pool/dataset', origin_snapshot.get('dataset'))
+        moved = {}
+
+        # snapshots up to the origin of the clone move to the clone
+        for snapshot_id, snapshot in list(self.tables['zfs/snapshot'].items()):
+            if snapshot.get('dataset') != origin.get('id'):
+                continue
+
+            new_id = '{dataset}@{name}'.format(dataset=clone.get('id'), name=snapshot.get('snapshot_name'))
+            snapshot.update({ 'id': new_id, 'name': new_id, 'dataset': clone.get('id') })
+            del self.tables['zfs/snapshot'][snapshot_id]
+            self.tables['zfs/snapshot'][new_id] = snapshot
+            moved[snapshot_id] = new_id
+
+            if snapshot is origin_snapshot:
+                break
+
+        for dataset in self.tables['pool/dataset'].values():
+            if dataset.get('origin').get('value') in moved and dataset is not clone:
+                dataset['origin'] = prop(moved.get(dataset.get('origin').get('value')))
+
+        clone['origin'], origin['origin'] = origin.get('origin'), prop(origin_snapshot.get('id'))
+
+        return None
+
+    def remove(self, resource, item):
+        if resource == 'pool/dataset':
+            for snapshot_id in [ s for s in self.tables['zfs/snapshot'] if s.startswith(item.get('id') + '@') ]:
+                if self.tables['zfs/snapshot'][snapshot_id]['properties']['numclones']['rawvalue'] != '0':
+                    raise Error(422, '{id} has dependent clones'.format(id=snapshot_id))
+                del self.tables['zfs/snapshot'][snapshot_id]
+
+            # forced deletes take the extents of the zvol along
+            disk = 'zvol/{id}'.format(id=item.get('id'))
+
+            for extent in [ e for e in self.tables['iscsi/extent'].values() if e.get('disk') == disk ]:
+                for targetextent in [ t for t in self.tables['iscsi/targetextent'].values()
+                                      if t.get('extent') == extent.get('id') ]:
+                    del self.tables['iscsi/targetextent'][targetextent.get('id')]
+                del self.tables['iscsi/extent'][extent.get('id')]
+
+            origin = self.tables['zfs/snapshot'].get(item.get('origin').get('value'))
+
+            if origin:
+                numclones = int(origin['properties']['numclones']['rawvalue'])
+                origin['properties']['numclones'] = prop(max(numclones - 1, 0))
+
+            del self.tables['pool/dataset'][item.get('id')]
+            return True
+
+        if resource == 'zfs/snapshot':
+            if item.get('holds'):
+                raise Error(422, '{id} is held'.format(id=item.get('id')))
+            if item['properties']['numclones']['rawvalue'] != '0':
+                raise Error(422, '{id} has dependent clones'.format(id=item.get('id')))
+
+        del self.tables[resource][item.get('id')]
+
+        return True
+
+
+def server(truenas, host='127.0.0.1', port=8000):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def respond(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            raw = self.rfile.read(length) if length else b''
+
+            try:
+                body = json.loads(raw) if raw else {}
+            except ValueError:
+                body = {}
+
+            status, payload = truenas.handle(self.command, self.path, body)
+
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        do_GET = do_POST = do_PUT = do_DELETE = respond
+
+    ThreadingHTTPServer.daemon_threads = True
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake TrueNAS REST API for the CSP')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--flavour', default='SCALE', choices=sorted(VERSIONS))
+    parser.add_argument('--root', default='tank')
+    parser.add_argument('--datasets', type=int, default=0, help='pre-existing zvols under root')
+    parser.add_argument('--snapshots', type=int, default=0, help='snapshots per pre-existing zvol')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to each request')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many seconds added at random')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests failing')
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    truenas = FakeTrueNAS(flavour=args.flavour, root=args.root, datasets=args.datasets,
+                          snapshots=args.snapshots, latency=args.latency, jitter=args.jitter,
+                          error_rate=args.error_rate, error_status=args.error_status, seed=args.seed)
+
+    httpd = server(truenas, args.host, args.port)
+    print('Fake {version} listening on {host}:{port}'.format(version=VERSIONS.get(args.flavour),
+          host=args.host, port=args.port), flush=True)
+
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
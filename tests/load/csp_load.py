@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+#
+# Drives mixed CSI workloads against a running CSP and reports throughput
+# and latency percentiles per route. Each virtual user registers a host and
+# then runs volume lifecycles: create, publish, snapshot, optionally clone,
+# then tear everything down again. Decisions are seeded for repeatable runs.
+#
+# python3 tests/load/csp_load.py --csp http://127.0.0.1:8080 --array 127.0.0.1:8000 --users 4 --iterations 10
+#
+# Users are spread over replicas given as a comma separated list to --csp.
+#
+
+from threading import Thread, Lock
+from time import perf_counter
+import argparse
+import random
+import json
+import sys
+import requests
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = Lock()
+        self.samples = {}
+        self.errors = {}
+
+    def add(self, route, elapsed, failed):
+        with self.lock:
+            self.samples.setdefault(route, []).append(elapsed)
+            if failed:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+    def report(self, duration):
+        routes = {}
+
+        for route, samples in sorted(self.samples.items()):
+            samples = sorted(samples)
+            routes[route] = {
+                'requests': len(samples),
+                'errors': self.errors.get(route, 0),
+                'p50_ms': percentile(samples, 50) * 1000,
+                'p99_ms': percentile(samples, 99) * 1000,
+                'max_ms': samples[-1] * 1000
+            }
+
+        total = sum(route.get('requests') for route in routes.values())
+
+        return {
+            'duration_s': duration,
+            'requests': total,
+            'errors': sum(route.get('errors') for route in routes.values()),
+            'throughput_rps': total / duration if duration else 0.0,
+            'routes': routes
+        }
+
+
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+
+    return samples[min(len(samples) - 1, int(round(p / 100.0 * (len(samples) - 1))))]
+
+
+class User(Thread):
+    def __init__(self, number, args, recorder):
+        super(User, self).__init__(daemon=True)
+        self.number = number
+        self.args = args
+        self.recorder = recorder
+        self.random = random.Random(args.seed * 1000 + number)
+        self.session = requests.Session()
+        self.session.headers.update({
+            'x-auth-token': args.token,
+            'x-array-ip': args.array,
+            'content-type': 'application/json'
+        })
+        self.host_uuid = '00000000-0000-4000-8000-{run:06d}{user:06d}'.format(run=args.seed, user=number)
+        replicas = args.csp.split(',')
+        self.csp = replicas[number % len(replicas)]
+
+    def call(self, method, route, path, body=None, params=None):
+        started = perf_counter()
+        resp = self.session.request(method, '{csp}{path}'.format(csp=self.csp, path=path),
+                data=json.dumps(body) if body is not None else None, params=params)
+        self.recorder.add('{method} {route}'.format(method=method, route=route),
+                perf_counter() - started, resp.status_code >= 400)
+
+        return resp
+
+    def run(self):
+        self.call('POST', '/containers/v1/hosts', '/containers/v1/hosts', {
+            'name': 'load-host-{user}'.format(user=self.number),
+            'uuid': self.host_uuid,
+            'iqns': [ 'iqn.1994-05.com.redhat:load-{user}'.format(user=self.number) ],
+            'networks': [ '192.0.2.{user}/24'.format(user=100 + self.number % 100) ],
+            'wwpns': []
+        })
+
+        for iteration in range(self.args.iterations):
+            self.lifecycle(iteration)
+
+        self.call('DELETE', '/containers/v1/hosts/{host_id}',
+                  '/containers/v1/hosts/{uuid}'.format(uuid=self.host_uuid))
+
+    def lifecycle(self, iteration):
+        name = 'load-{seed}-{user}-{iteration}'.format(seed=self.args.seed, user=self.number, iteration=iteration)
+        volume_id = '{root}_{name}'.format(root=self.args.root.replace('/', '_'), name=name)
+        snapshot_id = '{volume_id}@snap'.format(volume_id=volume_id)
+        clone = self.random.random() < self.args.clones
+
+        self.call('POST', '/containers/v1/volumes', '/containers/v1/volumes', {
+            'name': name,
+            'size': str(self.random.choice([ 1, 5, 10 ]) * 1024 ** 3),
+            'description': 'load test volume {pvc}',
+            'config': { 'root': self.args.root }
+        })
+        self.call('GET', '/containers/v1/volumes', '/containers/v1/volumes', params={ 'name': name })
+
+        publish = { 'host_uuid': self.host_uuid, 'access_protocol': 'iscsi' }
+        self.call('PUT', '/containers/v1/volumes/{volume_id}/actions/publish',
+                  '/containers/v1/volumes/{id}/actions/publish'.format(id=volume_id), publish)
+
+        self.call('POST', '/containers/v1/snapshots', '/containers/v1/snapshots', {
+            'name': 'snap',
+            'volume_id': volume_id,
+            'config': {}
+        })
+        self.call('GET', '/containers/v1/snapshots', '/containers/v1/snapshots', params={ 'volume_id': volume_id })
+
+        if clone:
+            self.call('POST', '/containers/v1/volumes', '/containers/v1/volumes', {
+                'name': '{name}-clone'.format(name=name),
+                'size': '1073741824',
+                'clone': 'true',
+                'base_snapshot_id': snapshot_id,
+                'config': { 'root': self.args.root }
+            })
+            self.call('DELETE', '/containers/v1/volumes/{volume_id}',
+                      '/containers/v1/volumes/{id}-clone'.format(id=volume_id))
+
+        self.call('DELETE', '/containers/v1/snapshots/{snapshot_id}',
+                  '/containers/v1/snapshots/{id}'.format(id=snapshot_id))
+
+        self.call('PUT', '/containers/v1/volumes/{volume_id}/actions/unpublish',
+                  '/containers/v1/volumes/{id}/actions/unpublish'.format(id=volume_id),
+                  { 'host_uuid': self.host_uuid })
+        self.call('DELETE', '/containers/v1/volumes/{volume_id}',
+                  '/containers/v1/volumes/{id}'.format(id=volume_id))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CSI workload generator for the CSP')
+    parser.add_argument('--csp', default='http://127.0.0.1:8080', help='comma separated replicas')
+    parser.add_argument('--array', default='127.0.0.1:8000', help='X-Array-IP sent to the CSP')
+    parser.add_argument('--token', default='1-' + 'a' * 64)
+    parser.add_argument('--root', default='tank')
+    parser.add_argument('--users', type=int, default=4)
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--clones', type=float, default=0.2, help='share of lifecycles that clone')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    recorder = Recorder()
+    users = [ User(number, args, recorder) for number in range(args.users) ]
+
+    started = perf_counter()
+    for user in users:
+        user.start()
+    for user in users:
+        user.join()
+
+    report = recorder.report(perf_counter() - started)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print('{route:<62} {requests:>8} {errors:>7} {p50:>10} {p99:>10}'.format(
+        route='route', requests='requests', errors='errors', p50='p50 ms', p99='p99 ms'))
+
+    for route, stats in report.get('routes').items():
+        print('{route:<62} {requests:>8} {errors:>7} {p50:>10.1f} {p99:>10.1f}'.format(
+            route=route, requests=stats.get('requests'), errors=stats.get('errors'),
+            p50=stats.get('p50_ms'), p99=stats.get('p99_ms')))
+
+    print('\n{requests} requests, {errors} errors in {duration:.1f}s, {rps:.1f} requests/s'.format(
+        requests=report.get('requests'), errors=report.get('errors'),
+        duration=report.get('duration_s'), rps=report.get('throughput_rps')))
+
+    if report.get('errors'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+#
+# Replays a capture written with CAPTURE_DIR through the CSP in process.
+# Backend requests are answered from the capture, in the order the CSI
+# request that caused them saw them, with the recorded latency. CSI
+# requests are sent at their recorded offsets, --speed 10 runs ten times
+# faster and --speed 0 as fast as possible. Requests run one at a time,
+# overlapping requests in the capture are serialized.
+#
+# python3 tests/load/replay.py /tmp/capture/capture-*.jsonl --speed 10
+#
+
+from os import path, environ
+from time import sleep, perf_counter
+from unittest import mock
+import argparse
+import io
+import json
+import sys
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', '..', 'truenascsp'))
+environ.setdefault('ADMISSION_CONTROL', 'false')
+environ.pop('CAPTURE_DIR', None)
+
+import requests
+import falcon.testing
+import backend
+import csp
+
+from csp_load import Recorder
+
+TOKEN = '1-' + 'r' * 64
+
+
+def load(files):
+    entries = []
+
+    for name in files:
+        with open(name) as f:
+            for line in f:
+                if line.strip():
+                    entries.append(json.loads(line))
+
+    csi = sorted([ e for e in entries if e.get('k') == 'csi' ], key=lambda e: e.get('t'))
+    responses = {}
+
+    for entry in sorted([ e for e in entries if e.get('k') == 'backend' ], key=lambda e: e.get('t')):
+        responses.setdefault(entry.get('rid'), []).append(entry)
+
+    return csi, responses
+
+
+class Backend:
+    """
+    Answers backend requests of the CSI request being replayed from its
+    captured round trips. Requests the capture has no answer for are
+    answered by the latest capture of the same method and URI, if any.
+    """
+
+    def __init__(self, responses, speed):
+        self.responses = responses
+        self.speed = speed
+        self.latest = {}
+        self.pending = []
+        self.misses = 0
+
+        for entries in responses.values():
+            for entry in entries:
+                self.latest[(entry.get('m'), entry.get('u'))] = entry
+
+    def start(self, rid):
+        self.pending = list(self.responses.get(rid, []))
+
+    def request(self, method, url, **kwargs):
+        uri = url.split('/api/v2.0/', 1)[-1]
+        entry = None
+
+        for n, candidate in enumerate(self.pending):
+            if candidate.get('m') == method and candidate.get('u') == uri:
+                entry = self.pending.pop(n)
+                break
+
+        if entry is None:
+            entry = self.latest.get((method, uri))
+            self.misses += 1
+
+        resp = requests.models.Response()
+        resp.url = url
+
+        if entry is None or entry.get('s') is None:
+            resp.status_code = 404
+            resp.reason = 'Not Found'
+            resp.raw = io.BytesIO(b'{}')
+            return resp
+
+        if self.speed:
+            sleep(entry.get('ms') / 1000.0 / self.speed)
+
+        resp.status_code = entry.get('s')
+        resp.reason = 'OK' if entry.get('s') == 200 else 'Error'
+        resp.raw = io.BytesIO(json.dumps(entry.get('b')).encode('utf-8'))
+
+        return resp
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a CSP capture against the captured backend')
+    parser.add_argument('files', nargs='+', help='capture files, rotated ones included')
+    parser.add_argument('--speed', type=float, default=1.0, help='0 for as fast as possible')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    csi, responses = load(args.files)
+
+    if not csi:
+        sys.exit('No CSI requests in capture')
+
+    replay = Backend(responses, args.speed)
+    recorder = Recorder()
+    client = falcon.testing.TestClient(csp.SERVE)
+
+    def retry_sleep(seconds):
+        if args.speed:
+            sleep(seconds / args.speed)
+
+    with mock.patch('requests.Session.request', side_effect=replay.request), \
+            mock.patch.object(backend, 'sleep', side_effect=retry_sleep):
+        origin, started = csi[0].get('t'), perf_counter()
+
+        for entry in csi:
+            if args.speed:
+                wait = (entry.get('t') - origin) / args.speed - (perf_counter() - started)
+                if wait > 0:
+                    sleep(wait)
+
+            replay.start(entry.get('rid'))
+            body = entry.get('q')
+
+            # credentials are redacted in the capture, any token passes the replayed ping
+            if isinstance(body, dict) and 'password' in body:
+                body = dict(body, password=TOKEN)
+
+            request_started = perf_counter()
+            resp = client.simulate_request(entry.get('m'), entry.get('p').split('?')[0],
+                    query_string=entry.get('p').partition('?')[2] or None,
+                    body=json.dumps(body) if body is not None else None,
+                    headers={ 'content-type': 'application/json', 'x-auth-token': TOKEN,
+                              'x-array-ip': entry.get('array') or 'replay' })
+
+            recorder.add('{method} {route}'.format(method=entry.get('m'), route=entry.get('route')),
+                    perf_counter() - request_started, str(resp.status_code) != entry.get('s'))
+
+        report = recorder.report(perf_counter() - started)
+
+    report['unmatched_backend_requests'] = replay.misses
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print('{route:<62} {requests:>8} {diverged:>8} {p50:>10} {p99:>10}'.format(
+        route='route', requests='requests', diverged='diverged', p50='p50 ms', p99='p99 ms'))
+
+    for route, stats in report.get('routes').items():
+        print('{route:<62} {requests:>8} {errors:>8} {p50:>10.1f} {p99:>10.1f}'.format(
+            route=route, requests=stats.get('requests'), errors=stats.get('errors'),
+            p50=stats.get('p50_ms'), p99=stats.get('p99_ms')))
+
+    print('\n{requests} requests in {duration:.1f}s, {errors} answered differently than captured, '
+          '{misses} backend requests not in capture'.format(requests=report.get('requests'),
+          duration=report.get('duration_s'), errors=report.get('errors'), misses=replay.misses))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+#
+# Backend round trip budgets per CSP operation and TrueNAS flavour.
+#
+# Every route runs in process against the fake TrueNAS which records each
+# backend call. An operation fails when it makes more calls, moves more
+# bytes or sleeps more often than its budget. When a change legitimately
+# needs more, raise the budget in the same change and say why.
+#
+# python3 -m pytest tests/test_budgets.py
+#
+
+import pytest
+
+from conftest import Recording, TOKEN, serving
+
+FLAVOURS = [ 'SCALE', 'CORE', 'LEGACY' ]
+
+HOST = '41302701-0196-420f-b319-834a79891db0'
+VOLUME = 'tank_budget-volume'
+SNAPSHOT = 'tank_budget-volume@budget-snapshot'
+
+# operation: { flavour: (calls, bytes, sleeps) }, bytes have 10% headroom
+BUDGETS = {
+    'POST /containers/v1/tokens': { 'SCALE': (3, 400, 0), 'CORE': (3, 400, 0), 'LEGACY': (3, 400, 0) },
+    'POST /containers/v1/hosts': { 'SCALE': (5, 200, 0), 'CORE': (5, 200, 0), 'LEGACY': (5, 200, 0) },
+    'POST /containers/v1/hosts existing': { 'SCALE': (2, 200, 0), 'CORE': (2, 200, 0), 'LEGACY': (2, 200, 0) },
+    'POST /containers/v1/volumes': { 'SCALE': (8, 2100, 0), 'CORE': (7, 2000, 0), 'LEGACY': (7, 2000, 0) },
+    'GET /containers/v1/volumes': { 'SCALE': (3, 1600, 0), 'CORE': (3, 1600, 0), 'LEGACY': (3, 1600, 0) },
+    'GET /containers/v1/volumes/{volume_id}': { 'SCALE': (3, 1600, 0), 'CORE': (3, 1600, 0), 'LEGACY': (3, 1600, 0) },
+    'PUT /containers/v1/volumes/{volume_id}': { 'SCALE': (4, 3100, 0), 'CORE': (4, 3100, 0), 'LEGACY': (4, 3100, 0) },
+    'PUT /containers/v1/volumes/{volume_id}/actions/publish': { 'SCALE': (13, 2500, 0), 'CORE': (13, 2500, 0), 'LEGACY': (13, 2500, 0) },
+    'POST /containers/v1/snapshots': { 'SCALE': (5, 1200, 0), 'CORE': (4, 1200, 0), 'LEGACY': (4, 1200, 0) },
+    'GET /containers/v1/snapshots': { 'SCALE': (2, 600, 0), 'CORE': (2, 600, 0), 'LEGACY': (2, 600, 0) },
+    'GET /containers/v1/snapshots/{snapshot_id}': { 'SCALE': (1, 100, 0), 'CORE': (1, 100, 0), 'LEGACY': (1, 100, 0) },
+    'POST /containers/v1/volumes clone': { 'SCALE': (8, 2100, 0), 'CORE': (8, 2100, 0), 'LEGACY': (8, 2100, 0) },
+    'DELETE /containers/v1/volumes/{volume_id} clone': { 'SCALE': (8, 3200, 1), 'CORE': (8, 3200, 1), 'LEGACY': (8, 3200, 1) },
+    'DELETE /containers/v1/snapshots/{snapshot_id}': { 'SCALE': (6, 1200, 1), 'CORE': (5, 1200, 1), 'LEGACY': (5, 1200, 1) },
+    'PUT /containers/v1/volumes/{volume_id}/actions/unpublish': { 'SCALE': (6, 600, 1), 'CORE': (6, 600, 1), 'LEGACY': (11, 1300, 3) },
+    'DELETE /containers/v1/volumes/{volume_id}': { 'SCALE': (8, 3100, 1), 'CORE': (8, 3100, 1), 'LEGACY': (8, 3100, 1) },
+    'DELETE /containers/v1/hosts/{host_id}': { 'SCALE': (4, 300, 1), 'CORE': (4, 400, 1), 'LEGACY': (4, 400, 1) },
+    'GET /containers/v1/capacity': { 'SCALE': (3, 10100, 0), 'CORE': (3, 10100, 0), 'LEGACY': (3, 10100, 0) },
+    'GET /containers/v1/statistics': { 'SCALE': (2, 19800, 0), 'CORE': (2, 19800, 0), 'LEGACY': (2, 19800, 0) }
+}
+
+
+@pytest.fixture(params=FLAVOURS)
+def csp_client(request):
+    recording = Recording(request.param)
+    array = 'truenas-{flavour}'.format(flavour=request.param.lower())
+
+    with serving(recording, array) as client:
+        yield request.param, recording, client, array
+
+
+def measure(recording, call):
+    calls, sleeps = len(recording.fake.calls), len(recording.sleeps)
+    result = call()
+    made = recording.fake.calls[calls:]
+
+    return result, (len(made), sum(c.get('bytes') for c in made), len(recording.sleeps) - sleeps)
+
+
+def lifecycle(client, array):
+    """
+    The operations of a volume's life in the order the CSI driver sends them.
+    """
+    volume = {
+        'name': 'budget-volume',
+        'size': '1073741824',
+        'description': 'budget volume {pvc}',
+        'config': { 'root': 'tank' }
+    }
+    host = {
+        'name': 'budget-host',
+        'uuid': HOST,
+        'iqns': [ 'iqn.1994-05.com.redhat:budget' ],
+        'networks': [ '192.0.2.20/24' ],
+        'wwpns': []
+    }
+
+    return [
+        ('POST /containers/v1/tokens', lambda: client.simulate_post('/containers/v1/tokens',
+            json={ 'array_ip': array, 'username': 'hpe-csi', 'password': TOKEN })),
+        ('POST /containers/v1/hosts', lambda: client.simulate_post('/containers/v1/hosts', json=host)),
+        ('POST /containers/v1/hosts existing', lambda: client.simulate_post('/containers/v1/hosts', json=host)),
+        ('POST /containers/v1/volumes', lambda: client.simulate_post('/containers/v1/volumes', json=volume)),
+        ('GET /containers/v1/volumes', lambda: client.simulate_get('/containers/v1/volumes',
+            params={ 'name': 'budget-volume' })),
+        ('GET /containers/v1/volumes/{volume_id}', lambda: client.simulate_get(
+            '/containers/v1/volumes/{id}'.format(id=VOLUME))),
+        ('PUT /containers/v1/volumes/{volume_id}', lambda: client.simulate_put(
+            '/containers/v1/volumes/{id}'.format(id=VOLUME), json={ 'size': 2147483648 })),
+        ('PUT /containers/v1/volumes/{volume_id}/actions/publish', lambda: client.simulate_put(
+            '/containers/v1/volumes/{id}/actions/publish'.format(id=VOLUME),
+            json={ 'host_uuid': HOST, 'access_protocol': 'iscsi' })),
+        ('POST /containers/v1/snapshots', lambda: client.simulate_post('/containers/v1/snapshots',
+            json={ 'name': 'budget-snapshot', 'volume_id': VOLUME, 'config': {} })),
+        ('GET /containers/v1/snapshots', lambda: client.simulate_get('/containers/v1/snapshots',
+            params={ 'volume_id': VOLUME })),
+        ('GET /containers/v1/snapshots/{snapshot_id}', lambda: client.simulate_get(
+            '/containers/v1/snapshots/{id}'.format(id=SNAPSHOT))),
+        ('POST /containers/v1/volumes clone', lambda: client.simulate_post('/containers/v1/volumes',
+            json=dict(volume, name='budget-clone', clone='true', base_snapshot_id=SNAPSHOT))),
+        ('DELETE /containers/v1/volumes/{volume_id} clone', lambda: client.simulate_delete(
+            '/containers/v1/volumes/tank_budget-clone')),
+        ('DELETE /containers/v1/snapshots/{snapshot_id}', lambda: client.simulate_delete(
+            '/containers/v1/snapshots/{id}'.format(id=SNAPSHOT))),
+        ('PUT /containers/v1/volumes/{volume_id}/actions/unpublish', lambda: client.simulate_put(
+            '/containers/v1/volumes/{id}/actions/unpublish'.format(id=VOLUME), json={ 'host_uuid': HOST })),
+        ('DELETE /containers/v1/volumes/{volume_id}', lambda: client.simulate_delete(
+            '/containers/v1/volumes/{id}'.format(id=VOLUME))),
+        ('DELETE /containers/v1/hosts/{host_id}', lambda: client.simulate_delete(
+            '/containers/v1/hosts/{id}'.format(id=HOST))),
+        ('GET /containers/v1/capacity', lambda: client.simulate_get('/containers/v1/capacity')),
+        ('GET /containers/v1/statistics', lambda: client.simulate_get('/containers/v1/statistics'))
+    ]
+
+
+def test_budgets(csp_client):
+    flavour, recording, client, array = csp_client
+    over = []
+
+    for operation, call in lifecycle(client, array):
+        result, spent = measure(recording, call)
+
+        assert result.status_code < 400, '{operation} failed on {flavour}: {body}'.format(
+            operation=operation, flavour=flavour, body=result.text)
+
+        budget = BUDGETS.get(operation, {}).get(flavour)
+
+        print('{operation:<60} {flavour:<6} calls={spent[0]} bytes={spent[1]} sleeps={spent[2]}'.format(
+            operation=operation, flavour=flavour, spent=spent))
+
+        if budget is None:
+            over.append('{operation} has no budget on {flavour}'.format(operation=operation, flavour=flavour))
+            continue
+
+        for name, used, allowed in zip(('calls', 'bytes', 'sleeps'), spent, budget):
+            if used > allowed:
+                over.append('{operation} on {flavour}: {used} {name}, budget {allowed}'.format(
+                    operation=operation, flavour=flavour, used=used, name=name, allowed=allowed))
+
+    assert not over, '\n'.join(over)
@@ -0,0 +1,128 @@
+#
+# A saturated array only takes its own bulkhead slots.
+#
+# python3 -m pytest tests/test_bulkhead.py
+#
+
+from unittest import mock
+from threading import Thread, Event
+from time import sleep
+import falcon
+import falcon.testing
+import pytest
+
+import admission
+import backend
+import bulkhead
+import csp
+import truenascsp
+
+from conftest import Recording, TOKEN
+
+ARRAY = 'truenas-bulkhead'
+HOST = '41302701-0196-420f-b319-834a79891de0'
+
+
+def test_slots():
+    bulkheads = bulkhead.Bulkhead(slots=2)
+
+    first = bulkheads.enter('array-a')
+    bulkheads.enter('array-a')
+
+    with pytest.raises(bulkhead.Full):
+        bulkheads.enter('array-a')
+
+    # other arrays keep their share
+    bulkheads.enter('array-b')
+
+    status = bulkheads.status()
+    assert status.get('array-a').get('saturation') == 1.0
+    assert status.get('array-b').get('occupied') == 1
+
+    bulkheads.leave(first)
+    bulkheads.enter('array-a')
+
+
+def test_reap():
+    bulkheads = bulkhead.Bulkhead(slots=1)
+    occupant = bulkheads.enter('array-a')
+
+    # a worker killed with the slot taken
+    bulkheads.occupants.set(occupant, 'pid', 2 ** 22 + 1)
+
+    bulkheads.enter('array-a')
+
+
+def test_locks():
+    locks = bulkhead.Locks(stripes=16)
+
+    assert locks.get('array-a') is locks.get('array-a')
+    assert len(set(id(locks.get('array-{n}'.format(n=n))) for n in range(64))) > 1
+
+
+def until(condition, seconds=10):
+    for _ in range(int(seconds * 100)):
+        if condition():
+            return True
+
+        sleep(0.01)
+
+    return False
+
+
+class Blocking(Recording):
+    # snapshot lookups hang until released
+    def __init__(self, flavour):
+        super(Blocking, self).__init__(flavour)
+        self.released = Event()
+
+    def request(self, method, url, **kwargs):
+        if 'snapshot' in url:
+            self.released.wait()
+
+        return super(Blocking, self).request(method, url, **kwargs)
+
+
+def test_publish_first():
+    recording = Blocking('SCALE')
+    config = backend.CONFIG._replace(admission_control=True, bulkhead_slots=8)
+
+    app = falcon.API(middleware=csp.middleware(config))
+    app.add_route('/containers/v1/snapshots/{snapshot_id}', truenascsp.Snapshot())
+    app.add_route('/containers/v1/volumes/{volume_id}/actions/unpublish', truenascsp.Unpublish())
+
+    client = falcon.testing.TestClient(app, headers={ 'x-auth-token': TOKEN, 'x-array-ip': ARRAY })
+    admitting = admission.Admission(initial_limit=4, max_limit=4)
+    deletes = []
+
+    def delete(n):
+        deletes.append(client.simulate_delete('/containers/v1/snapshots/tank_pvc-{n}@snapshot'.format(n=n)))
+
+    with mock.patch('requests.Session.request', side_effect=recording.request), \
+            mock.patch.object(backend, 'ADMISSION', admitting), \
+            mock.patch.object(backend, 'BULKHEAD', bulkhead.Bulkhead(slots=8)):
+        # housekeeping burst, four running and four queued
+        housekeeping = [ Thread(target=delete, args=(n,)) for n in range(8) ]
+        publishing = []
+        publish = Thread(target=lambda: publishing.append(client.simulate_put(
+            '/containers/v1/volumes/tank_pvc-publish/actions/unpublish', json={ 'host_uuid': HOST })))
+
+        try:
+            for thread in housekeeping:
+                thread.start()
+
+            assert until(lambda: admitting.status().get(ARRAY, {}).get('waiting') == 4)
+            publish.start()
+
+            # queued behind the burst or turned away
+            until(lambda: admitting.status().get(ARRAY).get('waiting') == 5 or publishing)
+        finally:
+            recording.released.set()
+
+        publish.join()
+
+        for thread in housekeeping:
+            thread.join()
+
+    assert publishing[0].status_code == 204
+    assert all(response.status_code != 429 for response in deletes)
@@ -0,0 +1,57 @@
+#
+# Configuration is parsed once and can't be changed by requests.
+#
+# python3 -m pytest tests/test_config.py
+#
+
+import pytest
+
+import backend
+import config
+
+
+def test_defaults():
+    loaded = config.load({})
+
+    assert loaded.dataset_defaults.get('root') == 'tank'
+    assert loaded.chap_tag == '4730274'
+    assert set(loaded.performance_profiles) == { 'database', 'vm-boot', 'bulk' }
+
+
+def test_kubernetes():
+    loaded = config.load({ 'LOCK_BACKEND': 'lease', 'KUBERNETES_SERVICE_HOST': '10.96.0.1' })
+
+    assert loaded.kubernetes_url == 'https://10.96.0.1:443'
+
+
+def test_profiles():
+    loaded = config.load({ 'PERFORMANCE_PROFILES': '{"logs": {"sync": "DISABLED"}}' })
+
+    assert loaded.performance_profiles.get('logs').get('sync') == 'DISABLED'
+
+
+@pytest.mark.parametrize('env', [
+    { 'PERFORMANCE_PROFILES': '{"logs": {"recordsize": "1M"}}' },
+    { 'BACKEND_READ_TIMEOUT': 'soon' },
+    { 'DEFAULT_CHAP_TAG': 'tag' },
+    { 'BACKEND_SCHEMA': 'ftp' },
+    { 'LOCK_BACKEND': 'lease' },
+    { 'DEFAULT_DEADLINE': 'never' },
+    { 'ROUTE_DEADLINES': '{"GET /containers/v1/hosts": ' }
+])
+def test_invalid(env):
+    with pytest.raises(ValueError):
+        config.load(env)
+
+
+def test_immutable():
+    api = backend.Handler()
+
+    with pytest.raises(TypeError):
+        api.dataset_defaults['root'] = 'scratch'
+
+    with pytest.raises(AttributeError):
+        api.target_portal = 'other'
+
+    with pytest.raises(AttributeError):
+        api.scratch = True
@@ -0,0 +1,95 @@
+#
+# Timeouts given by callers never extend the deadline of the route, a
+# request past its deadline is answered with a 504 and releases its locks.
+#
+# python3 -m pytest tests/test_deadlines.py
+#
+
+from unittest import mock
+from threading import Thread, Event
+import falcon
+import falcon.testing
+import pytest
+
+import backend
+import csp
+
+ARRAY = 'truenas-deadlines'
+HOST = '41302701-0196-420f-b319-834a79891dd0'
+VOLUME = 'tank_pvc-deadlines'
+
+
+@pytest.mark.parametrize('header, timeout', [
+    (None, 170.0),
+    ('30', 30.0),
+    ('0.5', 0.5),
+    ('600', 170.0),
+    ('0', 170.0),
+    ('-5', 170.0),
+    ('nan', 170.0),
+    ('inf', 170.0),
+    ('soon', 170.0)
+])
+def test_timeout(header, timeout):
+    headers = { 'x-request-timeout': header } if header else {}
+    req = falcon.Request(falcon.testing.create_environ(headers=headers))
+
+    assert csp.TokenHandler().timeout(req, 170.0) == timeout
+
+
+def unpublish(client, **kwargs):
+    return client.simulate_put('/containers/v1/volumes/{id}/actions/unpublish'.format(id=VOLUME),
+                               json={ 'host_uuid': HOST }, **kwargs)
+
+
+def unavailable(api):
+    api.abort = ('503 Service Unavailable', 'Backend unavailable', 1)
+    raise backend.BackendUnavailable(api.abort[1])
+
+
+def test_lock_deadline(served):
+    recording, client = served
+    held, done = Event(), Event()
+
+    def publishing():
+        lock = backend.LOCKS.get(ARRAY, 'volume/pvc-deadlines')
+        lock.acquire()
+        held.set()
+        done.wait()
+        lock.release()
+
+    publisher = Thread(target=publishing)
+    publisher.start()
+    held.wait()
+
+    try:
+        response = unpublish(client, headers={ 'x-request-timeout': '0.2' })
+    finally:
+        done.set()
+        publisher.join()
+
+    assert response.status_code == 504
+    assert response.headers.get('Retry-After') == '1'
+    assert response.json.get('errors')[0].get('code') == '504 Gateway Timeout'
+
+    assert unpublish(client).status_code == 204
+
+
+@pytest.mark.parametrize('method, path', [
+    ('PUT', '/containers/v1/volumes/{volume}/actions/unpublish'),
+    ('POST', '/containers/v1/snapshots'),
+    ('DELETE', '/containers/v1/snapshots/{volume}@snapshot')
+])
+def test_version_unavailable(served, method, path):
+    recording, client = served
+
+    with mock.patch.object(backend.Handler, 'version', unavailable):
+        response = client.simulate_request(method, path.format(volume=VOLUME),
+                                           json={ 'host_uuid': HOST, 'name': 'snapshot', 'volume_id': VOLUME })
+
+    assert response.status_code == 503
+    assert response.headers.get('Retry-After') == '1'
+    assert response.json.get('errors')[0].get('code') == '503 Service Unavailable'
+
+    # the volume lock was given back
+    assert unpublish(client).status_code == 204
@@ -0,0 +1,156 @@
+#
+# The debug endpoints are served to holders of the admin token only.
+#
+# python3 -m pytest tests/test_debug.py
+#
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+from os import getpid, path
+
+import pytest
+
+import config
+import profiler
+import truenascsp
+
+from conftest import Recording, serving
+
+ARRAY = 'truenas-debug'
+
+ADMIN_TOKEN = config.CONFIG.admin_token
+
+
+@pytest.mark.parametrize('path', [ '/debug/traces', '/debug/profile/auto' ])
+def test_admin_token(served, path):
+    recording, client = served
+
+    assert client.simulate_get(path).status_code == 401
+    assert client.simulate_get(path, headers={ 'x-admin-token': 'guess' }).status_code == 401
+    assert client.simulate_get(path, headers={ 'x-admin-token': ADMIN_TOKEN }).status_code != 401
+    assert not recording.fake.calls
+
+
+def test_traces(served):
+    recording, client = served
+
+    client.simulate_get('/containers/v1/volumes')
+    response = client.simulate_get('/debug/traces', headers={ 'x-admin-token': ADMIN_TOKEN })
+
+    assert response.status_code == 200
+    assert isinstance(response.json, list)
+
+
+class Overlapping(Recording):
+    # the first backend request waits for a whole second CSP request
+    def __init__(self, flavour):
+        super(Overlapping, self).__init__(flavour)
+        self.waiting = Event()
+        self.served = Event()
+
+    def request(self, method, url, **kwargs):
+        if not self.waiting.is_set():
+            self.waiting.set()
+            self.served.wait(5)
+
+        return super(Overlapping, self).request(method, url, **kwargs)
+
+
+def test_overlapping(monkeypatch):
+    recording = Overlapping('SCALE')
+    monkeypatch.setattr(truenascsp.profiling, 'sample_percent', 100)
+    profiled = []
+    enable = truenascsp.profiling.enable
+
+    def recorded():
+        profiling = enable()
+        profiled.append(profiling is not None)
+        return profiling
+
+    monkeypatch.setattr(truenascsp.profiling, 'enable', recorded)
+
+    with serving(recording, ARRAY) as client:
+        with ThreadPoolExecutor(1) as pool:
+            first = pool.submit(client.simulate_get, '/containers/v1/volumes')
+            assert recording.waiting.wait(5)
+
+            second = client.simulate_get('/containers/v1/volumes')
+            recording.served.set()
+
+            assert first.result().status_code == 200
+            assert second.status_code == 200
+
+        assert client.simulate_get('/containers/v1/volumes').status_code == 200
+
+    assert profiled == [ True, False, True ]
+    assert not truenascsp.profiling.active
+
+
+@pytest.mark.parametrize('params, status', [
+    ('sort=tottime&limit=10', 200),
+    ('sort=bogus', 400),
+    ('limit=ten', 400),
+    ('limit=-1', 400),
+    ('limit=0', 400)
+])
+def test_profile_params(served, monkeypatch, params, status):
+    recording, client = served
+    monkeypatch.setattr(truenascsp.profiling, 'sample_percent', 100)
+    client.simulate_get('/containers/v1/volumes')
+
+    response = client.simulate_get('/debug/profile/auto', query_string=params,
+                                   headers={ 'x-admin-token': ADMIN_TOKEN })
+
+    assert response.status_code == status
+
+
+def test_flush(monkeypatch, tmp_path):
+    monkeypatch.setattr(profiler, 'PROFILE_DIR', str(tmp_path))
+    profiling = profiler.Profiler(max_seconds=10, max_overhead=0.01, interval=0.01, sample_percent=100,
+                                  flush_interval=3600)
+    filename = profiler.result_path('auto-{pid}'.format(pid=getpid()), 'pstats')
+
+    profiling.disable(profiling.enable())
+    assert path.exists(filename)
+
+    # requests go on while the stats are written
+    writing, written = Event(), Event()
+    dump_stats = profiler.pstats.Stats.dump_stats
+
+    def slow(stats, filename):
+        writing.set()
+        written.wait(5)
+        dump_stats(stats, filename)
+
+    monkeypatch.setattr(profiler.pstats.Stats, 'dump_stats', slow)
+    profiling.disable(profiling.enable())
+
+    with ThreadPoolExecutor(1) as pool:
+        flushing = pool.submit(profiling.flush, True)
+        assert writing.wait(5)
+
+        started = profiler.time()
+        profiling.disable(profiling.enable())
+        assert profiler.time() - started < 1
+
+        written.set()
+        flushing.result()
+
+    # only the flush interval or a read writes the file
+    assert profiling.sampled is not None
+    profiling.flush(force=True)
+    assert profiling.sampled is None
+
+
+def test_cprofile_share(monkeypatch, tmp_path):
+    monkeypatch.setattr(profiler, 'PROFILE_DIR', str(tmp_path))
+    profiling = profiler.Profiler(max_seconds=10, max_overhead=0.25, interval=0.01, sample_percent=0)
+    profiling.start('cprofile', 1)
+    profiled = 0
+
+    for _ in range(8):
+        state = profiling.enable()
+        profiled += state is not None
+        profiling.disable(state)
+
+    assert profiled == 2
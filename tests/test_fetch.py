@@ -0,0 +1,127 @@
+#
+# fetch checks its filter on every row, stops at its limit and holds no
+# more of a listing than the rows it keeps.
+#
+# python3 -m pytest tests/test_fetch.py
+#
+
+from unittest import mock
+import tracemalloc
+import json
+import io
+import pytest
+import requests
+
+import backend
+
+from conftest import Recording, TOKEN, serving
+
+ARRAY = 'truenas-fetch'
+ZVOLS = 1000
+
+
+class Unfiltered(Recording):
+    # answers with every row, as if the filters were lost on the way
+    def request(self, method, url, **kwargs):
+        query = kwargs.get('json') or {}
+
+        if isinstance(query, dict) and query.get('query-filters'):
+            kwargs['json'] = dict(query, **{ 'query-filters': [] })
+
+        return super(Unfiltered, self).request(method, url, **kwargs)
+
+
+@pytest.fixture(params=[ Recording, Unfiltered ])
+def listing(request):
+    recording = request.param('SCALE')
+
+    for n in range(ZVOLS):
+        recording.fake.add_dataset('tank/fetch-{n:04d}'.format(n=n), 'VOLUME', volsize=1024,
+                                   origin='tank/fetch-0000@base' if n % 100 == 1 else '')
+
+    with serving(recording, ARRAY):
+        api = backend.Handler()
+        api.backend = ARRAY
+        api.token = TOKEN
+
+        yield api
+
+
+def test_filtered(listing):
+    api = listing
+
+    assert [ z.get('id') for z in api.fetch('pool/dataset', field='id', value='tank/fetch-0042',
+                                            returnBy=list) ] == [ 'tank/fetch-0042' ]
+    assert len(api.fetch('pool/dataset', field='id', value='tank/fetch-09', operator='^',
+                         returnBy=list)) == 100
+    assert len(api.fetch('pool/dataset', field='id', value='-0990', operator='$', returnBy=list)) == 1
+    assert len(api.fetch('pool/dataset', field='origin.value', value='tank/fetch-0000@base',
+                         returnBy=list)) == ZVOLS // 100
+
+
+def test_capped(served):
+    recording, client = served
+    fake = recording.fake
+
+    for n in range(ZVOLS):
+        fake.add_dataset('tank/fetch-{n:04d}'.format(n=n), 'VOLUME', volsize=1024)
+
+    api = backend.Handler()
+    api.backend = ARRAY
+    api.token = TOKEN
+
+    assert len(api.fetch('pool/dataset', field='type', value='VOLUME', limit=10, returnBy=list)) == 10
+    assert len(api.fetch('pool/dataset', field='type', value='VOLUME', returnBy=list)) > ZVOLS
+    listing = fake.calls[-1].get('bytes')
+
+    # a single row is asked for, TrueNAS doesn't send the whole listing
+    assert api.fetch('pool/dataset', field='type', value='VOLUME', returnBy=dict).get('type') == 'VOLUME'
+    assert fake.calls[-1].get('bytes') * ZVOLS < listing * 2
+
+
+def respond(body):
+    response = requests.models.Response()
+    response.status_code = 200
+    response.raw = io.BytesIO(body)
+
+    return response
+
+
+def test_memory():
+    rows = [ { 'id': 'tank/pvc-{n:06d}@snapshot'.format(n=n), 'holds': {},
+               'properties': { 'used': { 'value': '0B', 'rawvalue': '0', 'parsed': 0, 'source': 'NONE' } } }
+             for n in range(20000) ]
+    body = json.dumps(rows).encode('utf-8')
+    del rows
+
+    api = backend.Handler()
+    api.backend = ARRAY
+    api.token = TOKEN
+
+    with mock.patch('requests.Session.request', side_effect=lambda *args, **kwargs: respond(body)):
+        tracemalloc.start()
+
+        try:
+            found = api.fetch('zfs/snapshot', field='id', value='tank/pvc-019999@snapshot', returnBy=list)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    assert [ snapshot.get('id') for snapshot in found ] == [ 'tank/pvc-019999@snapshot' ]
+    # bound by the chunks read, not the listing
+    assert len(body) > 32 * backend.Handler.chunk_size
+    assert peak < 8 * backend.Handler.chunk_size
+
+
+def test_long_row():
+    body = json.dumps([ { 'id': 'tank/pvc-a' }, { 'id': 'tank/pvc-b', 'comment': 'x' * 4096 } ]).encode('utf-8')
+
+    api = backend.Handler()
+    api.backend = ARRAY
+    api.token = TOKEN
+
+    # a listing cut short isn't returned as the listing
+    with mock.patch('requests.Session.request', side_effect=lambda *args, **kwargs: respond(body)), \
+            mock.patch.object(backend.Handler, 'chunk_size', 256), \
+            mock.patch.object(backend.Handler, 'max_row_length', 1024):
+        assert api.fetch('zfs/snapshot', returnBy=list) is None
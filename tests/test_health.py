@@ -0,0 +1,101 @@
+#
+# Probes report backend latency per array and hold readiness until the
+# caches are warm.
+#
+# python3 -m pytest tests/test_health.py
+#
+
+from unittest import mock
+
+import backend
+import health
+import truenascsp
+
+from conftest import Recording, TOKEN, serving
+
+ARRAY = 'truenas-health'
+
+
+def test_latency():
+    probes = health.Health(max_latency=1.0)
+
+    for sample in range(100):
+        probes.record(ARRAY, sample / 100.0)
+
+    status = probes.status().get(ARRAY)
+    assert status.get('reachable')
+    assert status.get('samples') == 64
+    assert status.get('p50') < status.get('p95') <= status.get('p99')
+    assert probes.ready({}) == (True, 'Ready')
+
+    # a slow array doesn't take traffic
+    probes.record('truenas-slow', 5.0)
+    assert probes.ready({ ARRAY: { 'state': 'open' } })[0] is False
+
+    probes.record('truenas-slow', 0.1)
+    assert probes.ready({ ARRAY: { 'state': 'open' } })[0] is False
+    assert probes.ready({ ARRAY: { 'state': 'half-open' } })[0] is True
+
+
+def test_unreachable():
+    probes = health.Health()
+
+    probes.record(ARRAY, 0.1)
+    probes.record(ARRAY, 5.0, ok=False)
+
+    assert probes.status().get(ARRAY).get('reachable') is False
+    assert probes.ready({})[0] is False
+
+
+def test_prewarm():
+    probes = health.Health(prewarm=(ARRAY,))
+    recording = Recording('SCALE')
+
+    assert probes.ready({})[0] is False
+
+    with serving(recording, ARRAY) as client, mock.patch.object(backend, 'HEALTH', probes):
+        probes.start_prewarm(lambda array: truenascsp.prewarm(array, TOKEN)).join()
+
+        assert probes.prewarm_state() == 'done'
+        assert probes.start_prewarm(lambda array: None) is None
+        assert backend.SHARED_CACHE.count().get(ARRAY)
+
+        ready = client.simulate_get('/readyz')
+
+        assert ready.status_code == 200
+        assert ready.json.get('arrays').get(ARRAY).get('reachable')
+        assert client.simulate_get('/healthz').status_code == 200
+
+
+def test_reclaim():
+    probes = health.Health(prewarm=(ARRAY,))
+
+    # a worker killed while prewarming
+    probes.prewarm.set(0, 'state', health.RUNNING)
+    probes.prewarm.set(0, 'pid', 2 ** 22 + 1)
+
+    probes.start_prewarm(lambda array: None).join()
+    assert probes.ready({})[0] is True
+
+
+def test_recovery():
+    probes = health.Health(probe_after=3600)
+    recording = Recording('SCALE')
+
+    with serving(recording, ARRAY) as client, mock.patch.object(backend, 'HEALTH', probes):
+        assert client.simulate_get('/containers/v1/volumes').status_code == 200
+
+        # an outage and slow requests, then no more traffic
+        for sample in range(64):
+            probes.record(ARRAY, 20.0, ok=False)
+
+        assert client.simulate_get('/readyz').status_code == 503
+
+        # left alone long enough, the array is asked directly
+        probes.probe_after = 0
+        calls = len(recording.fake.calls)
+        ready = client.simulate_get('/readyz')
+
+        assert ready.status_code == 200
+        assert recording.fake.calls[calls].get('resource') == 'core/ping'
+        assert ready.json.get('arrays').get(ARRAY).get('p95') < 1
@@ -0,0 +1,86 @@
+#
+# Hosts re-asserted as they are cost no writes and no locks.
+#
+# python3 -m pytest tests/test_hosts.py
+#
+
+from unittest import mock
+import pytest
+
+import backend
+import locking
+
+from conftest import Recording, serving
+
+ARRAY = 'truenas-hosts'
+HOST = '41302701-0196-420f-b319-834a79891dc0'
+
+
+@pytest.fixture(params=[ 'SCALE', 'CORE' ])
+def registered(request):
+    recording = Recording(request.param)
+
+    with serving(recording, ARRAY) as client:
+        host = {
+            'name': 'hosts-host',
+            'uuid': HOST,
+            'iqns': [ 'iqn.1994-05.com.redhat:hosts-a', 'iqn.1994-05.com.redhat:hosts-b' ],
+            'networks': [ '192.0.2.20/24' ],
+            'chap_user': 'chap-user',
+            'chap_password': 'chap-password-1',
+            'wwpns': []
+        }
+
+        assert client.simulate_post('/containers/v1/hosts', json=host).status_code == 200
+
+        yield recording, client, host
+
+
+def writes(recording, since):
+    return [ (call.get('method'), call.get('resource')) for call in recording.fake.calls[since:]
+             if call.get('method') != 'GET' ]
+
+
+def test_unchanged(registered):
+    recording, client, host = registered
+    since = len(recording.fake.calls)
+
+    with mock.patch.object(backend.LOCKS, 'get', wraps=backend.LOCKS.get) as locks:
+        # IQNs in another order are the same host
+        response = client.simulate_post('/containers/v1/hosts',
+                json=dict(host, iqns=list(reversed(host.get('iqns')))))
+
+    assert response.status_code == 200
+    assert sorted(response.json.get('iqns')) == sorted(host.get('iqns'))
+    assert writes(recording, since) == []
+    assert not locks.called
+
+
+def test_changed(registered):
+    recording, client, host = registered
+    initiators = recording.fake.tables.get('iscsi/initiator')
+
+    since = len(recording.fake.calls)
+    iqns = [ 'iqn.1994-05.com.redhat:hosts-c' ]
+    assert client.simulate_post('/containers/v1/hosts', json=dict(host, iqns=iqns)).status_code == 200
+
+    assert writes(recording, since) == [ ('PUT', 'iscsi/initiator') ]
+    assert [ i.get('initiators') for i in initiators.values() if i.get('comment') == HOST ] == [ iqns ]
+
+    since = len(recording.fake.calls)
+    assert client.simulate_post('/containers/v1/hosts', json=dict(host, iqns=iqns,
+            chap_password='chap-password-2')).status_code == 200
+
+    assert writes(recording, since) == [ ('PUT', 'iscsi/auth') ]
+    assert [ a.get('secret') for a in recording.fake.tables.get('iscsi/auth').values() ] == [ 'chap-password-2' ]
+
+
+def test_stripe_collision(registered):
+    recording, client, host = registered
+
+    # the host and CHAP locks of one request on the same stripe
+    with mock.patch.object(backend, 'LOCKS', locking.LocalLocks(stripes=1)):
+        response = client.simulate_post('/containers/v1/hosts', json=dict(host, chap_password='chap-password-3'))
+
+    assert response.status_code == 200
+    assert [ a.get('secret') for a in recording.fake.tables.get('iscsi/auth').values() ] == [ 'chap-password-3' ]
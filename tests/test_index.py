@@ -0,0 +1,77 @@
+#
+# Datasets and snapshots served from worker memory until written or expired.
+#
+# python3 -m pytest tests/test_index.py
+#
+
+import tempfile
+from unittest import mock
+
+import index
+import sharedcache
+
+ARRAY = 'truenas-index'
+
+SNAPSHOTS = [
+    { 'id': 'tank/a@one', 'dataset': 'tank/a', 'snapshot_name': 'one', 'holds': {} },
+    { 'id': 'tank/a@two', 'dataset': 'tank/a', 'snapshot_name': 'two', 'holds': {} }
+]
+
+
+def indexed(**kwargs):
+    store = sharedcache.SharedCache(tempfile.mkdtemp(), max_entries=100)
+    return index.Index(kwargs.get('ttl', 30), kwargs.get('max_entries', 100), store=store), store
+
+
+def test_lookups():
+    snapshots, _ = indexed()
+    generation = snapshots.generation(ARRAY)
+
+    snapshots.put(ARRAY, 'zfs/snapshot', SNAPSHOTS, generation, holds=True, field='dataset', value='tank/a')
+
+    assert snapshots.get(ARRAY, 'zfs/snapshot', 'tank/a@two') == SNAPSHOTS[1]
+    assert snapshots.get(ARRAY, 'zfs/snapshot', 'tank/a@two', holds=True) == SNAPSHOTS[1]
+    assert snapshots.query(ARRAY, 'zfs/snapshot', 'dataset', 'tank/a', holds=True) == SNAPSHOTS
+    assert snapshots.query(ARRAY, 'zfs/snapshot', 'dataset', 'tank/a') is None
+    assert snapshots.get('truenas-other', 'zfs/snapshot', 'tank/a@two') is None
+
+
+def test_holds():
+    snapshots, _ = indexed()
+
+    snapshots.put(ARRAY, 'zfs/snapshot', SNAPSHOTS[:1], snapshots.generation(ARRAY))
+
+    assert snapshots.get(ARRAY, 'zfs/snapshot', 'tank/a@one')
+    assert snapshots.get(ARRAY, 'zfs/snapshot', 'tank/a@one', holds=True) is None
+
+
+def test_writes():
+    snapshots, store = indexed()
+    generation = snapshots.generation(ARRAY)
+    snapshots.put(ARRAY, 'zfs/snapshot', SNAPSHOTS, generation)
+
+    # another worker wrote
+    store.invalidate(ARRAY, 'zfs')
+    assert snapshots.get(ARRAY, 'zfs/snapshot', 'tank/a@one') is None
+
+    # lookups that raced a write aren't kept
+    snapshots.put(ARRAY, 'zfs/snapshot', SNAPSHOTS, generation)
+    assert snapshots.get(ARRAY, 'zfs/snapshot', 'tank/a@one') is None
+
+    generation = snapshots.generation(ARRAY)
+    snapshots.put(ARRAY, 'zfs/snapshot', SNAPSHOTS, generation)
+    snapshots.invalidate(ARRAY)
+    assert snapshots.get(ARRAY, 'zfs/snapshot', 'tank/a@one') is None
+
+
+def test_expiry():
+    snapshots, _ = indexed(ttl=30, max_entries=2)
+    snapshots.put(ARRAY, 'zfs/snapshot', SNAPSHOTS, snapshots.generation(ARRAY), field='dataset', value='tank/a')
+
+    # the query entry pushed out the least recently used snapshot
+    assert snapshots.get(ARRAY, 'zfs/snapshot', 'tank/a@one') is None
+    assert snapshots.query(ARRAY, 'zfs/snapshot', 'dataset', 'tank/a') is None
+    assert snapshots.get(ARRAY, 'zfs/snapshot', 'tank/a@two')
+
+    with mock.patch.object(index, 'time', return_value=index.time() + 31):
+        assert snapshots.get(ARRAY, 'zfs/snapshot', 'tank/a@two') is None
@@ -0,0 +1,97 @@
+#
+# Interrupted provisioning resumes from the journal instead of starting over.
+#
+# python3 -m pytest tests/test_journal.py
+#
+
+import pytest
+
+import backend
+import reconciler
+
+from conftest import Recording, TOKEN, serving
+
+ARRAY = 'truenas-journal'
+
+VOLUME = {
+    'name': 'journal-volume',
+    'size': '1073741824',
+    'description': 'journal volume {pvc}',
+    'config': { 'root': 'tank' }
+}
+
+
+class Interrupted(Recording):
+    def __init__(self, flavour, resource):
+        super(Interrupted, self).__init__(flavour)
+        self.resource = resource
+
+    def request(self, method, url, **kwargs):
+        if self.resource and method == 'POST' and url.endswith(self.resource):
+            self.resource = None
+            raise backend.DeadlineExceeded('Deadline passed')
+
+        return super(Interrupted, self).request(method, url, **kwargs)
+
+
+@pytest.fixture
+def interrupted(request):
+    recording = Interrupted('SCALE', request.param)
+
+    with serving(recording, ARRAY) as client:
+        yield recording, client
+
+
+def posts(recording, resource):
+    return [ c for c in recording.fake.calls if c.get('method') == 'POST' and c.get('resource') == resource ]
+
+
+@pytest.mark.parametrize('interrupted', [ '/iscsi/target', '/iscsi/extent', '/iscsi/targetextent' ],
+                         indirect=True)
+def test_resume(interrupted):
+    recording, client = interrupted
+    fake = recording.fake
+
+    assert client.simulate_post('/containers/v1/volumes', json=VOLUME).status_code >= 500
+    assert client.simulate_post('/containers/v1/volumes', json=VOLUME).status_code == 200
+
+    assert len(posts(recording, 'pool/dataset')) == 1
+    assert len(posts(recording, 'iscsi/extent')) == 1
+    assert len(fake.tables.get('iscsi/target')) == 1
+    assert len(fake.tables.get('iscsi/extent')) == 1
+    assert len(fake.tables.get('iscsi/targetextent')) == 1
+    assert not backend.JOURNAL.abandoned(ARRAY, -1)
+
+
+@pytest.mark.parametrize('interrupted', [ '/iscsi/targetextent' ], indirect=True)
+def test_rollback(interrupted):
+    recording, client = interrupted
+    fake = recording.fake
+
+    client.simulate_post('/containers/v1/volumes', json=VOLUME)
+    assert len(backend.JOURNAL.abandoned(ARRAY, -1)) == 2
+
+    reconciler.Reconciler('dry-run', 3600, 20, 0, abandon_after=-1).reconcile(ARRAY, TOKEN)
+    assert len(fake.tables.get('iscsi/extent')) == 1
+
+    # the zvol went away, whatever was made for it goes too
+    del fake.tables.get('pool/dataset')['tank/journal-volume']
+
+    reconciler.Reconciler('delete', 3600, 20, 0, abandon_after=-1).reconcile(ARRAY, TOKEN)
+    assert not fake.tables.get('iscsi/target')
+    assert not fake.tables.get('iscsi/extent')
+    assert not backend.JOURNAL.abandoned(ARRAY, -1)
+
+
+@pytest.mark.parametrize('interrupted', [ '/iscsi/targetextent' ], indirect=True)
+def test_rollback_kept(interrupted):
+    recording, client = interrupted
+    fake = recording.fake
+
+    client.simulate_post('/containers/v1/volumes', json=VOLUME)
+
+    reconciler.Reconciler('delete', 3600, 20, 0, abandon_after=-1).reconcile(ARRAY, TOKEN)
+    assert len(fake.tables.get('iscsi/target')) == 1
+    assert len(fake.tables.get('iscsi/extent')) == 1
+    assert 'tank/journal-volume' in fake.tables.get('pool/dataset')
+    assert not backend.JOURNAL.abandoned(ARRAY, -1)
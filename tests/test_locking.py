@@ -0,0 +1,163 @@
+#
+# Keyed locks hold across workers and replicas, fencing tokens only grow
+# and writes under a lost lease are refused.
+#
+# python3 -m pytest tests/test_locking.py
+#
+
+from unittest import mock
+from threading import Thread
+import tempfile
+import pytest
+
+import backend
+import locking
+import kubernetes
+
+ARRAY = 'truenas-locking'
+
+
+def test_local():
+    locks = locking.LocalLocks()
+
+    first = locks.get(ARRAY, 'volume/a')
+    assert first.acquire()
+    assert not locks.get(ARRAY, 'volume/a').acquire(blocking=False)
+
+    first.release()
+    second = locks.get(ARRAY, 'volume/a')
+    assert second.acquire(blocking=False)
+    assert second.token > 1
+    second.release()
+
+
+def test_stripe_collision():
+    # every key on one stripe
+    locks = locking.LocalLocks(stripes=1)
+
+    host = locks.get(ARRAY, 'host/a')
+    auth = locks.get(ARRAY, 'auth/b')
+    assert host.acquire(deadline=locking.time() + 1)
+    assert auth.acquire(deadline=locking.time() + 1)
+
+    # other threads still wait on the stripe
+    waited = []
+    other = Thread(target=lambda: waited.append(locks.get(ARRAY, 'volume/c').acquire(blocking=False)))
+    other.start()
+    other.join()
+    assert waited == [ False ]
+
+    auth.release()
+    host.release()
+
+    other = Thread(target=lambda: waited.append(locks.get(ARRAY, 'volume/c').acquire(blocking=False)))
+    other.start()
+    other.join()
+    assert waited == [ False, True ]
+
+
+def test_file():
+    directory = tempfile.mkdtemp()
+
+    # replicas sharing a directory
+    first = locking.FileLocks(directory).get(ARRAY, 'volume/a')
+    second = locking.FileLocks(directory).get(ARRAY, 'volume/a')
+
+    assert first.acquire()
+    assert not second.acquire(blocking=False)
+    assert locking.FileLocks(directory).get(ARRAY, 'volume/b').acquire(blocking=False)
+
+    first.release()
+    assert second.acquire(blocking=False)
+    assert second.token == 2
+    second.release()
+
+
+@pytest.fixture
+def cluster():
+    fake = kubernetes.FakeKubernetes()
+
+    with mock.patch('requests.Session.request', side_effect=fake.request):
+        yield fake, [ locking.LeaseLocks(namespace='csp', identity='replica-{n}'.format(n=n),
+                                         url='https://kubernetes') for n in range(2) ]
+
+
+def test_lease(cluster):
+    fake, replicas = cluster
+
+    held = replicas[0].get(ARRAY, 'volume/a')
+    assert held.acquire()
+    assert held.token == 1
+    assert not replicas[1].get(ARRAY, 'volume/a').acquire(blocking=False)
+    assert replicas[1].get(ARRAY, 'volume/b').acquire(blocking=False)
+
+    held.renew()
+    held.check()
+    held.release()
+
+    taken = replicas[1].get(ARRAY, 'volume/a')
+    assert taken.acquire(blocking=False)
+    assert taken.token == 2
+    taken.release()
+
+
+def test_expiry(cluster):
+    fake, replicas = cluster
+
+    # a replica that stopped renewing
+    stale = replicas[0].get(ARRAY, 'volume/a')
+    stale.acquire()
+
+    waiting = replicas[1].get(ARRAY, 'volume/a')
+    assert not waiting.acquire(blocking=False)
+
+    later = locking.monotonic() + 16
+
+    with mock.patch.object(locking, 'monotonic', return_value=later):
+        assert waiting.acquire(blocking=False)
+        assert waiting.token == 2
+
+        with pytest.raises(locking.Lost):
+            stale.check()
+
+    # writes under the lost lease never reach the array
+    api = backend.Handler()
+    api.backend = ARRAY
+    api.token = '1-' + 'a' * 64
+    api.leases.append(stale)
+
+    calls = len(fake.calls)
+
+    with pytest.raises(backend.BackendUnavailable):
+        api.post('iscsi/initiator', {})
+
+    assert len(fake.calls) == calls
+    assert api.abort[0] == '503 Service Unavailable'
+
+
+def test_deadline(cluster):
+    fake, replicas = cluster
+
+    held = replicas[0].get(ARRAY, 'volume/a')
+    assert held.acquire()
+
+    waiting = replicas[1].get(ARRAY, 'volume/a')
+    polls = len(fake.calls)
+    started = locking.time()
+
+    assert not waiting.acquire(deadline=started + 0.2)
+    assert locking.time() - started < 1
+    assert len(fake.calls) > polls
+
+    # a caller past its deadline gets a 504 instead of waiting on the lease
+    api = backend.Handler()
+    api.backend = ARRAY
+    api.deadline = locking.time() - 1
+
+    with pytest.raises(backend.DeadlineExceeded):
+        api.hold(waiting, 'volume')
+
+    assert api.abort[0] == '504 Gateway Timeout'
+    assert waiting not in api.leases
+
+    held.release()
@@ -0,0 +1,70 @@
+#
+# A performance profile TrueNAS refuses fails the request instead of passing silently.
+#
+# python3 -m pytest tests/test_profiles.py
+#
+
+import io
+
+import pytest
+import requests
+
+import metrics
+
+from conftest import Recording, serving
+
+ARRAY = 'truenas-profiles'
+
+VOLUME = {
+    'name': 'profile-volume',
+    'size': '1073741824',
+    'description': 'profile volume {pvc}',
+    'config': { 'root': 'tank', 'performance_profile': 'database' }
+}
+
+
+class Refusing(Recording):
+    def __init__(self, flavour):
+        super(Refusing, self).__init__(flavour)
+        self.refuse = True
+
+    def request(self, method, url, **kwargs):
+        if self.refuse and method == 'PUT' and '/zfs/dataset/' in url:
+            self.refuse = False
+            response = requests.models.Response()
+            response.status_code = 422
+            response.url = url
+            response.raw = io.BytesIO(b'{"message": "Invalid property"}')
+            return response
+
+        return super(Refusing, self).request(method, url, **kwargs)
+
+
+@pytest.fixture
+def refusing():
+    recording = Refusing('SCALE')
+
+    with serving(recording, ARRAY) as client:
+        yield recording, client
+
+
+def failed():
+    return metrics.PROFILE_FAILED.labels(ARRAY, 'zfs/dataset')._value.get()
+
+
+def test_refused(refusing):
+    recording, client = refusing
+    fake = recording.fake
+    before = failed()
+
+    response = client.simulate_post('/containers/v1/volumes', json=VOLUME)
+    assert response.status_code == 500
+    assert failed() == before + 1
+    assert 'tank/profile-volume' in fake.tables.get('pool/dataset')
+    assert not fake.tables.get('iscsi/target')
+
+    assert client.simulate_post('/containers/v1/volumes', json=VOLUME).status_code == 200
+
+    dataset = fake.tables.get('pool/dataset').get('tank/profile-volume')
+    assert dataset.get('logbias').get('value') == 'latency'
+    assert len(fake.tables.get('iscsi/target')) == 1
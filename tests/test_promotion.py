@@ -0,0 +1,101 @@
+#
+# Deleting the origin of clones promotes a clone when CLONE_PROMOTION is set.
+#
+# python3 -m pytest tests/test_promotion.py
+#
+
+from unittest import mock
+import pytest
+
+import backend
+
+ARRAY = 'truenas-promotion'
+ORIGIN = 'tank_promotion-origin'
+SNAPSHOT = 'tank_promotion-origin@promotion-snapshot'
+
+
+@pytest.fixture
+def cloned(served):
+    recording, client = served
+    volume = {
+        'name': 'promotion-origin',
+        'size': '1073741824',
+        'description': 'promotion volume {pvc}',
+        'config': { 'root': 'tank' }
+    }
+
+    assert client.simulate_post('/containers/v1/volumes', json=volume).status_code == 200
+    assert client.simulate_post('/containers/v1/snapshots', json={
+        'name': 'promotion-snapshot', 'volume_id': ORIGIN, 'config': {} }).status_code == 200
+
+    for name in [ 'promotion-clone-1', 'promotion-clone-2' ]:
+        assert client.simulate_post('/containers/v1/volumes', json=dict(volume, name=name,
+            clone='true', base_snapshot_id=SNAPSHOT)).status_code == 200
+
+    return recording, client
+
+
+def test_disabled(cloned):
+    recording, client = cloned
+
+    assert client.simulate_delete('/containers/v1/volumes/' + ORIGIN).status_code == 409
+    assert 'tank/promotion-origin' in recording.fake.tables.get('pool/dataset')
+
+
+def test_promote(cloned):
+    recording, client = cloned
+    datasets = recording.fake.tables.get('pool/dataset')
+
+    with mock.patch.object(backend.Handler, 'clone_promotion', True):
+        assert client.simulate_delete('/containers/v1/volumes/' + ORIGIN).status_code == 204
+
+        assert 'tank/promotion-origin' not in datasets
+        assert datasets.get('tank/promotion-clone-2').get('origin').get('value') == ''
+        assert datasets.get('tank/promotion-clone-1').get('origin').get('value') == \
+            'tank/promotion-clone-2@promotion-snapshot'
+
+        # the snapshot moved to the promoted clone and keeps its CSI ID
+        snapshot = client.simulate_get('/containers/v1/snapshots/' + SNAPSHOT)
+        assert snapshot.status_code == 200
+        assert snapshot.json.get('id') == SNAPSHOT
+        assert snapshot.json.get('volume_id') == 'tank_promotion-clone-2'
+
+        for name in [ 'tank_promotion-clone-1', 'tank_promotion-clone-2' ]:
+            assert client.simulate_get('/containers/v1/volumes/' + name).status_code == 200
+
+        # the snapshot is destroyed once its last clone is gone
+        assert client.simulate_delete('/containers/v1/volumes/tank_promotion-clone-1').status_code == 204
+        assert client.simulate_delete('/containers/v1/snapshots/' + SNAPSHOT).status_code == 204
+        assert 'tank/promotion-clone-2@promotion-snapshot' not in recording.fake.tables.get('zfs/snapshot')
+
+
+def test_several_snapshots(cloned):
+    recording, client = cloned
+    datasets = recording.fake.tables.get('pool/dataset')
+
+    assert client.simulate_post('/containers/v1/snapshots', json={
+        'name': 'promotion-later', 'volume_id': ORIGIN, 'config': {} }).status_code == 200
+    assert client.simulate_post('/containers/v1/volumes', json={
+        'name': 'promotion-clone-3', 'size': '1073741824', 'config': { 'root': 'tank' },
+        'clone': 'true', 'base_snapshot_id': ORIGIN + '@promotion-later' }).status_code == 200
+
+    with mock.patch.object(backend.Handler, 'clone_promotion', True):
+        response = client.simulate_delete('/containers/v1/volumes/' + ORIGIN)
+
+    assert response.status_code == 409
+    assert 'promote one by hand' in response.text
+    assert 'tank/promotion-origin' in datasets
+    assert all(datasets.get('tank/promotion-clone-{n}'.format(n=n)).get('origin').get('value')
+               .startswith('tank/promotion-origin@') for n in (1, 2, 3))
+
+
+@pytest.mark.parametrize('promotion, searched', [ (False, False), (True, True) ])
+def test_missing_snapshot(served, promotion, searched):
+    recording, client = served
+
+    with mock.patch.object(backend.Handler, 'clone_promotion', promotion), \
+            mock.patch.object(backend.Handler, 'lookup', autospec=True, side_effect=backend.Handler.lookup) as lookup:
+        assert client.simulate_delete('/containers/v1/snapshots/tank_promotion-origin@gone').status_code == 404
+
+    # only promotion moves snapshots, nothing to look for elsewhere without it
+    assert any(call.kwargs.get('field') == 'snapshot_name' for call in lookup.call_args_list) is searched
@@ -0,0 +1,149 @@
+#
+# Orphan detection and cleanup against the fake TrueNAS.
+#
+# python3 -m pytest tests/test_reconciler.py
+#
+
+from unittest import mock
+from threading import Thread, Event
+import pytest
+
+import backend
+import locking
+import reconciler
+
+from conftest import Recording, TOKEN, serving
+
+ARRAY = 'truenas-reconciler'
+HOST = '41302701-0196-420f-b319-834a79891db0'
+
+
+def publish(fake, name, portal=1, comment='Managed by HPE CSI Driver for Kubernetes'):
+    initiator = fake.insert('iscsi/initiator', { 'comment': name, 'initiators': [] })
+    target = fake.insert('iscsi/target', { 'name': name, 'groups': [
+        { 'portal': portal, 'initiator': initiator.get('id'), 'auth': None, 'authmethod': 'NONE' } ] })
+    extent = fake.insert('iscsi/extent', { 'name': name, 'comment': comment,
+        'disk': 'zvol/tank/{name}'.format(name=name) })
+    fake.insert('iscsi/targetextent', { 'target': target.get('id'), 'extent': extent.get('id'), 'lunid': 0 })
+
+
+@pytest.fixture
+def recording():
+    recording = Recording('SCALE')
+    fake = recording.fake
+
+    publish(fake, 'pvc-00000000')
+    publish(fake, 'pvc-deleted')
+    publish(fake, 'backups', portal=99, comment='Made by hand')
+    fake.insert('iscsi/initiator', { 'comment': HOST, 'initiators': [] })
+
+    # provisioning in progress, target without a group
+    fake.insert('iscsi/target', { 'name': 'pvc-interrupted', 'groups': [] })
+
+    with serving(recording, ARRAY):
+        yield recording
+
+
+def names(fake, resource, field):
+    return sorted(item.get(field) for item in fake.tables.get(resource).values())
+
+
+def test_dry_run(recording):
+    fake = recording.fake
+
+    before = { resource: dict(table) for resource, table in fake.tables.items() }
+    orphans = reconciler.Reconciler('dry-run', 3600, 20, 0).reconcile(ARRAY, TOKEN)
+
+    assert [ o.get('name') for o in orphans.get('target') ] == [ 'pvc-deleted' ]
+    assert [ o.get('name') for o in orphans.get('extent') ] == [ 'pvc-deleted' ]
+    assert [ o.get('comment') for o in orphans.get('initiator') ] == [ 'pvc-deleted' ]
+    assert len(orphans.get('targetextent')) == 1
+    assert { resource: dict(table) for resource, table in fake.tables.items() } == before
+
+
+def test_delete(recording):
+    fake = recording.fake
+
+    reconciler.Reconciler('delete', 3600, 20, 0).reconcile(ARRAY, TOKEN)
+
+    assert names(fake, 'iscsi/target', 'name') == [ 'backups', 'pvc-00000000', 'pvc-interrupted' ]
+    assert names(fake, 'iscsi/extent', 'name') == [ 'backups', 'pvc-00000000' ]
+    assert names(fake, 'iscsi/initiator', 'comment') == sorted([ HOST, 'backups', 'pvc-00000000' ])
+    assert len(fake.tables.get('iscsi/targetextent')) == 2
+
+
+def test_max_deletes(recording):
+    reconciler.Reconciler('delete', 3600, 1, 0).reconcile(ARRAY, TOKEN)
+
+    assert len(recording.fake.tables.get('iscsi/targetextent')) == 2
+    assert len(recording.fake.tables.get('iscsi/target')) == 4
+
+
+class Racing(Recording):
+    # a volume is provisioned between the listings of targets and extents
+    def request(self, method, url, **kwargs):
+        if method == 'GET' and url.split('?')[0].endswith('/iscsi/extent') and \
+                not self.fake.tables.get('pool/dataset').get('tank/pvc-racing'):
+            self.fake.add_dataset('tank/pvc-racing', 'VOLUME', volsize=1024)
+            publish(self.fake, 'pvc-racing')
+
+        return super(Racing, self).request(method, url, **kwargs)
+
+
+def test_racing():
+    recording = Racing('SCALE')
+
+    with serving(recording, ARRAY):
+        orphans = reconciler.Reconciler('delete', 3600, 20, 0).reconcile(ARRAY, TOKEN)
+
+    fake = recording.fake
+
+    assert len(orphans.get('targetextent')) == 1
+    assert names(fake, 'iscsi/target', 'name') == [ 'pvc-racing' ]
+    assert names(fake, 'iscsi/extent', 'name') == [ 'pvc-racing' ]
+    assert len(fake.tables.get('iscsi/targetextent')) == 1
+
+
+def test_stripe_collision(recording):
+    locks = locking.LocalLocks(stripes=1)
+
+    with mock.patch.object(backend, 'LOCKS', locks):
+        # the pass lock shares the stripe of every volume
+        passing = locks.get(ARRAY, 'reconciler')
+        assert passing.acquire(blocking=False)
+
+        try:
+            reconciler.Reconciler('delete', 3600, 20, 0).reconcile(ARRAY, TOKEN)
+        finally:
+            passing.release()
+
+    assert names(recording.fake, 'iscsi/target', 'name') == [ 'backups', 'pvc-00000000', 'pvc-interrupted' ]
+
+
+def test_deadline(recording):
+    locks = locking.LocalLocks(stripes=1)
+    held, done = Event(), Event()
+
+    def publishing():
+        lock = locks.get(ARRAY, 'volume/pvc-deleted')
+        lock.acquire()
+        held.set()
+        done.wait()
+        lock.release()
+
+    publisher = Thread(target=publishing)
+    publisher.start()
+    held.wait()
+
+    try:
+        with mock.patch.object(backend, 'LOCKS', locks):
+            with pytest.raises(backend.DeadlineExceeded):
+                reconciler.Reconciler('delete', 3600, 20, 0, deadline=0.1).reconcile(ARRAY, TOKEN)
+    finally:
+        done.set()
+        publisher.join()
+
+    # the pass gave up and left the stripe free
+    lock = locks.get(ARRAY, 'volume/pvc-deleted')
+    assert lock.acquire(blocking=False)
+    lock.release()
@@ -0,0 +1,81 @@
+#
+# Backend lookups shared between workers.
+#
+# python3 -m pytest tests/test_sharedcache.py
+#
+
+from multiprocessing import get_context
+import pytest
+
+import sharedcache
+
+ARRAY = '192.0.2.1'
+
+
+@pytest.fixture
+def workers(tmp_path):
+    return [ sharedcache.SharedCache(str(tmp_path), max_entries=4, prune_every=1) for _ in range(2) ]
+
+
+def test_shared(workers):
+    first, second = workers
+
+    first.set(ARRAY, 'system/version', 'key', [ 'TrueNAS-SCALE-24.04.2' ])
+
+    assert second.get(ARRAY, 'system/version', 'key', 60)[0] == [ 'TrueNAS-SCALE-24.04.2' ]
+    assert second.get(ARRAY, 'system/version', 'key', -1) is None
+    assert second.get('192.0.2.2', 'system/version', 'key', 60) is None
+
+
+def test_invalidate(workers):
+    first, second = workers
+
+    first.set(ARRAY, 'iscsi/portal', 'key', [ { 'id': 1 } ])
+    second.invalidate(ARRAY, 'iscsi/portal')
+
+    assert first.get(ARRAY, 'iscsi/portal', 'key', 60) is None
+
+
+def test_stale_lookup(workers):
+    first, second = workers
+
+    # a lookup racing a write in another worker isn't stored
+    generation = first.generation(ARRAY, 'iscsi/portal')
+    second.invalidate(ARRAY, 'iscsi/portal')
+    first.set(ARRAY, 'iscsi/portal', 'key', [ { 'id': 1 } ], generation)
+
+    assert first.get(ARRAY, 'iscsi/portal', 'key', 60) is None
+
+
+def test_bounded(workers):
+    first, _ = workers
+
+    for n in range(10):
+        first.set(ARRAY, 'interface', str(n), [ n ])
+
+    assert len(first._run('SELECT key FROM entries')) == 4
+    assert first.get(ARRAY, 'interface', '9', 60)[0] == [ 9 ]
+
+
+def lookup(directory, queue):
+    queue.put(sharedcache.SharedCache(directory, max_entries=4).get(ARRAY, 'system/version', 'key', 60))
+
+
+def test_forked(tmp_path, workers):
+    first, _ = workers
+    first.set(ARRAY, 'system/version', 'key', [ 'TrueNAS-13.0-U6.1' ])
+
+    context = get_context('fork')
+    queue = context.Queue()
+    worker = context.Process(target=lookup, args=(str(tmp_path), queue))
+    worker.start()
+    worker.join(10)
+
+    assert queue.get(timeout=10)[0] == [ 'TrueNAS-13.0-U6.1' ]
+
+
+def test_disabled():
+    cache = sharedcache.SharedCache('', max_entries=4)
+    cache.set(ARRAY, 'system/version', 'key', [ 'TrueNAS-SCALE-24.04.2' ])
+
+    assert cache.get(ARRAY, 'system/version', 'key', 60) is None
@@ -0,0 +1,38 @@
+#
+# Volume statistics name the claim behind each zvol whatever its description.
+#
+# python3 -m pytest tests/test_statistics.py
+#
+
+ARRAY = 'truenas-statistics'
+
+
+def test_claim(served):
+    recording, client = served
+
+    # created before the claim was kept in user properties
+    recording.fake.add_dataset('tank/statistics-legacy', 'VOLUME', volsize=1024,
+            comments='Dataset created by HPE CSI Driver for Kubernetes as pvc-5678 in team-b from logs')
+
+    assert client.simulate_post('/containers/v1/volumes', json={
+        'name': 'statistics-volume',
+        'size': '1073741824',
+        'description': 'Custom {pvc} description',
+        'config': {
+            'root': 'tank',
+            'csi.storage.k8s.io/pv/name': 'pvc-1234',
+            'csi.storage.k8s.io/pvc/name': 'data',
+            'csi.storage.k8s.io/pvc/namespace': 'team-a'
+        }
+    }).status_code == 200
+
+    statistics = client.simulate_get('/containers/v1/statistics', params={ 'root': 'tank' })
+    volumes = { volume.get('name'): volume for volume in statistics.json.get('volumes') }
+
+    assert statistics.status_code == 200
+    assert volumes.get('statistics-volume').get('pv') == 'pvc-1234'
+    assert volumes.get('statistics-volume').get('pvc') == 'data'
+    assert volumes.get('statistics-volume').get('namespace') == 'team-a'
+
+    assert volumes.get('statistics-legacy').get('pvc') == 'logs'
+    assert volumes.get('statistics-legacy').get('namespace') == 'team-b'
@@ -0,0 +1,73 @@
+#
+# Incremental parsing of TrueNAS list responses.
+#
+# python3 -m pytest tests/test_streaming.py
+#
+
+from unittest import mock
+import json
+import pytest
+
+import streaming
+
+DOCUMENTS = [
+    [],
+    [ 1, 2, 3 ],
+    [ 12345, 6.5e10, -1.5e-3, True, None, 's,]' ],
+    [ { 'id': 'tank/pvc-é@snap', 'holds': { 'truenas-csp': 1 }, 'children': [ 1, { 'c': None } ] } ] * 5,
+    [ [ 1, 2 ], [ 3 ] ],
+    { 'id': 1 },
+    'pong',
+    7
+]
+
+
+def chunked(content, size):
+    return [ content[i:i + size] for i in range(0, len(content), size) ]
+
+
+@pytest.mark.parametrize('size', [ 1, 2, 3, 7, 4096 ])
+@pytest.mark.parametrize('document', DOCUMENTS)
+def test_items(document, size):
+    for content in (json.dumps(document, ensure_ascii=False), json.dumps(document, indent=2)):
+        items = list(streaming.items(chunked(content.encode('utf-8'), size)))
+
+        assert items == (document if isinstance(document, list) else [ document ])
+
+
+def test_stops_reading():
+    chunks = iter(chunked(json.dumps([ { 'id': n } for n in range(100) ]).encode('utf-8'), 16))
+
+    assert next(streaming.items(chunks)) == { 'id': 0 }
+    assert next(chunks, None) is not None
+
+
+@pytest.mark.parametrize('content', [ b'[1,2', b'[{"id": 1', b'' ])
+def test_truncated(content):
+    with pytest.raises(ValueError):
+        list(streaming.items(chunked(content, 2)))
+
+
+def test_large_element():
+    document = [ { 'comment': 'x' * 1024 * 1024 }, 1 ]
+    decodes = []
+    raw_decode = streaming.decoder.raw_decode
+
+    def counting(*args):
+        decodes.append(args)
+        return raw_decode(*args)
+
+    # decoded again as it doubles, not once per chunk
+    with mock.patch.object(streaming.decoder, 'raw_decode', side_effect=counting):
+        assert list(streaming.items(chunked(json.dumps(document).encode('utf-8'), 1024))) == document
+
+    assert len(decodes) < 20
+
+
+def test_max_length():
+    content = json.dumps([ 1, 'x' * 4096, 2 ]).encode('utf-8')
+
+    with pytest.raises(ValueError):
+        list(streaming.items(chunked(content, 256), max_length=1024))
+
+    assert list(streaming.items(chunked(content, 256), max_length=8192)) == [ 1, 'x' * 4096, 2 ]
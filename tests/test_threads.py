@@ -0,0 +1,74 @@
+#
+# Requests served by threads of the same worker don't see each other's
+# backend responses.
+#
+# python3 -m pytest tests/test_threads.py
+#
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+import pytest
+
+import backend
+
+from conftest import Recording, serving
+
+ARRAY = 'truenas-threads'
+THREADS = 8
+
+
+class Serialized(Recording):
+    # the fake isn't thread-safe, the CSP has to be
+    def __init__(self, flavour):
+        super(Serialized, self).__init__(flavour)
+        self.lock = Lock()
+
+    def request(self, method, url, **kwargs):
+        with self.lock:
+            return super(Serialized, self).request(method, url, **kwargs)
+
+    def sleep(self, seconds):
+        with self.lock:
+            return super(Serialized, self).sleep(seconds)
+
+
+@pytest.fixture
+def threaded():
+    recording = Serialized('SCALE')
+
+    with serving(recording, ARRAY) as client:
+        yield recording, client
+
+
+def create(client, index):
+    return client.simulate_post('/containers/v1/volumes', json={
+        'name': 'thread-volume-{index}'.format(index=index),
+        'size': str((index + 1) * 1073741824),
+        'description': 'thread volume {pvc}',
+        'config': { 'root': 'tank' }
+    })
+
+
+def test_concurrent_creates(threaded):
+    recording, client = threaded
+
+    with ThreadPoolExecutor(THREADS) as pool:
+        responses = list(pool.map(lambda index: create(client, index), range(THREADS * 2)))
+
+    for index, response in enumerate(responses):
+        assert response.status_code == 200
+        assert response.json.get('name') == 'thread-volume-{index}'.format(index=index)
+        assert response.json.get('size') == (index + 1) * 1073741824
+
+    extents = list(recording.fake.tables.get('iscsi/extent').values())
+    assert len(extents) == THREADS * 2
+    assert len(set(e.get('disk') for e in extents)) == THREADS * 2
+    assert len(recording.fake.tables.get('iscsi/targetextent')) == THREADS * 2
+
+
+def test_session_per_thread():
+    with ThreadPoolExecutor(2) as pool:
+        sessions = list(pool.map(lambda _: backend.session(), range(2)))
+
+    assert backend.session() is backend.session()
+    assert backend.session() not in sessions
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+#
+# (C) Copyright 2024 Hewlett Packard Enterprise Development LP.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+from os import getpid
+from time import time
+from math import ceil
+from multiprocessing import Condition
+from shared import Table, array_key, pid_alive
+
+# priorities, lower goes first
+PUBLISH = 0
+PROVISION = 1
+HOUSEKEEPING = 2
+
+PRIORITIES = 3
+
+# ticket states
+WAITING = 1
+RUNNING = 2
+
+
+class Overloaded(Exception):
+    def __init__(self, message, retry_after):
+        super(Overloaded, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class Admission:
+    """
+    Admits CSI requests to a backend by priority. Each backend has its own
+    concurrency limit, raised additively while backend round trips stay below
+    the latency target and halved when they don't or the request fails.
+    """
+
+    def __init__(self, **kwargs):
+        self.initial_limit = kwargs.get('initial_limit', 4.0)
+        self.min_limit = kwargs.get('min_limit', 1.0)
+        self.max_limit = kwargs.get('max_limit', 16.0)
+        self.latency_target = kwargs.get('latency_target', 2.0)
+        self.queue_depth = kwargs.get('queue_depth', 32)
+        self.queue_timeout = kwargs.get('queue_timeout', 30.0)
+
+        self.names = {}
+        self.condition = Condition()
+        self.backends = Table(kwargs.get('backends', 16), [ 'key', 'limit', 'latency' ])
+        self.tickets = Table(kwargs.get('tickets', 256),
+                [ 'backend', 'pid', 'priority', 'state', 'started' ])
+
+    def _backend(self, array):
+        key = array_key(array)
+        self.names[key] = array
+
+        return self.backends.row(key, limit=self.initial_limit)
+
+    def _reap(self):
+        # tickets of workers killed by gunicorn are never released
+        for ticket in range(self.tickets.rows):
+            if self.tickets.get(ticket, 'backend') and not pid_alive(self.tickets.get(ticket, 'pid')):
+                self.tickets.set(ticket, 'backend', 0)
+
+    def _count(self, backend, state, below=PRIORITIES):
+        count = 0
+
+        for ticket in range(self.tickets.rows):
+            if self.tickets.get(ticket, 'backend') == backend + 1 and \
+                    self.tickets.get(ticket, 'state') == state and \
+                    self.tickets.get(ticket, 'priority') < below:
+                count += 1
+
+        return count
+
+    def _ticket(self, backend, priority):
+        for ticket in range(self.tickets.rows):
+            if not self.tickets.get(ticket, 'backend'):
+                self.tickets.set(ticket, 'backend', backend + 1)
+                self.tickets.set(ticket, 'pid', getpid())
+                self.tickets.set(ticket, 'priority', priority)
+                self.tickets.set(ticket, 'state', WAITING)
+                self.tickets.set(ticket, 'started', time())
+                return ticket
+
+        return None
+
+    def _retry_after(self, backend):
+        limit = self.backends.get(backend, 'limit')
+        latency = self.backends.get(backend, 'latency') or 1.0
+        waiting = self._count(backend, WAITING)
+
+        return int(ceil(latency * (waiting + 1) / limit))
+
+    def acquire(self, array, priority, timeout=None):
+        """
+        Blocks until the request may proceed and returns a ticket to release.
+        Raises Overloaded if the queue is full or the wait times out.
+        """
+        deadline = time() + min(self.queue_timeout, self.queue_timeout if timeout is None else timeout)
+
+        with self.condition:
+            self._reap()
+            backend = self._backend(array)
+
+            if self._count(backend, WAITING) >= self.queue_depth:
+                raise Overloaded('Admission queue full for {array}'.format(array=array),
+                                 self._retry_after(backend))
+
+            ticket = self._ticket(backend, priority)
+
+            if ticket is None:
+                raise Overloaded('No admission tickets left', self._retry_after(backend))
+
+            while self._count(backend, RUNNING) >= int(self.backends.get(backend, 'limit')) or \
+                    self._count(backend, WAITING, below=priority):
+                remaining = deadline - time()
+
+                if remaining <= 0:
+                    self.tickets.set(ticket, 'backend', 0)
+                    self.condition.notify_all()
+                    raise Overloaded('Admission timed out for {array}'.format(array=array),
+                                     self._retry_after(backend))
+
+                self.condition.wait(remaining)
+                self._reap()
+
+            self.tickets.set(ticket, 'state', RUNNING)
+            self.tickets.set(ticket, 'started', time())
+
+        return ticket
+
+    def release(self, ticket, elapsed, round_trip=None, failed=False):
+        """
+        Returns the ticket. The limit adapts to round_trip, the mean backend
+        round trip of the request, or elapsed if there were none.
+        """
+        with self.condition:
+            backend = int(self.tickets.get(ticket, 'backend')) - 1
+            self.tickets.set(ticket, 'backend', 0)
+
+            if backend < 0:
+                return
+
+            limit = self.backends.get(backend, 'limit')
+
+            if failed or (elapsed if round_trip is None else round_trip) > self.latency_target:
+                limit = max(self.min_limit, limit / 2)
+            else:
+                limit = min(self.max_limit, limit + 1 / limit)
+
+            self.backends.set(backend, 'limit', limit)
+
+            # smoothed for Retry-After estimates
+            previous = self.backends.get(backend, 'latency') or elapsed
+            self.backends.set(backend, 'latency', previous * 0.8 + elapsed * 0.2)
+
+            self.condition.notify_all()
+
+    def status(self):
+        with self.condition:
+            self._reap()
+            backends = {}
+
+            for row in range(self.backends.rows):
+                key = self.backends.get(row, 'key')
+
+                if key:
+                    backends[self.names.get(key, '{key:08x}'.format(key=int(key)))] = {
+                        'limit': self.backends.get(row, 'limit'),
+                        'latency': self.backends.get(row, 'latency'),
+                        'running': self._count(row, RUNNING),
+                        'waiting': self._count(row, WAITING)
+                    }
+
+            return backends
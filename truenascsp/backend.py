@@ -22,64 +22,185 @@
 # THE SOFTWARE.
 #
 
-from os import environ, getpid
-from time import sleep
+from os import getpid
+from time import sleep, time
+from threading import local
+from http.cookiejar import DefaultCookiePolicy
 import traceback
-import logging
 import json
 import urllib3
 import requests
 import re
+import admission
+import breaker
+import bulkhead
+import locking
+import health
+import metrics
+import tracing
+import logs
+import capture
+import config
+import journal
+import streaming
+import sharedcache
+import index
 from requests.auth import HTTPBasicAuth
 from ipaddress import IPv4Interface, ip_network
 
 urllib3.disable_warnings()
-logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s %(message)s',
-                    datefmt='%a, %d %b %Y %H:%M:%S +0000')
+logger = logs.get_logger(__name__)
+
+api_key = re.compile('^[0-9]+-[a-zA-Z0-9]{64}')
+
+CONFIG = config.CONFIG
+
+CAPTURE = capture.Capture(CONFIG.capture_dir, max_bytes=CONFIG.capture_max_bytes,
+                          backups=CONFIG.capture_backups)
+
+JOURNAL = journal.Journal(CONFIG.journal_dir)
+
+SHARED_CACHE = sharedcache.SharedCache(CONFIG.cache_dir, max_entries=CONFIG.cache_max_entries)
+
+INDEX = index.Index(CONFIG.index_ttl, CONFIG.index_max_entries, store=SHARED_CACHE)
+
+# shared by all workers, must be created before gunicorn forks
+BREAKER = breaker.Breaker(failures=CONFIG.breaker_failures, cooldown=CONFIG.breaker_cooldown)
+
+ADMISSION = admission.Admission(initial_limit=CONFIG.admission_initial_limit,
+                                max_limit=CONFIG.admission_max_limit,
+                                latency_target=CONFIG.admission_latency_target,
+                                queue_depth=CONFIG.admission_queue_depth,
+                                queue_timeout=CONFIG.admission_queue_timeout)
+
+BULKHEAD = bulkhead.Bulkhead(slots=CONFIG.bulkhead_slots)
+
+# keyed by array and object, across replicas unless LOCK_BACKEND is local
+LOCKS = locking.from_config(CONFIG)
+
+HEALTH = health.Health(max_latency=CONFIG.ready_max_latency, probe_after=CONFIG.ready_probe_after,
+        prewarm=CONFIG.prewarm_arrays)
+
+SESSIONS = local()
+
+
+class BackendUnavailable(Exception):
+    pass
+
+
+class DeadlineExceeded(BackendUnavailable):
+    pass
+
+
+def session():
+    """
+    Keep-alive session of the calling thread. Sessions aren't thread-safe
+    and connections can't be shared with forked workers.
+    """
+    if getattr(SESSIONS, 'pid', None) != getpid():
+        SESSIONS.pid = getpid()
+        SESSIONS.session = requests.Session()
+        # requests carry their own credentials, cookies would leak across tokens
+        SESSIONS.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+    return SESSIONS.session
 
 
 class Handler:
+    """
+    Context of one request to a backend. Only per-request state lives in
+    the instance, configuration is shared by all requests and read-only.
+    """
+
+    __slots__ = (
+        'backend',
+        'token',
+        'round_trips',
+        'round_trip_time',
+        'abort',
+        'started',
+        'trace',
+        'deadline',
+        'request_id',
+        'log_payloads',
+        'leases',
+        'logger'
+    )
+
+    backend_schema = CONFIG.backend_schema
+    backend_api = '/api/v2.0/'
+    connect_timeout = CONFIG.connect_timeout
+    read_timeout = CONFIG.read_timeout
+    write_timeout = CONFIG.write_timeout
+    volume_divider = '_'
+    dataset_divider = '/'
+    uri_slash = '%2f'
+    target_basenames = ( 'iqn.2011-08.org.truenas.ctl', 'iqn.2005-10.org.freenas.ctl' )
+    target_portal = CONFIG.target_portal
+    chap_tag = CONFIG.chap_tag
+    backend_retries = 15
+    backend_delay = 1.5
+    access_name = '{dataset_name}'
+    clone_from_pvc_prefix = 'snap-for-clone-'
+
+    # listings are parsed as they arrive, a row longer than max_row_length
+    # characters fails the fetch
+    chunk_size = 64 * 1024
+    max_row_length = 4 * 1024 * 1024
+
+    # the query filters of fetch, checked again on every row returned
+    filter_operators = {
+        '=': lambda found, value: found == value,
+        '!=': lambda found, value: found != value,
+        '^': lambda found, value: isinstance(found, str) and found.startswith(value),
+        '$': lambda found, value: isinstance(found, str) and found.endswith(value)
+    }
+
+    # claim field: ZFS user property, CSI parameter
+    claim_properties = {
+        'pv': ('hpe-csi:pv', 'csi.storage.k8s.io/pv/name'),
+        'pvc': ('hpe-csi:pvc', 'csi.storage.k8s.io/pvc/name'),
+        'namespace': ('hpe-csi:namespace', 'csi.storage.k8s.io/pvc/namespace')
+    }
+    cached_resources = CONFIG.cached_resources
+    indexed_resources = ( 'pool/dataset', 'zfs/' )
+    clone_promotion = CONFIG.clone_promotion
+    dataset_defaults = CONFIG.dataset_defaults
+
+    dataset_mutables = (
+        'size',
+        'description',
+        'deduplication',
+        'compression',
+        'sync',
+        'volblocksize'
+    )
+
+    performance_profiles = CONFIG.performance_profiles
+    profile_properties = config.frozen(config.PROFILE_PROPERTIES)
+
+    profile_immutables = (
+        'volblocksize',
+        'blocksize'
+    )
+
+    profile_unsupported = config.frozen({
+        'LEGACY': [ 'special_small_block_size', 'logbias', 'primarycache', 'secondarycache' ]
+    })
+
     def __init__(self):
-        self.backend_schema = 'https'
-        self.backend_api = '/api/v2.0/'
         self.backend = None
         self.token = None
-        self.pong = None
-        self.req_backend = None
-        self.volume_divider = '_'
-        self.dataset_divider = '/'
-        self.uri_slash = '%2f'
-        self.resp_msg = '100 Continue'
-        self.target_basenames = [ 'iqn.2011-08.org.truenas.ctl', 'iqn.2005-10.org.freenas.ctl' ]
-        self.target_portal = environ.get('DEFAULT_TARGET_PORTAL', 'hpe-csi')
-        self.chap_tag = environ.get('DEFAULT_CHAP_TAG', '4730274')
-        self.backend_retries = 15
-        self.backend_delay = 1.5
-        self.access_name = '{dataset_name}'
-        self.clone_from_pvc_prefix = 'snap-for-clone-'
-
-        self.logger = logging.getLogger('{name} {pid}'.format(name=__name__, pid=getpid()))
-        self.logger.setLevel(logging.DEBUG if environ.get(
-            'LOG_DEBUG') else logging.INFO)
-
-        self.dataset_defaults = {
-            'deduplication': environ.get('DEFAULT_DEDUPLICATION', 'OFF'),
-            'compression': environ.get('DEFAULT_COMPRESSION', 'LZ4'),
-            'sync': environ.get('DEFAULT_SYNC', 'STANDARD'),
-            'sparse': environ.get('DEFAULT_SPARSE', "true"),
-            'root': environ.get('DEFAULT_ROOT', 'tank'),
-            'volblocksize': environ.get('DEFAULT_VOLBLOCKSIZE', '8K'),
-            'description': environ.get('DEFAULT_DESCRIPTION', 'Dataset created by HPE CSI Driver for Kubernetes as {pv} in {namespace} from {pvc}')
-        }
-
-        self.dataset_mutables = [
-            'size',
-            'description',
-            'deduplication',
-            'compression',
-            'sync',
-            'volblocksize'
-        ]
+        self.round_trips = 0
+        self.round_trip_time = 0.0
+        self.abort = None
+        self.started = time()
+        self.trace = tracing.Trace()
+        self.deadline = None
+        self.request_id = self.trace.trace_id
+        self.log_payloads = logs.LOG_DEBUG
+        self.leases = []
+        self.logger = logs.RequestLogger(logger, self)
 
     def _get_auth(self):
         """
@@ -88,9 +209,7 @@ class Handler:
         FreeNAS <v12 that does NOT support API Keys.
         """
 
-        p = re.compile('^[0-9]+-[a-zA-Z0-9]{64}')
-
-        if p.match(self.token):
+        if api_key.match(self.token):
             self.logger.debug("API Key detected. Will use token authentication.")
             return {
                 'Authorization': 'Bearer {token}'.format(token=self.token)
@@ -102,7 +221,10 @@ class Handler:
     def ping(self, req):
         content = req.media
 
-        self.pong = self.fetch('core/ping')
+        pong = self.fetch('core/ping')
+
+        if not self.log_payloads:
+            return pong
 
         self.logger.debug('HPE CSI Request <==============================>')
         self.logger.debug('         uri: %s', req.uri)
@@ -113,6 +235,8 @@ class Handler:
         headers = json.dumps(req.headers).replace(self.token, "*****")
         self.logger.debug('     headers: %s', headers)
 
+        return pong
+
     def ipaddrs_to_networks(self, ipaddrs):
         interfaces = self.fetch('interface', returnBy=list)
 
@@ -166,7 +290,31 @@ class Handler:
         return False
 
 
+    def auth_current(self, chap_user, chap_password):
+        auth = self.fetch('iscsi/auth', field='tag', value=int(self.chap_tag), returnBy=dict)
+
+        if auth and auth.get('user') == chap_user and auth.get('secret') == chap_password:
+            return auth
+
+        return None
+
     def apply_auths(self, chap_user, chap_password):
+        auth = self.auth_current(chap_user, chap_password)
+
+        if auth:
+            self.logger.info('CHAP found: %s', self.chap_tag)
+            return auth
+
+        # hosts share the CHAP credentials
+        lock = LOCKS.get(self.backend, 'auth/{tag}'.format(tag=self.chap_tag))
+        self.hold(lock, 'auth')
+
+        try:
+            return self._apply_auths(chap_user, chap_password)
+        finally:
+            self.release(lock)
+
+    def _apply_auths(self, chap_user, chap_password):
         # check if auths already exist
         auth = self.fetch('iscsi/auth', field='tag', value=int(self.chap_tag), returnBy=dict)
 
@@ -180,8 +328,10 @@ class Handler:
                         'user': chap_user,
                         'secret': chap_password
                         }
-                self.put('iscsi/auth/id/{aid}'.format(aid=auth.get('id')), req_backend)
+                response = self.put('iscsi/auth/id/{aid}'.format(aid=auth.get('id')), req_backend)
                 self.logger.info('CHAP updated: %s', self.chap_tag)
+            else:
+                return auth
         else:
             # if not, create it
             req_backend = {
@@ -189,17 +339,62 @@ class Handler:
                 'user': chap_user,
                 'secret': chap_password
                 }
-            self.post('iscsi/auth', req_backend)
+            response = self.post('iscsi/auth', req_backend)
             self.logger.info('CHAP created: %s', self.chap_tag)
 
-        return self.req_backend.json()
+        return self.payload(response)
+
+
+    def initiator_request(self, name, content, current_initiator, system_version):
+        req_backend = {
+            'comment': name,
+            'initiators': content.get('iqns') if content else [],
+        }
+
+        # CORE and FreeNAS
+        if system_version == "CORE" or system_version == "LEGACY":
+            if current_initiator:
+                req_backend['auth_network'] = self.cidrs_to_hosts(current_initiator.get('auth_network'))
+            elif content:
+                req_backend['auth_network'] = self.cidrs_to_hosts(content.get('networks'))
+
+        return req_backend
+
+    def initiator_changed(self, current_initiator, req_backend):
+        for field, value in req_backend.items():
+            current = current_initiator.get(field)
+
+            if isinstance(value, list):
+                if sorted(value) != sorted(current or []):
+                    return True
+            elif value != current:
+                return True
+
+        return False
+
+    def registered_initiator(self, name, content):
+        """
+        Returns the initiator of name if it and the CHAP credentials are as
+        content asks already, None if anything is left to apply.
+        """
+        chap_user = content.get('chap_user')
+        chap_password = content.get('chap_password')
+
+        if chap_user and chap_password and not self.auth_current(chap_user, chap_password):
+            return None
 
+        current_initiator = self.fetch('iscsi/initiator', field='comment',
+                            value=name, returnBy=dict)
+
+        if not current_initiator or self.initiator_changed(current_initiator,
+                self.initiator_request(name, content, current_initiator, self.version())):
+            return None
+
+        return current_initiator
 
     def apply_initiator(self, name, **kwargs):
 
         content = {}
-        iqns = []
-        req_backend = {}
 
         # content exist when creating a new host initiator
         if kwargs.get('content'):
@@ -214,35 +409,21 @@ class Handler:
         current_initiator = self.fetch('iscsi/initiator', field='comment',
                             value=name, returnBy=dict)
 
-        # CORE and FreeNAS
-        system_version = self.version()
-
-        if content:
-            req_backend = {
-                'comment': name,
-                'initiators': content.get('iqns'),
-            }
-
-            if system_version == "CORE" or system_version == "LEGACY":
-                req_backend['auth_network'] = self.cidrs_to_hosts(content.get('networks'))
-
-        else:
-            req_backend = {
-                'comment': name,
-                'initiators': iqns,
-            }
+        req_backend = self.initiator_request(name, content, current_initiator, self.version())
 
         if current_initiator:
-            if system_version == "CORE" or system_version == "LEGACY":
-                req_backend['auth_network'] = self.cidrs_to_hosts(current_initiator.get('auth_network'))
-            self.put(
+            if not self.initiator_changed(current_initiator, req_backend):
+                self.logger.info('Initiator unchanged: %s', name)
+                return current_initiator
+
+            response = self.put(
                 'iscsi/initiator/id/{id}'.format(id=current_initiator.get('id')), req_backend)
             self.logger.info('Initiator updated: %s', name)
         else:
-            self.post('iscsi/initiator', req_backend)
+            response = self.post('iscsi/initiator', req_backend)
             self.logger.info('Initiator created: %s', name)
 
-        return self.req_backend.json()
+        return self.payload(response)
 
 
     def xslt_volume_id_to_name(self, csi):
@@ -281,6 +462,80 @@ class Handler:
 
         return {}
 
+    def performance_profile(self, name, system_version):
+        if not name:
+            return {}
+
+        profile = self.performance_profiles.get(name)
+
+        if profile is None:
+            raise ValueError('Unknown performance profile "{name}", use {names}'.format(name=name,
+                    names=' or '.join(self.performance_profiles)))
+
+        for key in profile:
+            if key in self.profile_unsupported.get(system_version, ()):
+                raise ValueError('Performance profile "{name}" has property "{key}" not supported on {version}'.format(
+                        name=name, key=key, version=system_version))
+
+        return profile
+
+    def profile_subset(self, profile, resource, **kwargs):
+        subset = {}
+
+        for key, value in profile.items():
+            if self.profile_properties.get(key) != resource:
+                continue
+
+            if kwargs.get('mutable') and key in self.profile_immutables:
+                self.logger.info('Immutable property "%s" from performance profile skipped', key)
+                continue
+
+            subset[key] = value
+
+        return subset
+
+    def apply_profile(self, dataset_id, profile, **kwargs):
+        """
+        Returns what TrueNAS said about the first update it refused, None once applied.
+        """
+        updates = []
+
+        # clones inherit pool/dataset properties from their origin
+        if kwargs.get('clone'):
+            req_backend = self.profile_subset(profile, 'pool/dataset', mutable=True)
+
+            if req_backend:
+                updates.append((self.uri_id('pool/dataset', dataset_id), req_backend))
+
+        # properties not exposed by pool/dataset
+        properties = self.profile_subset(profile, 'zfs/dataset')
+
+        if properties:
+            req_backend = {
+                'properties': {key: {'value': str(value).lower()} for key, value in properties.items()}
+            }
+            updates.append((self.uri_id('zfs/dataset', dataset_id), req_backend))
+
+        # new extents are created with the profile, existing ones need an update
+        extent = kwargs.get('extent')
+
+        if extent:
+            req_backend = self.profile_subset(profile, 'iscsi/extent', mutable=True)
+
+            if req_backend:
+                updates.append(('iscsi/extent/id/{eid}'.format(eid=extent.get('id')), req_backend))
+
+        for uri, req_backend in updates:
+            response = self.put(uri, req_backend)
+
+            if response is None or response.status_code != 200:
+                self.logger.error('Performance profile not applied to %s: %s', dataset_id, self.returned(response))
+                metrics.PROFILE_FAILED.labels(self.backend, metrics.resource_id.sub('', uri)).inc()
+
+                return self.returned(response)
+
+        self.logger.debug('Performance profile applied to %s: %s', dataset_id, profile)
+
     def discovery_ips(self):
 
         # grab portal IPs
@@ -318,8 +573,135 @@ class Handler:
 
         return {}
 
+    def root_capacity(self, root):
+        properties = [ 'id', 'type', 'pool', 'used', 'available', 'volsize', 'refreservation' ]
+
+        parent = self.fetch('pool/dataset', field='id', value=root,
+                select=properties, returnBy=dict)
+
+        if not parent:
+            return None
+
+        zvols = self.fetch('pool/dataset', field='id', value='{root}/'.format(root=root),
+                operator='^', select=properties, returnBy=list)
+
+        available = int(parent.get('available').get('rawvalue'))
+
+        thick = { 'volumes': 0, 'provisioned_bytes': 0, 'reserved_bytes': 0 }
+        sparse = { 'volumes': 0, 'provisioned_bytes': 0, 'used_bytes': 0 }
+
+        for zvol in zvols:
+            if zvol.get('type') != 'VOLUME':
+                continue
+
+            volsize = int(zvol.get('volsize').get('rawvalue'))
+            refreservation = int(zvol.get('refreservation').get('rawvalue'))
+
+            # sparse zvols don't reserve anything up front
+            if refreservation:
+                thick['volumes'] += 1
+                thick['provisioned_bytes'] += volsize
+                thick['reserved_bytes'] += refreservation
+            else:
+                sparse['volumes'] += 1
+                sparse['provisioned_bytes'] += volsize
+                sparse['used_bytes'] += int(zvol.get('used').get('rawvalue'))
+
+        # thick zvols have their space withheld from available already
+        thick['capacity_bytes'] = available
+
+        # sparse zvols may still grow into what they've been promised
+        sparse['capacity_bytes'] = max(available - max(sparse.get('provisioned_bytes') -
+                sparse.get('used_bytes'), 0), 0)
+
+        capacity = {
+            'root': root,
+            'pool': parent.get('pool'),
+            'available_bytes': available,
+            'used_bytes': int(parent.get('used').get('rawvalue')),
+            'provisioned_bytes': thick.get('provisioned_bytes') + sparse.get('provisioned_bytes'),
+            'thick': thick,
+            'sparse': sparse
+        }
+
+        self.logger.debug('Capacity of %s: %s', root, capacity)
+
+        return capacity
+
+    def claim_user_properties(self, config):
+        """
+        ZFS user properties recording the claim a zvol was created for.
+        """
+        return [ { 'key': key, 'value': config.get(parameter) }
+                 for key, parameter in self.claim_properties.values() if config.get(parameter) ]
+
+    def dataset_claim(self, dataset):
+        user_properties = dataset.get('user_properties') or {}
+        claim = { field: user_properties.get(key).get('value')
+                  for field, (key, _) in self.claim_properties.items() if key in user_properties }
+
+        # zvols created before the user properties, or on FreeNAS
+        return claim or self.description_to_claim(dataset.get('comments', {}).get('value'))
+
+    def description_to_claim(self, description):
+        # reverse the default description template to find the claim behind a zvol
+        pattern = re.escape(self.dataset_defaults.get('description'))
+
+        for field in ('pv', 'pvc', 'namespace'):
+            pattern = pattern.replace(re.escape('{{{field}}}'.format(field=field)),
+                    '(?P<{field}>[^ ]+)'.format(field=field), 1)
+
+        claim = re.match('^{pattern}$'.format(pattern=pattern), description or '')
+
+        if claim:
+            return claim.groupdict()
+
+        return {}
+
+    def root_statistics(self, root):
+        properties = [ 'id', 'type', 'comments', 'user_properties', 'volsize', 'used', 'referenced',
+                       'logicalused', 'usedbysnapshots', 'compressratio' ]
+
+        zvols = self.fetch('pool/dataset', field='id', value='{root}/'.format(root=root),
+                operator='^', select=properties, returnBy=list)
+
+        volumes = []
+
+        for zvol in zvols:
+            if zvol.get('type') != 'VOLUME':
+                continue
+
+            claim = self.dataset_claim(zvol)
+
+            volumes.append({
+                'id': self.xslt_dataset_to_volume(zvol.get('id')),
+                'name': self.xlst_name_from_id(zvol.get('id')),
+                'pv': claim.get('pv', ''),
+                'pvc': claim.get('pvc', ''),
+                'namespace': claim.get('namespace', ''),
+                'size': int(zvol.get('volsize').get('rawvalue')),
+                'used_bytes': int(zvol.get('used').get('rawvalue')),
+                'referenced_bytes': int(zvol.get('referenced').get('rawvalue')),
+                'logical_used_bytes': int(zvol.get('logicalused').get('rawvalue')),
+                'snapshot_used_bytes': int(zvol.get('usedbysnapshots').get('rawvalue')),
+                'compression_ratio': float(zvol.get('compressratio').get('rawvalue'))
+            })
+
+        self.logger.debug('Statistics of %s: %d volumes', root, len(volumes))
+
+        return {
+            'root': root,
+            'volumes': volumes
+        }
+
     # pool/dataset, field=name, value=foo, attr=rawvalue
     def fetch(self, resource, **kwargs):
+        """
+        Rows of resource matching field and value, at most limit of them.
+        A single row is asked for when returnBy is dict. Rows are parsed and
+        filtered as they arrive, only the matching ones are held. None if
+        the listing couldn't be read whole.
+        """
         results = []
         options = {}
         query = {}
@@ -329,13 +711,25 @@ class Handler:
         field = kwargs.get('field')
         value = kwargs.get('value')
         extras = kwargs.get('extras')
+        select = kwargs.get('select')
+        limit = kwargs.get('limit')
         returnBy = kwargs.get('returnBy')
 
         if extras:
             options = { "extra": extras }
 
+        if select:
+            options['select'] = select
+
         if field and value:
             filters.append([ field, operator, value ])
+            self.logger.debug('Looking for field=%s and value=%s', field, value)
+
+            if returnBy == dict:
+                limit = 1
+
+        if limit:
+            options['limit'] = limit
 
         if filters or options:
             query = {
@@ -345,36 +739,96 @@ class Handler:
 
         self.logger.debug('Composed query: %s', query)
 
+        ttl = self.cached_resources.get(resource)
+
+        if ttl:
+            key = json.dumps([ query, attr, returnBy == dict ], sort_keys=True)
+            cached = SHARED_CACHE.get(self.backend, resource, key, ttl)
+
+            if cached:
+                metrics.CACHE_REQUESTS.labels(resource, 'hit').inc()
+                return self.shape(cached[0], returnBy)
+
+            metrics.CACHE_REQUESTS.labels(resource, 'miss').inc()
+            generation = SHARED_CACHE.generation(self.backend, resource)
+
+        response = None
+
         try:
-            self.get(resource, query)
+            response = self.get(resource, query, stream=True)
 
-            if self.req_backend.status_code != 200:  # FIXME
-                self.logger.debug('TrueNAS GET Request through fetch: %s', self.req_backend.status_code)
+            if response is None or response.status_code != 200:  # FIXME
+                self.logger.debug('TrueNAS GET Request through fetch: %s', self.status(response))
                 return None
 
-            rset = self.req_backend.json()
-
-            if not isinstance(rset, list):
-                rset = [ rset ]
+            rset = streaming.items(response.iter_content(self.chunk_size), self.max_row_length)
+            matches = self.filter_operators.get(operator) if field and value else None
 
             for item in rset:
-                if field and value:
-                    self.logger.debug('Looking for field={field} and value={value}'.format(field=field,
-                            value=value))
-                    if attr:
-                        value = item.get(field).get(attr)
-                    else:
-                        self.logger.debug('Nope %s', item)
-                        value = item.get(field)
+                # rows selected without the field are taken on trust
+                if matches and field.split('.')[0] in item and \
+                        not matches(self.field_value(item, field, attr), value):
+                    continue
 
-                    if not isinstance(value, str) and hasattr(value, 'match'):
-                        if not value.match(value):
-                            continue
                 results.append(item)
+
+                if limit and len(results) >= limit:
+                    break
+
+            if ttl:
+                SHARED_CACHE.set(self.backend, resource, key, results, generation)
+        except BackendUnavailable:
+            raise
         except Exception:
             self.csp_error('Backend Request (GET) Exception',
                            traceback.format_exc())
 
+            # a listing cut short isn't the listing
+            return None
+        finally:
+            if response is not None:
+                response.close()
+
+        return self.shape(results, returnBy)
+
+    def field_value(self, item, field, attr=None):
+        for key in field.split('.') + ([ attr ] if attr else []):
+            item = item.get(key) if isinstance(item, dict) else None
+
+        return item
+
+    def lookup(self, resource, field, value, returnBy=None, extras=None):
+        """
+        fetch through the index for datasets and snapshots by id and
+        snapshots by snapshot name or parent dataset.
+        """
+        holds = bool(extras and extras.get('holds'))
+        # names of datasets and snapshots are their ids
+        by_id = field in ('id', 'name')
+
+        if by_id:
+            item = INDEX.get(self.backend, resource, value, holds)
+            results = [ item ] if item else None
+        else:
+            results = INDEX.query(self.backend, resource, field, value, holds)
+
+        if results is not None:
+            metrics.CACHE_REQUESTS.labels('index', 'hit').inc()
+            return self.shape(results, returnBy)
+
+        metrics.CACHE_REQUESTS.labels('index', 'miss').inc()
+        generation = INDEX.generation(self.backend)
+        results = self.fetch(resource, field=field, value=value, extras=extras, returnBy=list)
+
+        if results is None:
+            return None
+
+        INDEX.put(self.backend, resource, results, generation, holds=holds,
+                  field=None if by_id else field, value=value)
+
+        return self.shape(results, returnBy)
+
+    def shape(self, results, returnBy):
         if len(results) == 1:
             self.logger.debug('API fetch caught 1 item')
 
@@ -401,7 +855,7 @@ class Handler:
         return results
 
     def uri_id(self, resource, rid):
-        if resource in ('zfs/snapshot', 'pool/dataset'):
+        if resource in ('zfs/snapshot', 'pool/dataset', 'zfs/dataset'):
             uri = '{resource}/id/{rid}'.format(resource=resource,
                                                rid=rid.replace(self.dataset_divider, self.uri_slash))
         else:
@@ -409,67 +863,239 @@ class Handler:
                                                rid=rid)
         return uri
 
-    def get(self, uri, query={}):
+    def remaining(self):
+        if self.deadline is None:
+            return None
+
+        return self.deadline - time()
+
+    def check_deadline(self):
+        """
+        Raises DeadlineExceeded once the caller has given up on the request.
+        """
+        remaining = self.remaining()
+
+        if remaining is not None and remaining <= 0:
+            self.abort = ('504 Gateway Timeout',
+                          'Deadline exceeded {seconds:.1f}s into the request, backend work skipped'.format(
+                              seconds=time() - self.started), 1)
+            raise DeadlineExceeded(self.abort[1])
+
+    def hold(self, lock, name):
+        """
+        Waits for lock until the deadline, writes are refused once it's lost.
+        """
+        if not metrics.acquire(lock, name, deadline=self.deadline):
+            self.abort = ('504 Gateway Timeout',
+                          'Deadline exceeded {seconds:.1f}s into the request waiting for lock {name}'.format(
+                              seconds=time() - self.started, name=lock.name), 1)
+            raise DeadlineExceeded(self.abort[1])
+
+        self.leases.append(lock)
+        self.logger.debug('Lock %s held with token %s', lock.name, lock.token)
+
+    def release(self, lock):
+        """
+        Releases lock, unless hold never got it.
+        """
+        if lock not in self.leases:
+            return
+
+        self.leases.remove(lock)
+        lock.release()
+
+    def check_leases(self):
+        for lease in self.leases:
+            try:
+                lease.check()
+            except locking.Lost as e:
+                self.abort = ('503 Service Unavailable', str(e), 1)
+                raise BackendUnavailable(self.abort[1])
+
+    def sleep(self, seconds, loop='backend'):
+        self.check_deadline()
+        remaining = self.remaining()
+        seconds = seconds if remaining is None else min(seconds, remaining)
+
+        metrics.SLEEPS.labels(loop).inc()
+        metrics.SLEEP_SECONDS.labels(loop).inc(seconds)
+
+        with self.trace.span('sleep', loop=loop):
+            sleep(seconds)
+
+        self.check_deadline()
+
+    def request(self, method, uri, stream=False, **kwargs):
+        """
+        Sends all backend requests and returns the response. Fails fast with
+        BackendUnavailable if the circuit for the backend is open. With stream
+        the body is left to be read by the caller, captures need it whole.
+        """
+        stream = stream and not CAPTURE.enabled
+
+        if not BREAKER.allow(self.backend):
+            self.abort = ('503 Service Unavailable',
+                          'Circuit open for {backend}, backend requests are failing'.format(backend=self.backend),
+                          BREAKER.retry_after(self.backend))
+            raise BackendUnavailable(self.abort[1])
+
+        self.check_deadline()
+
+        if method != 'GET':
+            self.check_leases()
+
         auth = self._get_auth()
+
+        if type(auth) == HTTPBasicAuth:
+            kwargs['auth'] = auth
+        else:
+            kwargs['headers'] = dict(kwargs.get('headers', {}), **auth)
+
+        # reads and writes are allowed different amounts of time
+        timeout = [ self.connect_timeout, self.read_timeout if method == 'GET' else self.write_timeout ]
+        remaining = self.remaining()
+
+        if remaining is not None:
+            timeout = [ min(seconds, remaining) for seconds in timeout ]
+
+        resource = metrics.backend_resource(uri)
+        started = time()
+
+        with self.trace.span('{method} {resource}'.format(method=method, resource=resource),
+                resource=resource, verb=method, uri=uri) as span:
+            try:
+                response = session().request(method, self.url_tmpl(uri), verify=False,
+                        timeout=tuple(timeout), stream=stream, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                BREAKER.failure(self.backend)
+                HEALTH.record(self.backend, time() - started, ok=False)
+                metrics.BACKEND_REQUESTS.labels(self.backend, resource, method, 'error').inc()
+
+                if CAPTURE.enabled:
+                    CAPTURE.backend(self, method, uri, kwargs, None, started, time() - started)
+                raise
+            finally:
+                elapsed = time() - started
+                self.round_trips += 1
+
+                # every worker sees the write before the next lookup of the resource
+                if method != 'GET':
+                    SHARED_CACHE.invalidate(self.backend, resource)
+
+                    if resource.startswith(self.indexed_resources):
+                        SHARED_CACHE.invalidate(self.backend, 'zfs')
+                        INDEX.invalidate(self.backend)
+
+                self.round_trip_time += elapsed
+                metrics.BACKEND_DURATION.labels(self.backend, resource, method).observe(elapsed)
+
+            span['attributes'].update({
+                'status': response.status_code,
+                'bytes': int(response.headers.get('Content-Length', 0)) if stream else
+                         len(response.content)
+            })
+
+        metrics.BACKEND_REQUESTS.labels(self.backend, resource, method,
+                str(response.status_code)).inc()
+
+        if CAPTURE.enabled:
+            CAPTURE.backend(self, method, uri, kwargs, response, started, elapsed)
+
+        if response.status_code in (502, 503, 504):
+            BREAKER.failure(self.backend)
+            HEALTH.record(self.backend, elapsed, ok=False)
+        else:
+            BREAKER.success(self.backend)
+            HEALTH.record(self.backend, elapsed)
+
+        return response
+
+    def status(self, response):
+        """
+        Status line of a response from get, post, put or delete.
+        """
+        if response is None:
+            return '502 Bad Gateway'
+
+        return '{code} {reason}'.format(code=str(response.status_code), reason=response.reason)
+
+    def payload(self, response):
+        """
+        Decoded body of a response from post or put, empty without one.
+        """
+        if response is None:
+            return {}
+
+        return response.json()
+
+    def returned(self, response):
+        if response is None:
+            return 'TrueNAS API did not respond'
+
+        return 'TrueNAS API returned: {content}'.format(content=response.content.decode('utf-8'))
+
+    def get(self, uri, query={}, stream=False):
+        """
+        The methods below return the response, or None if it never arrived.
+        """
+        response = None
+
         try:
             self.logger.debug('TrueNAS GET request URI: %s', uri)
-            if type(auth) == HTTPBasicAuth:
-                self.req_backend = requests.get(self.url_tmpl(uri),
-                                    auth=auth, verify=False, json=query)
-            else:
-                self.req_backend = requests.get(self.url_tmpl(uri),
-                                    headers=auth, verify=False, json=query)
-            self.logger.debug('TrueNAS response: %s', self.req_backend.text)
-            self.resp_msg = '{code} {reason}'.format(
-                code=str(self.req_backend.status_code), reason=self.req_backend.reason)
-            self.req_backend.raise_for_status()
+            response = self.request('GET', uri, json=query, stream=stream)
+            if self.log_payloads and not stream:
+                self.logger.debug('TrueNAS response: %s', response.text)
+            response.raise_for_status()
+        except BackendUnavailable:
+            raise
         except Exception:
             self.csp_error('Backend Request (GET) Exception',
                            traceback.format_exc())
 
+        return response
+
     def post(self, uri, content):
-        auth = self._get_auth()
+        response = None
+
         try:
             self.logger.debug('TrueNAS POST request URI: %s', uri)
-            self.logger.debug('TrueNAS request: %s', content)
-            if type(auth) == HTTPBasicAuth:
-                self.req_backend = requests.post(self.url_tmpl(uri),
-                                    auth=auth, json=content, verify=False)
-            else:
-                self.req_backend = requests.post(self.url_tmpl(uri),
-                                    headers=auth, json=content, verify=False)
-            self.logger.debug('TrueNAS response: %s', self.req_backend.json())
-            self.resp_msg = '{code} {reason}'.format(
-                code=str(self.req_backend.status_code), reason=self.req_backend.reason)
-            self.req_backend.raise_for_status()
+            if self.log_payloads:
+                self.logger.debug('TrueNAS request: %s', content)
+            response = self.request('POST', uri, json=content)
+            if self.log_payloads:
+                self.logger.debug('TrueNAS response: %s', response.text)
+            response.raise_for_status()
+        except BackendUnavailable:
+            raise
         except Exception:
-            self.csp_error('Backend Request (POST) Exception: {msg}'.format(msg=self.resp_msg),
+            self.csp_error('Backend Request (POST) Exception: {msg}'.format(msg=self.status(response)),
                            traceback.format_exc())
 
+        return response
 
     def put(self, uri, content):
-        auth = self._get_auth()
+        response = None
+
         try:
             self.logger.debug('TrueNAS PUT request URI: %s', uri)
-            self.logger.debug('TrueNAS request: %s', content)
-            if type(auth) == HTTPBasicAuth:
-                self.req_backend = requests.put(self.url_tmpl(uri),
-                                    auth=auth, json=content, verify=False)
-            else:
-                self.req_backend = requests.put(self.url_tmpl(uri),
-                                    headers=auth, json=content, verify=False)
-            self.logger.debug('TrueNAS response: %s', self.req_backend.json())
-            self.resp_msg = '{code} {reason}'.format(
-                code=str(self.req_backend.status_code), reason=self.req_backend.reason)
-            self.req_backend.raise_for_status()
+            if self.log_payloads:
+                self.logger.debug('TrueNAS request: %s', content)
+            response = self.request('PUT', uri, json=content)
+            if self.log_payloads:
+                self.logger.debug('TrueNAS response: %s', response.text)
+            response.raise_for_status()
+        except BackendUnavailable:
+            raise
         except Exception:
-            self.csp_error('Backend Request (PUT) Exception: {msg}'.format(msg=self.resp_msg),
+            self.csp_error('Backend Request (PUT) Exception: {msg}'.format(msg=self.status(response)),
                            traceback.format_exc())
 
+        return response
 
     def delete(self, uri, **kwargs):
         headers = { 'Content-Type': 'application/json' }
-        auth = self._get_auth()
+        response = None
+
         try:
             self.logger.debug('TrueNAS DELETE request URI: %s', uri)
             body = kwargs.get('body') if kwargs.get('body') else None
@@ -479,25 +1105,22 @@ class Handler:
             exist = self.fetch(uri)
 
             if not exist:
-                self.logger.info('{msg} {uri}'.format(msg=self.resp_msg, uri=uri))
-                return
+                self.logger.info('Not found %s', uri)
+                return None
 
-            if type(auth) == HTTPBasicAuth:
-                self.req_backend = requests.delete(self.url_tmpl(uri),
-                                    data=body, auth=auth, headers=headers, verify=False)
-            else:
-                auth.update(headers)
-                self.req_backend = requests.delete(self.url_tmpl(uri),
-                                    data=body, headers=auth, verify=False)
-            self.resp_msg = '{code} {reason}'.format(
-                code=str(self.req_backend.status_code), reason=self.req_backend.reason)
-            self.logger.debug('TrueNAS response code: %s', self.req_backend.status_code)
-            self.logger.debug('TrueNAS response msg: %s', self.req_backend.content.decode('utf-8'))
-            self.req_backend.raise_for_status()
+            response = self.request('DELETE', uri, data=body, headers=headers)
+            self.logger.debug('TrueNAS response code: %s', response.status_code)
+            if self.log_payloads:
+                self.logger.debug('TrueNAS response msg: %s', response.text)
+            response.raise_for_status()
+        except BackendUnavailable:
+            raise
         except Exception:
-            self.csp_error('Backend Request (DELETE) Exception: {msg}'.format(msg=self.resp_msg),
+            self.csp_error('Backend Request (DELETE) Exception: {msg}'.format(msg=self.status(response)),
                            traceback.format_exc())
-        sleep(self.backend_delay) #FIXME
+        self.sleep(self.backend_delay, 'delete') #FIXME
+
+        return response
 
 
     def get_target(self, access_name, **kwargs):
@@ -522,6 +1145,53 @@ class Handler:
         return results
 
 
+    def resume(self, entry, resource):
+        """
+        The object an interrupted attempt recorded for resource, if it's still there.
+        """
+        backend_id = entry.get(resource)
+
+        if backend_id is None:
+            return None
+
+        found = self.fetch('{resource}/id/{id}'.format(resource=resource,
+                           id=str(backend_id).replace(self.dataset_divider, self.uri_slash)))
+
+        if found:
+            self.logger.info('Resuming with %s %s', resource, backend_id)
+
+        return found
+
+    def zvol_exists(self, name):
+        """
+        Whether a zvol of the name exists, in doubt it does.
+        """
+        zvols = self.fetch('pool/dataset', field='name', operator='$',
+                           value='/{name}'.format(name=name), select=[ 'id' ])
+
+        return zvols is None or bool(zvols)
+
+    def rollback(self, entry):
+        """
+        Deletes what an abandoned operation created, newest first, unless
+        the zvol exists and the objects are its own. Datasets are left
+        alone, the CSI driver may have found them by name. Callers hold the
+        lock of the volume.
+        """
+        if self.zvol_exists(entry.content.get('name')):
+            self.logger.info('Abandoned %s of %s kept, the zvol exists', entry.content.get('operation'),
+                             entry.content.get('name'))
+            entry.done()
+            return False
+
+        for resource in [ 'iscsi/targetextent', 'iscsi/extent', 'iscsi/target' ]:
+            if entry.created(resource):
+                self.delete('{resource}/id/{id}'.format(resource=resource, id=entry.get(resource)))
+
+        entry.done()
+
+        return True
+
     def create_target(self, dataset, **kwargs):
         # content will only be available at provisioning
         content = kwargs.get('content', {})
@@ -558,22 +1228,29 @@ class Handler:
                     req_backend['auth_networks'] = self.ipaddrs_to_networks(discovery_ips)
                     self.logger.debug('Using discovery auth_networks: %s', req_backend['auth_networks'])
 
-            target = self.fetch('iscsi/target', field='name', value=access_name)
+            # an interrupted attempt left its progress behind
+            entry = JOURNAL.begin(self.backend, 'target', access_name)
+            target = self.resume(entry, 'iscsi/target')
+
+            if not target:
+                target = self.fetch('iscsi/target', field='name', value=access_name)
+
+                if target:
+                    entry.record('iscsi/target', target.get('id'), created=False)
 
             if not target:
                 target_created = self.backend_retries
 
                 while target_created:
-                    self.post('iscsi/target', req_backend)
-                    target = self.req_backend.json()
+                    target = self.payload(self.post('iscsi/target', req_backend))
                     if target.get('id'):
                         self.logger.debug('Target created: %s', access_name)
+                        entry.record('iscsi/target', target.get('id'))
                         break
                     else:
-                        self.logger.debug('Target debug: %s',
-                                self.req_backend.json())
+                        self.logger.debug('Target debug: %s', target)
 
-                    sleep(self.backend_delay)
+                    self.sleep(self.backend_delay, 'target_create')
                     target_created -= 1
 
             # add extent to dataset
@@ -584,9 +1261,21 @@ class Handler:
                 'disk': 'zvol/{dataset_id}'.format(dataset_id=dataset_id)
             }
 
-            self.post('iscsi/extent', req_backend)
-            extent = self.req_backend.json()
-            self.logger.debug('Extent created: %s', extent)
+            profile = self.performance_profile(config.get('performance_profile'), system_version)
+            req_backend.update(self.profile_subset(profile, 'iscsi/extent'))
+
+            extent = self.resume(entry, 'iscsi/extent')
+
+            if not extent:
+                extent = self.payload(self.post('iscsi/extent', req_backend))
+
+                if isinstance(extent, dict) and extent.get('id'):
+                    self.logger.debug('Extent created: %s', extent)
+                    entry.record('iscsi/extent', extent.get('id'))
+                else:
+                    # created by an attempt that died before recording it
+                    extent = self.fetch('iscsi/extent', field='name', value=access_name, returnBy=dict)
+                    self.logger.debug('Existing extent: %s', extent)
 
             # add target to extent
             req_backend = {
@@ -595,9 +1284,14 @@ class Handler:
                 'lunid': 0
             }
 
-            self.post('iscsi/targetextent', req_backend)
-            targetextent = self.req_backend.json()
-            self.logger.debug('Target Extent created: %s', targetextent)
+            targetextent = self.resume(entry, 'iscsi/targetextent')
+
+            if not targetextent:
+                targetextent = self.payload(self.post('iscsi/targetextent', req_backend))
+                self.logger.debug('Target Extent created: %s', targetextent)
+
+                if isinstance(targetextent, dict) and targetextent.get('id'):
+                    entry.record('iscsi/targetextent', targetextent.get('id'))
 
             results = {
                         'target': target,
@@ -605,8 +1299,12 @@ class Handler:
                         'targetextent': targetextent
                       }
 
+            entry.done()
+
             return results
 
+        except BackendUnavailable:
+            raise
         except Exception:
             self.csp_error('Exception', traceback.format_exc())
             return {}
@@ -667,8 +1365,8 @@ class Handler:
                     + initiator.get('auth_network')))
                 req_backend['auth_network'] = networks
 
-            self.put('iscsi/initiator/id/{id}'.format(id=initiator.get('id')), req_backend)
-            publish['initiator'] = self.req_backend.json()
+            publish['initiator'] = self.payload(
+                self.put('iscsi/initiator/id/{id}'.format(id=initiator.get('id')), req_backend))
 
             # need portal
             publish['portal'] = self.fetch('iscsi/portal', field='comment',
@@ -700,8 +1398,8 @@ class Handler:
 
             if target_id:
                 # update target groups
-                self.put('iscsi/target/id/{tid}'.format(tid=target_id), req_backend)
-                publish['target']['target'] = self.req_backend.json()
+                publish['target']['target'] = self.payload(
+                    self.put('iscsi/target/id/{tid}'.format(tid=target_id), req_backend))
             else:
                 publish = {}
 
@@ -718,6 +1416,76 @@ class Handler:
 
         return res
 
+    def find_snapshot(self, snapshot_id, **kwargs):
+        """
+        Looks up a snapshot by CSI ID. A promoted clone takes the snapshots
+        of its origin along under their names, the CSI ID keeps the origin.
+        Without clone promotion snapshots stay where they are.
+        """
+        snapshot_id = self.xslt_id_to_dataset(snapshot_id)
+        snapshot = self.lookup('zfs/snapshot', field='id', value=snapshot_id, returnBy=dict, **kwargs)
+
+        if snapshot:
+            return snapshot
+
+        if not self.clone_promotion:
+            return {}
+
+        dataset, _, snapshot_name = snapshot_id.partition('@')
+
+        if not snapshot_name:
+            return {}
+
+        for moved in self.lookup('zfs/snapshot', field='snapshot_name', value=snapshot_name,
+                                 returnBy=list, **kwargs) or []:
+            if moved.get('pool') == dataset.split(self.dataset_divider)[0]:
+                self.logger.info('Snapshot %s moved to %s', snapshot_id, moved.get('id'))
+                return moved
+
+        return {}
+
+    def promote_clone(self, dataset):
+        """
+        Promotes the newest clone of the latest snapshot of dataset with
+        clones, by createtxg. The older snapshots move along, dataset
+        becomes a clone itself and may be destroyed. Raises ValueError when
+        clones depend on more than one snapshot, which clone should own
+        them is left to the user.
+        """
+        clones = self.fetch('pool/dataset', field='origin.value',
+                value='{name}@'.format(name=dataset.get('id')), operator='^', returnBy=list)
+
+        if not clones:
+            return None
+
+        snapshots = self.fetch('zfs/snapshot', field='name',
+                value='{name}@'.format(name=dataset.get('id')), operator='^', returnBy=list)
+
+        if not snapshots:
+            return None
+
+        txg = { s.get('id'): int(s.get('properties').get('createtxg').get('rawvalue')) for s in snapshots }
+        origins = sorted(set(c.get('origin').get('value') for c in clones), key=lambda o: txg.get(o, -1))
+
+        if len(origins) > 1:
+            raise ValueError('{name} has clones of {count} snapshots: {origins}, promote one by hand'.format(
+                    name=dataset.get('id'), count=len(origins), origins=', '.join(origins)))
+
+        if origins[-1] not in txg:
+            return None
+
+        # the last clone listed of the latest snapshot wins
+        clone = [ c for c in clones if c.get('origin').get('value') == origins[-1] ][-1]
+
+        response = self.post('{uri}/promote'.format(uri=self.uri_id('pool/dataset', clone.get('id'))), {})
+
+        if response is None or response.status_code != 200:
+            return None
+
+        self.logger.info('Clone promoted: %s, %s may be deleted', clone.get('id'), dataset.get('id'))
+
+        return clone
+
     def dataset_is_busy(self, dataset):
         ds = self.fetch('pool/dataset', field='origin.value',
                 value='{name}@'.format(name=dataset.get('id')), operator='^')
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+#
+# (C) Copyright 2024 Hewlett Packard Enterprise Development LP.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+from os import getpid
+from time import time
+from math import ceil
+from multiprocessing import Lock
+from shared import Table, array_key, pid_alive
+
+CLOSED = 0
+OPEN = 1
+HALF_OPEN = 2
+
+STATES = {
+    CLOSED: 'closed',
+    OPEN: 'open',
+    HALF_OPEN: 'half-open'
+}
+
+
+class Breaker:
+    """
+    Circuit breaker per backend shared by all workers. Consecutive failures
+    open the circuit, once the cooldown has passed a single worker may probe
+    the backend and close it again.
+    """
+
+    def __init__(self, **kwargs):
+        self.failures = kwargs.get('failures', 5)
+        self.cooldown = kwargs.get('cooldown', 30.0)
+
+        self.names = {}
+        self.lock = Lock()
+        self.backends = Table(kwargs.get('backends', 16),
+                [ 'key', 'state', 'failures', 'opened', 'probe' ])
+
+    def _backend(self, array):
+        key = array_key(array)
+        self.names[key] = array
+
+        return self.backends.row(key)
+
+    def retry_after(self, array):
+        with self.lock:
+            backend = self._backend(array)
+
+            return max(int(ceil(self.backends.get(backend, 'opened') + self.cooldown - time())), 1)
+
+    def allow(self, array):
+        with self.lock:
+            backend = self._backend(array)
+            state = self.backends.get(backend, 'state')
+
+            if state == CLOSED:
+                return True
+
+            if state == OPEN:
+                if time() - self.backends.get(backend, 'opened') < self.cooldown:
+                    return False
+
+                self.backends.set(backend, 'state', HALF_OPEN)
+                self.backends.set(backend, 'probe', getpid())
+                self.backends.set(backend, 'opened', time())
+                return True
+
+            # half-open, only the probing worker gets through unless it went away
+            probe = self.backends.get(backend, 'probe')
+
+            if probe == getpid():
+                return True
+
+            if not pid_alive(probe) or time() - self.backends.get(backend, 'opened') >= self.cooldown:
+                self.backends.set(backend, 'probe', getpid())
+                self.backends.set(backend, 'opened', time())
+                return True
+
+            return False
+
+    def success(self, array):
+        with self.lock:
+            backend = self._backend(array)
+            self.backends.set(backend, 'state', CLOSED)
+            self.backends.set(backend, 'failures', 0)
+
+    def failure(self, array):
+        with self.lock:
+            backend = self._backend(array)
+            failures = self.backends.get(backend, 'failures') + 1
+            self.backends.set(backend, 'failures', failures)
+
+            if self.backends.get(backend, 'state') == HALF_OPEN or failures >= self.failures:
+                self.backends.set(backend, 'state', OPEN)
+                self.backends.set(backend, 'opened', time())
+
+    def status(self):
+        with self.lock:
+            backends = {}
+
+            for row in range(self.backends.rows):
+                key = self.backends.get(row, 'key')
+
+                if key:
+                    backends[self.names.get(key, '{key:08x}'.format(key=int(key)))] = {
+                        'state': STATES.get(int(self.backends.get(row, 'state'))),
+                        'failures': int(self.backends.get(row, 'failures')),
+                        'opened': int(self.backends.get(row, 'opened'))
+                    }
+
+            return backends
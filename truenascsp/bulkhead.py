@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+#
+# (C) Copyright 2024 Hewlett Packard Enterprise Development LP.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+from os import getpid
+from time import time
+from multiprocessing import Lock
+from shared import Table, array_key, pid_alive
+
+
+class Full(Exception):
+    def __init__(self, message, retry_after):
+        super(Full, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class Bulkhead:
+    """
+    Bounds the admitted requests of each backend held by the workers, so a
+    saturated backend can't take the threads the other backends need.
+    Requests waiting for admission are bounded by the admission queue.
+    """
+
+    def __init__(self, **kwargs):
+        self.slots = kwargs.get('slots', 8)
+        self.retry_after = kwargs.get('retry_after', 1)
+
+        self.names = {}
+        self.lock = Lock()
+        self.occupants = Table(kwargs.get('occupants', 256), [ 'key', 'pid', 'entered' ])
+
+    def _reap(self):
+        # slots of workers killed by gunicorn are never left
+        for occupant in range(self.occupants.rows):
+            if self.occupants.get(occupant, 'key') and not pid_alive(self.occupants.get(occupant, 'pid')):
+                self.occupants.set(occupant, 'key', 0)
+
+    def _count(self, key):
+        return sum(1 for occupant in range(self.occupants.rows)
+                   if self.occupants.get(occupant, 'key') == key)
+
+    def enter(self, array):
+        """
+        Takes a slot of the backend and returns it to leave. Raises Full if
+        the backend has none left.
+        """
+        key = array_key(array)
+
+        with self.lock:
+            self.names[key] = array
+            self._reap()
+
+            if self._count(key) >= self.slots:
+                raise Full('All {slots} slots for {array} are taken'.format(slots=self.slots, array=array),
+                           self.retry_after)
+
+            for occupant in range(self.occupants.rows):
+                if not self.occupants.get(occupant, 'key'):
+                    self.occupants.set(occupant, 'key', key)
+                    self.occupants.set(occupant, 'pid', getpid())
+                    self.occupants.set(occupant, 'entered', time())
+                    return occupant
+
+            raise Full('No bulkhead slots left', self.retry_after)
+
+    def leave(self, occupant):
+        with self.lock:
+            self.occupants.set(occupant, 'key', 0)
+
+    def status(self):
+        with self.lock:
+            self._reap()
+            counts = {}
+
+            for occupant in range(self.occupants.rows):
+                key = self.occupants.get(occupant, 'key')
+
+                if key:
+                    counts[key] = counts.get(key, 0) + 1
+
+            return { self.names.get(key, '{key:08x}'.format(key=int(key))): {
+                        'slots': self.slots,
+                        'occupied': count,
+                        'saturation': count / self.slots
+                     } for key, count in counts.items() }
+
+
+class Locks:
+    """
+    Locks keyed by backend, striped over a fixed set created before gunicorn
+    forks. Backends only wait on each other when they share a stripe.
+    """
+
+    def __init__(self, stripes=16):
+        self.stripes = [ Lock() for _ in range(stripes) ]
+
+    def get(self, array):
+        return self.stripes[array_key(array) % len(self.stripes)]
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+#
+# (C) Copyright 2024 Hewlett Packard Enterprise Development LP.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+from os import getpid
+from time import time, sleep
+from threading import Lock, Thread
+import traceback
+import json
+import logs
+import metrics
+
+logger = logs.get_logger(__name__)
+
+
+class RefreshCache:
+    """
+    Serves backend lookups from memory and keeps them fresh in a background
+    thread. Entries not asked for within the staleness window are dropped,
+    entries older than the staleness window are reloaded inline.
+
+    With a store, values are shared with the other workers and whichever
+    worker finds a value older than the interval reloads it.
+    """
+
+    def __init__(self, name, loader, interval, staleness, store=None):
+        self.name = name
+        self.loader = loader
+        self.interval = interval
+        self.staleness = staleness
+        self.store = store
+        self.entries = {}
+        self.lock = Lock()
+        self.pid = None
+
+    def _start(self):
+        # gunicorn forks workers after import, each worker needs its own refresher
+        if self.pid == getpid():
+            return
+
+        with self.lock:
+            if self.pid == getpid():
+                return
+            self.pid = getpid()
+            self.entries = {}
+
+        Thread(target=self._refresh, name=self.name, daemon=True).start()
+
+    def _refresh(self):
+        while True:
+            sleep(self.interval)
+
+            with self.lock:
+                entries = list(self.entries.items())
+
+            for key, entry in entries:
+                if time() - entry.get('accessed') > self.staleness:
+                    logger.debug('%s cache dropped idle entry: %s', self.name, key)
+                    with self.lock:
+                        self.entries.pop(key, None)
+                    continue
+
+                shared = self._shared(key)
+
+                # another worker refreshed it
+                if shared and time() - shared[1] < self.interval:
+                    with self.lock:
+                        entry.update({'value': shared[0], 'refreshed': shared[1]})
+                    continue
+
+                try:
+                    value = self.loader(*entry.get('args'))
+                except Exception:
+                    logger.error('%s cache refresh failed for %s: %s', self.name,
+                                 key, traceback.format_exc())
+                    continue
+
+                if value is not None:
+                    self._share(key, value)
+                    with self.lock:
+                        entry.update({'value': value, 'refreshed': time()})
+
+    def _shared(self, key):
+        if self.store is None:
+            return None
+
+        return self.store.get('', self.name, json.dumps(key), self.staleness)
+
+    def _share(self, key, value):
+        if self.store is not None:
+            self.store.set('', self.name, json.dumps(key), value)
+
+    def seen(self, key, *args):
+        """
+        True if the entry has been loaded before with the same args.
+        """
+        entry = self.entries.get(key)
+
+        return bool(entry) and entry.get('args') == args
+
+    def get(self, key, *args):
+        """
+        Returns a tuple of value and the time it was loaded. The loader is
+        called with args and must return None if there's nothing to cache.
+        """
+        self._start()
+        now = time()
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                entry.update({'accessed': now, 'args': args})
+
+        if entry and now - entry.get('refreshed') <= self.staleness:
+            metrics.CACHE_REQUESTS.labels(self.name, 'hit').inc()
+            return entry.get('value'), entry.get('refreshed')
+
+        shared = self._shared(key)
+
+        if shared:
+            metrics.CACHE_REQUESTS.labels(self.name, 'hit').inc()
+            with self.lock:
+                self.entries[key] = {
+                    'value': shared[0],
+                    'refreshed': shared[1],
+                    'accessed': now,
+                    'args': args
+                }
+            return shared
+
+        metrics.CACHE_REQUESTS.labels(self.name, 'miss').inc()
+        value = self.loader(*args)
+
+        if value is not None:
+            self._share(key, value)
+            with self.lock:
+                self.entries[key] = {
+                    'value': value,
+                    'refreshed': now,
+                    'accessed': now,
+                    'args': args
+                }
+
+        return value, now
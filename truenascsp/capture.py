@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+#
+# (C) Copyright 2024 Hewlett Packard Enterprise Development LP.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+from os import getpid, makedirs, path
+from threading import Lock
+from logging.handlers import RotatingFileHandler
+import logging
+import json
+
+SECRETS = frozenset([ 'password', 'secret', 'peersecret', 'chap_password', 'token',
+                      'session_token', 'authorization', 'x-auth-token' ])
+
+
+def redact(value):
+    if isinstance(value, dict):
+        return { k: '*****' if str(k).lower() in SECRETS and v else redact(v) for k, v in value.items() }
+
+    if isinstance(value, list):
+        return [ redact(v) for v in value ]
+
+    return value
+
+
+def body(raw):
+    if raw is None or raw == '':
+        return None
+
+    if isinstance(raw, (bytes, str)):
+        try:
+            return json.loads(raw)
+        except ValueError:
+            return raw if isinstance(raw, str) else raw.decode('utf-8', 'replace')
+
+    return raw
+
+
+class Capture:
+    """
+    Writes backend round trips and the CSI requests behind them as JSON
+    lines, one rotating file per worker. Entries of a CSI request share
+    its request ID.
+    """
+
+    def __init__(self, directory, max_bytes, backups):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.enabled = bool(directory)
+        self.pid = None
+        self.logger = None
+        self.lock = Lock()
+
+    def _write(self, entry):
+        # files are per worker, rotating a shared file from several processes loses entries
+        if self.pid != getpid():
+            with self.lock:
+                if self.pid != getpid():
+                    makedirs(self.directory, exist_ok=True)
+
+                    handler = RotatingFileHandler(path.join(self.directory,
+                            'capture-{pid}.jsonl'.format(pid=getpid())),
+                            maxBytes=self.max_bytes, backupCount=self.backups)
+                    handler.setFormatter(logging.Formatter('%(message)s'))
+
+                    self.logger = logging.getLogger('capture {pid}'.format(pid=getpid()))
+                    self.logger.propagate = False
+                    self.logger.setLevel(logging.INFO)
+                    self.logger.handlers = [ handler ]
+                    self.pid = getpid()
+
+        self.logger.info(json.dumps(entry, separators=(',', ':')))
+
+    def backend(self, api, method, uri, request, response, started, elapsed):
+        self._write({
+            'k': 'backend',
+            'rid': api.request_id,
+            'array': api.backend,
+            't': round(started, 4),
+            'ms': round(elapsed * 1000, 2),
+            'm': method,
+            'u': uri,
+            'q': redact(body(request.get('json', request.get('data')))),
+            's': response.status_code if response is not None else None,
+            'n': len(response.content) if response is not None else 0,
+            'b': redact(body(response.content)) if response is not None else None
+        })
+
+    def csi(self, api, req, resp):
+        query = '?{query}'.format(query=req.query_string) if req.query_string else ''
+
+        self._write({
+            'k': 'csi',
+            'rid': api.request_id,
+            'array': api.backend,
+            't': round(api.started, 4),
+            'ms': round((api.trace.duration() or 0.0) * 1000, 2),
+            'm': req.method,
+            'route': req.uri_template,
+            'p': '{path}{query}'.format(path=req.path, query=query),
+            'q': redact(req.media),
+            's': str(resp.status).split(' ')[0]
+        })
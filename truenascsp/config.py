@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+#
+# (C) Copyright 2024 Hewlett Packard Enterprise Development LP.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+from os import environ, path
+from types import MappingProxyType
+from collections import namedtuple
+import json
+
+# where each profile property is applied
+PROFILE_PROPERTIES = {
+    'volblocksize': 'pool/dataset',
+    'compression': 'pool/dataset',
+    'deduplication': 'pool/dataset',
+    'sync': 'pool/dataset',
+    'special_small_block_size': 'pool/dataset',
+    'logbias': 'zfs/dataset',
+    'primarycache': 'zfs/dataset',
+    'secondarycache': 'zfs/dataset',
+    'blocksize': 'iscsi/extent',
+    'pblocksize': 'iscsi/extent'
+}
+
+PERFORMANCE_PROFILES = {
+    'database': {
+        'volblocksize': '16K',
+        'logbias': 'latency',
+        'primarycache': 'all',
+        'blocksize': 4096
+    },
+    'vm-boot': {
+        'volblocksize': '16K',
+        'primarycache': 'all',
+        'blocksize': 512,
+        'pblocksize': True
+    },
+    'bulk': {
+        'volblocksize': '128K',
+        'logbias': 'throughput',
+        'primarycache': 'metadata',
+        'secondarycache': 'metadata',
+        'blocksize': 4096
+    }
+}
+
+Config = namedtuple('Config', [
+    'backend_schema',
+    'connect_timeout',
+    'read_timeout',
+    'write_timeout',
+    'target_portal',
+    'chap_tag',
+    'dataset_defaults',
+    'performance_profiles',
+    'cached_resources',
+    'clone_promotion',
+    'capture_dir',
+    'capture_max_bytes',
+    'capture_backups',
+    'journal_dir',
+    'cache_dir',
+    'cache_max_entries',
+    'index_ttl',
+    'index_max_entries',
+    'bulkhead_slots',
+    'lock_backend',
+    'lock_dir',
+    'lock_lease_duration',
+    'lock_namespace',
+    'lock_identity',
+    'breaker_failures',
+    'ready_max_latency',
+    'ready_probe_after',
+    'prewarm_arrays',
+    'prewarm_token',
+    'breaker_cooldown',
+    'admission_initial_limit',
+    'admission_max_limit',
+    'admission_latency_target',
+    'admission_queue_depth',
+    'admission_queue_timeout',
+    'admission_control',
+    'admin_token',
+    'default_deadline',
+    'route_deadlines',
+    'log_debug',
+    'log_format',
+    'log_payload_sampling',
+    'metrics_dir',
+    'kubernetes_url',
+    'profile_dir',
+    'profile_max_seconds',
+    'profile_max_overhead',
+    'profile_interval',
+    'profile_sample_percent',
+    'trace_slowest',
+    'trace_window',
+    'reconcile_mode',
+    'reconcile_interval',
+    'reconcile_max_deletes',
+    'reconcile_delete_delay',
+    'journal_abandon_after',
+    'capacity_refresh_interval',
+    'capacity_max_staleness',
+    'statistics_refresh_interval',
+    'statistics_max_staleness'
+])
+
+
+def frozen(value):
+    if isinstance(value, dict):
+        return MappingProxyType({ k: frozen(v) for k, v in value.items() })
+
+    if isinstance(value, list):
+        return tuple(frozen(v) for v in value)
+
+    return value
+
+
+def load(env=environ):
+    """
+    Parses the environment once, raises ValueError on settings the CSP
+    can't run with.
+    """
+    profiles = dict(PERFORMANCE_PROFILES)
+    profiles.update(json.loads(env.get('PERFORMANCE_PROFILES', '{}')))
+
+    for name, profile in profiles.items():
+        for key in profile:
+            if key not in PROFILE_PROPERTIES:
+                raise ValueError('Performance profile "{name}" has unknown property "{key}"'.format(
+                        name=name, key=key))
+
+    if env.get('BACKEND_SCHEMA', 'https') not in ('http', 'https'):
+        raise ValueError('BACKEND_SCHEMA must be http or https')
+
+    if env.get('LOCK_BACKEND', 'local') not in ('local', 'file', 'lease'):
+        raise ValueError('LOCK_BACKEND must be local, file or lease')
+
+    # in cluster API server address of the lease lock backend
+    kubernetes_url = None
+
+    if env.get('KUBERNETES_SERVICE_HOST'):
+        kubernetes_url = 'https://{host}:{port}'.format(host=env.get('KUBERNETES_SERVICE_HOST'),
+                port=env.get('KUBERNETES_SERVICE_PORT', '443'))
+    elif env.get('LOCK_BACKEND') == 'lease':
+        raise ValueError('LOCK_BACKEND lease must run in Kubernetes, KUBERNETES_SERVICE_HOST is not set')
+
+    return Config(
+        backend_schema=env.get('BACKEND_SCHEMA', 'https'),
+        connect_timeout=float(env.get('BACKEND_CONNECT_TIMEOUT', '5')),
+        read_timeout=float(env.get('BACKEND_READ_TIMEOUT', '30')),
+        write_timeout=float(env.get('BACKEND_WRITE_TIMEOUT', '60')),
+        target_portal=env.get('DEFAULT_TARGET_PORTAL', 'hpe-csi'),
+        chap_tag=str(int(env.get('DEFAULT_CHAP_TAG', '4730274'))),
+        dataset_defaults=frozen({
+            'deduplication': env.get('DEFAULT_DEDUPLICATION', 'OFF'),
+            'compression': env.get('DEFAULT_COMPRESSION', 'LZ4'),
+            'sync': env.get('DEFAULT_SYNC', 'STANDARD'),
+            'sparse': env.get('DEFAULT_SPARSE', "true"),
+            'root': env.get('DEFAULT_ROOT', 'tank'),
+            'volblocksize': env.get('DEFAULT_VOLBLOCKSIZE', '8K'),
+            'description': env.get('DEFAULT_DESCRIPTION', 'Dataset created by HPE CSI Driver for Kubernetes as {pv} in {namespace} from {pvc}')
+        }),
+        performance_profiles=frozen(profiles),
+        # backend facts served to all workers from the shared cache, in seconds
+        cached_resources=frozen({
+            'system/version': float(env.get('CACHE_VERSION_TTL', '300')),
+            'iscsi/global': float(env.get('CACHE_TTL', '60')),
+            'iscsi/portal': float(env.get('CACHE_TTL', '60')),
+            'interface': float(env.get('CACHE_TTL', '60'))
+        }),
+        clone_promotion=json.loads(env.get('CLONE_PROMOTION', 'false').lower()),
+        capture_dir=env.get('CAPTURE_DIR'),
+        capture_max_bytes=int(env.get('CAPTURE_MAX_BYTES', str(64 * 1024 * 1024))),
+        capture_backups=int(env.get('CAPTURE_BACKUPS', '4')),
+        journal_dir=env.get('JOURNAL_DIR', '/tmp/truenas-csp-journal'),
+        cache_dir=env.get('CACHE_DIR', '/dev/shm/truenas-csp-cache' if path.isdir('/dev/shm')
+                          else '/tmp/truenas-csp-cache'),
+        cache_max_entries=int(env.get('CACHE_MAX_ENTRIES', '10000')),
+        index_ttl=float(env.get('INDEX_TTL', '30')),
+        index_max_entries=int(env.get('INDEX_MAX_ENTRIES', '10000')),
+        bulkhead_slots=int(env.get('BULKHEAD_SLOTS', '8')),
+        lock_backend=env.get('LOCK_BACKEND', 'local'),
+        lock_dir=env.get('LOCK_DIR', '/tmp/truenas-csp-locks'),
+        lock_lease_duration=float(env.get('LOCK_LEASE_DURATION', '15')),
+        lock_namespace=env.get('POD_NAMESPACE'),
+        lock_identity=env.get('POD_NAME'),
+        ready_max_latency=float(env.get('READY_MAX_LATENCY', '10')),
+        ready_probe_after=float(env.get('READY_PROBE_AFTER', '10')),
+        prewarm_arrays=tuple(a.strip() for a in env.get('PREWARM_BACKEND', '').split(',') if a.strip()),
+        prewarm_token=env.get('PREWARM_TOKEN'),
+        breaker_failures=int(env.get('BREAKER_FAILURES', '5')),
+        breaker_cooldown=float(env.get('BREAKER_COOLDOWN', '30')),
+        admission_initial_limit=float(env.get('ADMISSION_INITIAL_LIMIT', '4')),
+        admission_max_limit=float(env.get('ADMISSION_MAX_LIMIT', '16')),
+        admission_latency_target=float(env.get('ADMISSION_LATENCY_TARGET', '2')),
+        admission_queue_depth=int(env.get('ADMISSION_QUEUE_DEPTH', '32')),
+        admission_queue_timeout=float(env.get('ADMISSION_QUEUE_TIMEOUT', '30')),
+        admission_control=json.loads(env.get('ADMISSION_CONTROL', 'true').lower()),
+        admin_token=env.get('ADMIN_TOKEN'),
+        # keep below the gunicorn worker timeout
+        default_deadline=float(env.get('DEFAULT_DEADLINE', '170')),
+        route_deadlines=frozen(json.loads(env.get('ROUTE_DEADLINES', '{}'))),
+        log_debug=bool(env.get('LOG_DEBUG')),
+        log_format=env.get('LOG_FORMAT', 'text'),
+        log_payload_sampling=frozen(json.loads(env.get('LOG_PAYLOAD_SAMPLING', '{}'))),
+        metrics_dir=env.get('PROMETHEUS_MULTIPROC_DIR', '/tmp/truenas-csp-metrics'),
+        kubernetes_url=kubernetes_url,
+        profile_dir=env.get('PROFILE_DIR', '/tmp/truenas-csp-profiles'),
+        profile_max_seconds=float(env.get('PROFILE_MAX_SECONDS', '120')),
+        profile_max_overhead=float(env.get('PROFILE_MAX_OVERHEAD', '0.01')),
+        profile_interval=float(env.get('PROFILE_INTERVAL', '0.01')),
+        profile_sample_percent=float(env.get('PROFILE_SAMPLE_PERCENT', '0')),
+        trace_slowest=int(env.get('TRACE_SLOWEST', '20')),
+        trace_window=float(env.get('TRACE_WINDOW', '3600')),
+        reconcile_mode=env.get('RECONCILE_MODE', 'off'),
+        reconcile_interval=float(env.get('RECONCILE_INTERVAL', '3600')),
+        reconcile_max_deletes=int(env.get('RECONCILE_MAX_DELETES', '20')),
+        reconcile_delete_delay=float(env.get('RECONCILE_DELETE_DELAY', '1')),
+        journal_abandon_after=float(env.get('JOURNAL_ABANDON_AFTER', '3600')),
+        capacity_refresh_interval=float(env.get('CAPACITY_REFRESH_INTERVAL', '30')),
+        capacity_max_staleness=float(env.get('CAPACITY_MAX_STALENESS', '120')),
+        statistics_refresh_interval=float(env.get('STATISTICS_REFRESH_INTERVAL', '60')),
+        statistics_max_staleness=float(env.get('STATISTICS_MAX_STALENESS', '300'))
+    )
+
+
+CONFIG = load()
@@ -22,16 +22,23 @@
 # THE SOFTWARE.
 #
 
+from time import time
+import json
+import hmac
 import falcon
 import backend
+import admission
+import bulkhead
+import metrics
+import logs
 import truenascsp
 
 from falcon.http_error import HTTPError
 
 class CSPError(HTTPError):
 
-    def __init__(self, status, error):
-        super(CSPError, self).__init__(status)
+    def __init__(self, status, error, **kwargs):
+        super(CSPError, self).__init__(status, **kwargs)
         self.status = status
         self.error = {"errors":[{"code": status,"message": error }]}
 
@@ -40,15 +47,161 @@ class CSPError(HTTPError):
         obj = self.error
         return obj
 
+
 class PostLogger:
     def process_response(self, req, resp, resource, req_succeded):
         api = req.context
 
         api.logger.debug('Falcon Response (to HPE CSI): %s', resp.status)
-        api.logger.debug('Last backend requests Response: %s', api.resp_msg)
+        api.logger.debug('Backend round trips: %s', api.round_trips)
+
+
+class RequestMetrics:
+    def process_response(self, req, resp, resource, req_succeded):
+        api = req.context
+
+        if not isinstance(api, backend.Handler):
+            return
+
+        route = req.uri_template or 'unrouted'
+
+        metrics.REQUEST_DURATION.labels(route, req.method,
+                str(resp.status).split(' ')[0]).observe(time() - api.started)
+        metrics.REQUEST_ROUND_TRIPS.labels(route, req.method).observe(api.round_trips)
+
+
+class RequestTracing:
+    untraced_routes = [
+        '/status',
+        '/metrics',
+        '/debug/traces'
+    ]
+
+    def process_response(self, req, resp, resource, req_succeded):
+        api = req.context
+
+        if not isinstance(api, backend.Handler):
+            return
+
+        api.trace.finish('{method} {route}'.format(method=req.method,
+                route=req.uri_template or req.path), status=str(resp.status).split(' ')[0],
+                array=api.backend or '', round_trips=api.round_trips)
+
+        resp.set_header('traceparent', api.trace.traceparent())
+
+        if req.path not in self.untraced_routes:
+            truenascsp.slow_traces.add(api.trace)
+
+
+class RequestProfiling:
+    def process_request(self, req, resp):
+        if not req.path.startswith('/debug/'):
+            req.env['truenascsp.profiling'] = truenascsp.profiling.enable()
+
+    def process_response(self, req, resp, resource, req_succeded):
+        profiling = req.env.pop('truenascsp.profiling', None)
+
+        if profiling:
+            truenascsp.profiling.disable(profiling)
+
+
+class RequestCapture:
+    def process_response(self, req, resp, resource, req_succeded):
+        api = req.context
+
+        if not isinstance(api, backend.Handler) or req.path in TokenHandler.public_routes or \
+                req.path.startswith('/debug/'):
+            return
+
+        backend.CAPTURE.csi(api, req, resp)
+
+
+class AdmissionControl:
+    priorities = {
+        ('Publish', 'PUT'): admission.PUBLISH,
+        ('Unpublish', 'PUT'): admission.PUBLISH,
+        ('Volume', 'DELETE'): admission.HOUSEKEEPING,
+        ('Hosts', 'DELETE'): admission.HOUSEKEEPING,
+        ('Snapshots', 'POST'): admission.HOUSEKEEPING,
+        ('Snapshot', 'DELETE'): admission.HOUSEKEEPING
+    }
+
+    def process_resource(self, req, resp, resource, params):
+        api = req.context
+
+        # unrouted requests and token deletes never reach a backend
+        if resource is None or not api.backend:
+            return
+
+        priority = self.priorities.get((type(resource).__name__, req.method),
+                admission.PROVISION)
+
+        try:
+            ticket = backend.ADMISSION.acquire(api.backend, priority, timeout=api.remaining())
+        except admission.Overloaded as e:
+            api.logger.info('%s: %s', falcon.HTTP_429, e)
+            raise CSPError(falcon.HTTP_429, str(e),
+                    headers={'Retry-After': str(e.retry_after)})
+
+        req.env['truenascsp.admission'] = (ticket, time())
+
+    def process_response(self, req, resp, resource, req_succeded):
+        admitted = req.env.pop('truenascsp.admission', None)
+
+        if admitted:
+            api = req.context
+            ticket, started = admitted
+            round_trip = api.round_trip_time / api.round_trips if api.round_trips else None
+
+            backend.ADMISSION.release(ticket, time() - started, round_trip,
+                    failed=str(resp.status).startswith('5'))
+
+
+class Bulkheads:
+    def process_resource(self, req, resp, resource, params):
+        api = req.context
+
+        if resource is None or not api.backend:
+            return
+
+        try:
+            occupant = backend.BULKHEAD.enter(api.backend)
+        except bulkhead.Full as e:
+            metrics.BULKHEAD_REJECTED.labels(api.backend).inc()
+            api.logger.info('%s: %s', falcon.HTTP_429, e)
+            raise CSPError(falcon.HTTP_429, str(e),
+                    headers={'Retry-After': str(e.retry_after)})
+
+        req.env['truenascsp.bulkhead'] = occupant
+
+    def process_response(self, req, resp, resource, req_succeded):
+        occupant = req.env.pop('truenascsp.bulkhead', None)
+
+        if occupant is not None:
+            backend.BULKHEAD.leave(occupant)
 
 
 class TokenHandler:
+    public_routes = [
+        '/healthz',
+        '/readyz',
+        '/status',
+        '/metrics'
+    ]
+
+    admin_routes = '/debug/'
+    admin_token = backend.CONFIG.admin_token
+
+    cached_routes = {
+        '/containers/v1/capacity': truenascsp.capacity_cache,
+        '/containers/v1/statistics': truenascsp.statistics_cache
+    }
+
+    payload_sampling = logs.PayloadSampling(backend.CONFIG.log_payload_sampling)
+
+    default_deadline = backend.CONFIG.default_deadline
+    route_deadlines = backend.CONFIG.route_deadlines
+
     def process_request(self, req, resp):
         content = req.media
         token = None
@@ -58,10 +211,32 @@ class TokenHandler:
         api = backend.Handler()
         req.context = api
 
+        api.trace.adopt(req.get_header('traceparent'))
+        api.request_id = req.get_header('x-request-id') or api.trace.trace_id
+        api.log_payloads = self.payload_sampling.sample(req.method, req.path)
+
         if tokens_url != -1 and req.method == 'DELETE':
             req.context = api
             return
 
+        if req.path in self.public_routes:
+            return
+
+        if req.path.startswith(self.admin_routes):
+            if not self.admin_token:
+                reason = falcon.HTTP_404
+                description = 'Admin endpoints are disabled, ADMIN_TOKEN is not set'
+                api.logger.info('%s: %s', reason, description)
+                raise CSPError(reason, description)
+
+            if not hmac.compare_digest(req.get_header('x-admin-token', default=''), self.admin_token):
+                reason = falcon.HTTP_401
+                description = 'Missing or invalid x-admin-token in header'
+                api.logger.info('%s: %s', reason, description)
+                raise CSPError(reason, description)
+
+            return
+
         if content:
             token = content.get('password')
             array = content.get('array_ip')
@@ -85,16 +260,101 @@ class TokenHandler:
         api.backend = array
         api.token = token
 
-        api.ping(req)
+        api.deadline = api.started + self.timeout(req, self.default_deadline)
+
+        if not backend.BREAKER.allow(array):
+            reason = falcon.HTTP_503
+            description = 'Circuit open for {array}, backend requests are failing'.format(array=array)
+            api.logger.info('%s: %s', reason, description)
+            raise CSPError(reason, description,
+                    headers={'Retry-After': str(backend.BREAKER.retry_after(array))})
+
+        # cached resources are served without touching the backend for known credentials
+        if req.path in self.cached_routes:
+            root = req.params.get('root', api.dataset_defaults.get('root'))
+
+            if self.cached_routes.get(req.path).seen((array, root), array, token, root):
+                return
+
+        try:
+            pong = api.ping(req)
+        except backend.BackendUnavailable:
+            status, description, retry_after = api.abort
+            api.logger.info('%s: %s', status, description)
+            raise CSPError(status, description, headers={'Retry-After': str(retry_after)})
 
-        if not api.pong:
+        if not pong:
             reason = falcon.HTTP_401
             description = 'Unable to authenticate with provided credentials'
             api.logger.info('%s: %s', reason, description)
             raise CSPError(reason, description)
 
+        truenascsp.reconciling.register(array, token)
+        backend.HEALTH.register(array, token)
+
+    def process_resource(self, req, resp, resource, params):
+        api = req.context
+
+        if api.deadline is None:
+            return
+
+        route = '{method} {template}'.format(method=req.method, template=req.uri_template)
+        limit = float(self.route_deadlines.get(route, self.default_deadline))
+
+        api.deadline = api.started + self.timeout(req, limit)
+
+    def timeout(self, req, limit):
+        # callers may tell how long they're prepared to wait, up to the limit
+        try:
+            timeout = float(req.get_header('x-request-timeout', default=limit))
+        except ValueError:
+            return limit
+
+        if not 0 < timeout <= limit:
+            return limit
+
+        return timeout
+
+    def process_response(self, req, resp, resource, req_succeded):
+        api = req.context
+
+        if not isinstance(api, backend.Handler):
+            return
+
+        resp.set_header('X-Request-ID', api.request_id)
+
+        # backend requests short-circuited halfway through the request
+        if api.abort:
+            status, description, retry_after = api.abort
+            resp.status = status
+            resp.body = json.dumps(CSPError(status, description).to_dict())
+            resp.set_header('Retry-After', str(retry_after))
+
 # Serve!
-SERVE = falcon.API(middleware=[TokenHandler(), PostLogger()])
+def middleware(config):
+    """
+    Middleware in the order requests pass through it.
+    """
+    chain = [RequestProfiling(), RequestTracing(), RequestMetrics(), TokenHandler()]
+
+    if config.admission_control:
+        chain.append(AdmissionControl())
+
+    # slots are taken once admitted, the admission queue bounds the waiting
+    if config.bulkhead_slots:
+        chain.append(Bulkheads())
+
+    chain.append(PostLogger())
+
+    if backend.CAPTURE.enabled:
+        chain.insert(1, RequestCapture())
+
+    return chain
+
+
+MIDDLEWARE = middleware(backend.CONFIG)
+
+SERVE = falcon.API(middleware=MIDDLEWARE)
 
 # Routes
 SERVE.add_route('/containers/v1/tokens/{token_id:int}', truenascsp.Tokens())
@@ -111,3 +371,14 @@ SERVE.add_route('/containers/v1/volumes/{volume_id}/actions/unpublish', truenasc
 
 SERVE.add_route('/containers/v1/snapshots/{snapshot_id}', truenascsp.Snapshot())
 SERVE.add_route('/containers/v1/snapshots', truenascsp.Snapshots())
+
+SERVE.add_route('/containers/v1/capacity', truenascsp.Capacity())
+SERVE.add_route('/containers/v1/statistics', truenascsp.Statistics())
+
+SERVE.add_route('/healthz', truenascsp.Healthz())
+SERVE.add_route('/readyz', truenascsp.Readyz())
+SERVE.add_route('/status', truenascsp.Status())
+SERVE.add_route('/metrics', truenascsp.Metrics())
+SERVE.add_route('/debug/traces', truenascsp.Traces())
+SERVE.add_route('/debug/profile/{capture_id}', truenascsp.Profile())
+SERVE.add_route('/debug/profile', truenascsp.Profiles())
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+#
+# (C) Copyright 2024 Hewlett Packard Enterprise Development LP.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+from os import getpid
+from time import time
+from threading import Thread
+from multiprocessing import Lock
+from shared import Table, array_key, pid_alive
+import traceback
+import logs
+
+logger = logs.get_logger(__name__)
+
+PENDING = 0
+RUNNING = 1
+DONE = 2
+
+STATES = {
+    PENDING: 'pending',
+    RUNNING: 'running',
+    DONE: 'done'
+}
+
+
+def percentile(samples, share):
+    return samples[min(int(len(samples) * share), len(samples) - 1)]
+
+
+class Health:
+    """
+    Recent backend round trips of each array and the state of the cache
+    prewarm, in shared memory for whichever worker serves the probe. The
+    credentials to ping an array are only known to the workers that
+    served it.
+    """
+
+    def __init__(self, **kwargs):
+        self.samples = kwargs.get('samples', 64)
+        self.max_latency = kwargs.get('max_latency', 10.0)
+        self.prewarm_arrays = kwargs.get('prewarm', ())
+        self.probe_after = kwargs.get('probe_after', 10.0)
+
+        self.names = {}
+        self.tokens = {}
+        self.lock = Lock()
+        self.fields = [ 's{n}'.format(n=n) for n in range(self.samples) ]
+        self.arrays = Table(kwargs.get('arrays', 16),
+                [ 'key', 'next', 'succeeded', 'failed' ] + self.fields)
+        self.prewarm = Table(1, [ 'state', 'pid' ])
+        self.prewarm.set(0, 'state', DONE if not self.prewarm_arrays else PENDING)
+
+    def record(self, array, seconds, ok=True):
+        key = array_key(array)
+        self.names[key] = array
+
+        with self.lock:
+            row = self.arrays.row(key)
+            sample = int(self.arrays.get(row, 'next'))
+
+            self.arrays.set(row, self.fields[sample % self.samples], seconds)
+            self.arrays.set(row, 'next', sample + 1)
+            self.arrays.set(row, 'succeeded' if ok else 'failed', time())
+
+    def register(self, array, token):
+        self.tokens[array] = token
+
+    def reset(self, array, seconds):
+        key = array_key(array)
+
+        with self.lock:
+            row = self.arrays.row(key)
+
+            self.arrays.set(row, self.fields[0], seconds)
+            self.arrays.set(row, 'next', 1)
+            self.arrays.set(row, 'succeeded', time())
+
+    def status(self):
+        with self.lock:
+            arrays = {}
+
+            for row in range(self.arrays.rows):
+                key = self.arrays.get(row, 'key')
+
+                if not key:
+                    continue
+
+                count = min(int(self.arrays.get(row, 'next')), self.samples)
+                samples = sorted(self.arrays.get(row, field) for field in self.fields[:count])
+                succeeded = self.arrays.get(row, 'succeeded')
+
+                arrays[self.names.get(key, '{key:08x}'.format(key=int(key)))] = {
+                    'reachable': succeeded > self.arrays.get(row, 'failed'),
+                    'last_success': int(succeeded),
+                    'last_failure': int(self.arrays.get(row, 'failed')),
+                    'samples': count,
+                    'p50': percentile(samples, 0.5) if samples else None,
+                    'p95': percentile(samples, 0.95) if samples else None,
+                    'p99': percentile(samples, 0.99) if samples else None
+                }
+
+            return arrays
+
+    def prewarm_state(self):
+        return STATES.get(int(self.prewarm.get(0, 'state')))
+
+    def start_prewarm(self, loader):
+        """
+        Calls loader with each array to prewarm in a thread of this worker,
+        unless another worker has it covered. Returns the thread started.
+        """
+        with self.lock:
+            state = self.prewarm.get(0, 'state')
+
+            if state == DONE or (state == RUNNING and pid_alive(self.prewarm.get(0, 'pid'))):
+                return None
+
+            self.prewarm.set(0, 'state', RUNNING)
+            self.prewarm.set(0, 'pid', getpid())
+
+        thread = Thread(target=self._prewarm, args=(loader,), name='prewarm', daemon=True)
+        thread.start()
+
+        return thread
+
+    def _prewarm(self, loader):
+        for array in self.prewarm_arrays:
+            started = time()
+
+            try:
+                loader(array)
+                logger.info('Prewarmed %s in %.1fs', array, time() - started)
+            except Exception:
+                logger.error('Prewarm of %s failed: %s', array, traceback.format_exc())
+
+        self.prewarm.set(0, 'state', DONE)
+
+    def ready(self, breakers, ping=None):
+        """
+        Returns whether to take traffic and why. Not before the caches are
+        warm and not while every array known is failing or slow. No request
+        reaches an unready pod, arrays left alone for probe_after seconds
+        are pinged instead.
+        """
+        if self.prewarm.get(0, 'state') != DONE:
+            return False, 'Prewarming caches for {arrays}'.format(arrays=', '.join(self.prewarm_arrays))
+
+        arrays = self.status()
+        healthy = self.healthy(arrays, breakers)
+
+        if arrays and not healthy and ping:
+            for array, status in arrays.items():
+                if array in self.tokens and \
+                        time() - max(status.get('last_success'), status.get('last_failure')) >= self.probe_after:
+                    self.probe(array, ping)
+
+            arrays = self.status()
+            healthy = self.healthy(arrays, breakers)
+
+        if arrays and not healthy:
+            return False, 'No array is reachable within {seconds}s'.format(seconds=self.max_latency)
+
+        return True, 'Ready'
+
+    def healthy(self, arrays, breakers):
+        return [ array for array, status in arrays.items()
+                 if status.get('reachable') and
+                    breakers.get(array, {}).get('state') != 'open' and
+                    (status.get('p95') or 0) <= self.max_latency ]
+
+    def probe(self, array, ping):
+        """
+        Pings array within max_latency, a quick answer starts its samples
+        over, the slow ones were taken before it recovered.
+        """
+        started = time()
+
+        try:
+            ok = ping(array, self.tokens.get(array), self.max_latency)
+        except Exception:
+            logger.info('Ping of %s failed: %s', array, traceback.format_exc())
+            return
+
+        seconds = time() - started
+
+        if ok and seconds <= self.max_latency:
+            self.reset(array, seconds)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+#
+# (C) Copyright 2024 Hewlett Packard Enterprise Development LP.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+from time import time
+from threading import Lock
+from collections import OrderedDict
+
+
+class Index:
+    """
+    Datasets and snapshots of each backend kept in worker memory, by id and
+    by the results of lookups by snapshot name and parent dataset.
+
+    Any write the CSP makes to a dataset or snapshot drops the entries of
+    the backend, in every worker with a shared store to count writes in.
+    Entries expire after ttl otherwise, the least recently used ones are
+    evicted beyond max_entries.
+    """
+
+    def __init__(self, ttl, max_entries, store=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.store = store
+        self.entries = OrderedDict()
+        self.writes = {}
+        self.lock = Lock()
+
+    def generation(self, array):
+        """
+        Read before the backend lookup and passed to put.
+        """
+        shared = self.store.generation(array, 'zfs') if self.store is not None else 0
+
+        return shared, self.writes.get(array, 0)
+
+    def _get(self, key, generation):
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None:
+                return None
+
+            if entry.get('generation') != generation or time() - entry.get('stored') > self.ttl:
+                del self.entries[key]
+                return None
+
+            self.entries.move_to_end(key)
+
+            return entry
+
+    def _put(self, key, generation, **entry):
+        entry.update({ 'generation': generation, 'stored': time() })
+
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _item(self, array, resource, item_id, holds, generation):
+        entry = self._get(('item', array, resource, item_id), generation)
+
+        # items found without their holds don't do for lookups that need them
+        if entry and (entry.get('holds') or not holds):
+            return entry.get('item')
+
+        return None
+
+    def get(self, array, resource, item_id, holds=False):
+        if not self.ttl:
+            return None
+
+        return self._item(array, resource, item_id, holds, self.generation(array))
+
+    def query(self, array, resource, field, value, holds=False):
+        """
+        Items last found by field, None unless all of them are still known.
+        """
+        if not self.ttl:
+            return None
+
+        generation = self.generation(array)
+        entry = self._get(('query', array, resource, field, value, holds), generation)
+
+        if entry is None:
+            return None
+
+        items = [ self._item(array, resource, item_id, holds, generation) for item_id in entry.get('ids') ]
+
+        return None if None in items else items
+
+    def put(self, array, resource, items, generation, holds=False, field=None, value=None):
+        if not self.ttl or generation != self.generation(array):
+            return
+
+        with self.lock:
+            for item in items:
+                self._put(('item', array, resource, item.get('id')), generation, item=item, holds=holds)
+
+            if field:
+                self._put(('query', array, resource, field, value, holds), generation,
+                          ids=[ item.get('id') for item in items ])
+
+    def invalidate(self, array):
+        with self.lock:
+            self.writes[array] = self.writes.get(array, 0) + 1
+
+            for key in [ key for key in self.entries if key[1] == array ]:
+                del self.entries[key]
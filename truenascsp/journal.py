@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+#
+# (C) Copyright 2024 Hewlett Packard Enterprise Development LP.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+from os import makedirs, path, listdir, remove, replace, getpid
+from time import time
+from threading import get_ident
+from shared import array_key
+import json
+import re
+
+unsafe = re.compile('[^A-Za-z0-9_.-]')
+
+
+class Entry:
+    """
+    Progress of one operation. Steps are recorded with the backend ID they
+    produced and whether the operation created the object.
+    """
+
+    def __init__(self, journal, filename, content):
+        self.journal = journal
+        self.filename = filename
+        self.content = content
+
+    def get(self, step):
+        return self.content.get('steps').get(step, {}).get('id')
+
+    def created(self, step):
+        return self.content.get('steps').get(step, {}).get('created', False)
+
+    def resumed(self):
+        return bool(self.content.get('steps'))
+
+    def record(self, step, backend_id, created=True):
+        self.content['steps'][step] = { 'id': backend_id, 'created': created }
+        self.content['updated'] = time()
+        self.journal._write(self.filename, self.content)
+
+    def done(self):
+        self.journal._remove(self.filename)
+
+
+class Journal:
+    """
+    Keeps a file per multi-step operation in progress, keyed by array and
+    name, so a retry resumes where an interrupted attempt stopped. Files are
+    removed when the operation completes, what's left behind was abandoned.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.enabled = bool(directory)
+
+        if self.enabled:
+            makedirs(directory, exist_ok=True)
+
+    def _filename(self, array, operation, name):
+        return '{key:08x}-{operation}-{name}.json'.format(key=array_key(array),
+                operation=operation, name=unsafe.sub('_', name))
+
+    def _write(self, filename, content):
+        if not self.enabled:
+            return
+
+        # readers never see half an entry
+        staging = path.join(self.directory, '.{pid}-{thread}-{filename}'.format(pid=getpid(),
+                            thread=get_ident(), filename=filename))
+
+        with open(staging, 'w') as f:
+            json.dump(content, f)
+
+        replace(staging, path.join(self.directory, filename))
+
+    def _remove(self, filename):
+        if not self.enabled:
+            return
+
+        try:
+            remove(path.join(self.directory, filename))
+        except FileNotFoundError:
+            pass
+
+    def _read(self, filename):
+        try:
+            with open(path.join(self.directory, filename)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def begin(self, array, operation, name):
+        """
+        Returns the entry of an interrupted attempt or a new one.
+        """
+        filename = self._filename(array, operation, name)
+        content = self._read(filename) if self.enabled else None
+
+        if not content:
+            content = {
+                'array': array,
+                'operation': operation,
+                'name': name,
+                'started': time(),
+                'updated': time(),
+                'steps': {}
+            }
+
+        return Entry(self, filename, content)
+
+    def abandoned(self, array, age):
+        """
+        Entries of array not updated for age seconds.
+        """
+        if not self.enabled:
+            return []
+
+        entries = []
+
+        for filename in sorted(listdir(self.directory)):
+            if filename.startswith('.') or not filename.endswith('.json'):
+                continue
+
+            content = self._read(filename)
+
+            if content and content.get('array') == array and time() - content.get('updated') > age:
+                entries.append(Entry(self, filename, content))
+
+        return entries
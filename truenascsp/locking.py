@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+
+#
+# (C) Copyright 2024 Hewlett Packard Enterprise Development LP.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+from os import getpid, makedirs, path, open as os_open, close, O_RDWR, O_CREAT
+from time import time, monotonic, sleep
+from threading import Lock, Thread, local, get_ident
+from datetime import datetime, timezone
+from multiprocessing import Array, RLock
+from hashlib import sha1
+from socket import gethostname
+from shared import array_key
+import random
+import fcntl
+import requests
+import logs
+import metrics
+
+logger = logs.get_logger(__name__)
+
+SERVICE_ACCOUNT = '/var/run/secrets/kubernetes.io/serviceaccount'
+
+LEASES = '/apis/coordination.k8s.io/v1/namespaces/{namespace}/leases'
+
+
+class Lost(Exception):
+    pass
+
+
+def key_name(array, key):
+    return '{array}/{key}'.format(array=array, key=key)
+
+
+class LocalLocks:
+    """
+    Keyed locks for the workers of one replica, striped over locks created
+    before gunicorn forks. Each stripe counts its acquisitions, the count is
+    the fencing token. A thread holding one key takes other keys of the same
+    stripe again, it would otherwise wait on itself.
+    """
+
+    def __init__(self, stripes=64):
+        self.stripes = [ RLock() for _ in range(stripes) ]
+        self.tokens = Array('d', stripes, lock=False)
+        self.held = local()
+
+    def get(self, array, key):
+        return LocalLock(self, key_name(array, key))
+
+    def names(self):
+        if not hasattr(self.held, 'names'):
+            self.held.names = set()
+
+        return self.held.names
+
+
+class LocalLock:
+    def __init__(self, locks, name):
+        self.name = name
+        self.locks = locks
+        self.stripe = array_key(name) % len(locks.stripes)
+        self.lock = locks.stripes[self.stripe]
+        self.tokens = locks.tokens
+        self.token = None
+
+    def acquire(self, blocking=True, deadline=None):
+        # the stripe is reentrant, the key itself isn't
+        if self.name in self.locks.names():
+            return False
+
+        if blocking and deadline is not None:
+            acquired = self.lock.acquire(True, max(deadline - time(), 0))
+        else:
+            acquired = self.lock.acquire(blocking)
+
+        if not acquired:
+            return False
+
+        self.locks.names().add(self.name)
+        self.tokens[self.stripe] += 1
+        self.token = int(self.tokens[self.stripe])
+
+        return True
+
+    def release(self):
+        self.token = None
+        self.locks.names().discard(self.name)
+        self.lock.release()
+
+    def check(self):
+        pass
+
+
+class FileLocks:
+    """
+    Keyed locks on lock files, for replicas sharing a directory. The file
+    keeps the fencing token.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        makedirs(directory, mode=0o700, exist_ok=True)
+
+    def get(self, array, key):
+        name = key_name(array, key)
+
+        return FileLock(name, path.join(self.directory,
+                '{digest}.lock'.format(digest=sha1(name.encode()).hexdigest())))
+
+
+class FileLock:
+    def __init__(self, name, filename):
+        self.name = name
+        self.filename = filename
+        self.fd = None
+        self.token = None
+
+    def acquire(self, blocking=True, deadline=None):
+        # a descriptor of its own, flock is held per open file
+        fd = os_open(self.filename, O_RDWR | O_CREAT, 0o600)
+
+        # flock can't time out, poll it when there's a deadline
+        if blocking and deadline is None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        else:
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if not blocking or time() >= deadline:
+                        close(fd)
+                        return False
+
+                    sleep(min(0.05, max(deadline - time(), 0)))
+
+        with open(fd, 'r+', closefd=False) as lockfile:
+            self.token = int(lockfile.read() or '0') + 1
+            lockfile.seek(0)
+            lockfile.truncate()
+            lockfile.write(str(self.token))
+
+        self.fd = fd
+
+        return True
+
+    def release(self):
+        fd, self.fd, self.token = self.fd, None, None
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        close(fd)
+
+    def check(self):
+        pass
+
+
+class LeaseLocks:
+    """
+    Keyed locks on Kubernetes Lease objects for replicas in different pods.
+    Held leases are renewed in the background, a lease that could not be
+    renewed within its duration is lost. The lease transition count is the
+    fencing token.
+
+    Expiry is judged by when this replica saw the lease record last change,
+    not by the renew time of the holder, clocks of pods needn't agree.
+    """
+
+    def __init__(self, namespace=None, duration=15, identity=None, url=None, poll=0.05):
+        self.namespace = namespace
+        self.duration = duration
+        self.identity = identity or gethostname()
+        self.url = url
+        self.poll = poll
+
+        self.held = {}
+        self.observed = {}
+        self.lock = Lock()
+        self.pid = None
+        self.sessions = local()
+        self.auth = None
+
+    def get(self, array, key):
+        name = key_name(array, key)
+
+        return Lease(self, name, 'truenas-csp-{digest}'.format(
+                digest=sha1(name.encode()).hexdigest()[:32]))
+
+    def _config(self):
+        if self.namespace is None:
+            with open(path.join(SERVICE_ACCOUNT, 'namespace')) as namespace:
+                self.namespace = namespace.read().strip()
+
+    def _headers(self):
+        # projected tokens are rotated, re-read them every minute
+        if not self.auth or time() - self.auth[1] > 60:
+            filename = path.join(SERVICE_ACCOUNT, 'token')
+            token = open(filename).read().strip() if path.exists(filename) else None
+            self.auth = ({ 'Authorization': 'Bearer {token}'.format(token=token) } if token else {}, time())
+
+        return self.auth[0]
+
+    def request(self, method, name=None, body=None):
+        self._config()
+
+        if getattr(self.sessions, 'pid', None) != getpid():
+            self.sessions.session = requests.Session()
+            self.sessions.pid = getpid()
+
+        ca = path.join(SERVICE_ACCOUNT, 'ca.crt')
+        uri = LEASES.format(namespace=self.namespace) + ('/' + name if name else '')
+
+        response = self.sessions.session.request(method, self.url + uri, json=body,
+                headers=self._headers(), verify=ca if path.exists(ca) else False, timeout=(5, 10))
+
+        return response.status_code, response.json() if response.content else {}
+
+    def expired(self, name, spec):
+        """
+        A lease whose record hasn't changed for its duration, as seen from
+        here, is free to take.
+        """
+        if not spec.get('holderIdentity'):
+            return True
+
+        record = (spec.get('holderIdentity'), spec.get('renewTime'), spec.get('leaseTransitions'))
+        now = monotonic()
+
+        with self.lock:
+            seen, since = self.observed.get(name, (None, now))
+
+            if seen != record:
+                self.observed[name] = (record, now)
+                since = now
+
+        return now - since > spec.get('leaseDurationSeconds', self.duration)
+
+    def _start(self):
+        if self.pid == getpid():
+            return
+
+        with self.lock:
+            if self.pid == getpid():
+                return
+            self.pid = getpid()
+            self.held = {}
+
+        Thread(target=self._renew, name='lease-renewal', daemon=True).start()
+
+    def _renew(self):
+        while True:
+            sleep(self.duration / 3)
+
+            with self.lock:
+                leases = list(self.held.values())
+
+            for lease in leases:
+                try:
+                    lease.renew()
+                except Exception as e:
+                    logger.error('Renewal of lease %s failed: %s', lease.name, e)
+
+
+def now_micro():
+    return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+class Lease:
+    def __init__(self, locks, name, lease_name):
+        self.locks = locks
+        self.name = name
+        self.lease_name = lease_name
+        self.identity = '{identity}/{pid}/{thread}/{nonce:08x}'.format(identity=locks.identity,
+                pid=getpid(), thread=get_ident(), nonce=random.getrandbits(32))
+        self.lease = None
+        self.renewed = None
+        self.lost = False
+        self.released = False
+        self.token = None
+
+    def spec(self, transitions):
+        return {
+            'holderIdentity': self.identity,
+            'leaseDurationSeconds': int(self.locks.duration),
+            'acquireTime': now_micro(),
+            'renewTime': now_micro(),
+            'leaseTransitions': transitions
+        }
+
+    def try_acquire(self):
+        started = monotonic()
+        status, lease = self.locks.request('GET', self.lease_name)
+
+        if status == 404:
+            status, lease = self.locks.request('POST', body={
+                'apiVersion': 'coordination.k8s.io/v1',
+                'kind': 'Lease',
+                'metadata': { 'name': self.lease_name, 'annotations': { 'truenas-csp/key': self.name } },
+                'spec': self.spec(1)
+            })
+        elif status == 200:
+            spec = lease.get('spec', {})
+
+            if not self.locks.expired(self.lease_name, spec):
+                return False
+
+            status, lease = self.locks.request('PUT', self.lease_name, body=dict(lease,
+                    spec=self.spec(spec.get('leaseTransitions', 0) + 1)))
+        else:
+            raise Lost('Lease {name} unavailable: {status}'.format(name=self.name, status=status))
+
+        # somebody else got there first
+        if status == 409:
+            return False
+
+        if status not in (200, 201):
+            raise Lost('Lease {name} unavailable: {status}'.format(name=self.name, status=status))
+
+        self.lease = lease
+        self.renewed = started
+        self.lost = False
+        self.released = False
+        self.token = lease.get('spec').get('leaseTransitions')
+
+        self.locks._start()
+
+        with self.locks.lock:
+            self.locks.held[self.identity] = self
+
+        return True
+
+    def acquire(self, blocking=True, deadline=None):
+        poll = self.locks.poll
+
+        while not self.try_acquire():
+            if not blocking:
+                return False
+
+            # the caller has given up, stop asking the apiserver
+            if deadline is not None and time() >= deadline:
+                return False
+
+            wait = poll * random.uniform(0.5, 1.5)
+
+            if deadline is not None:
+                wait = min(wait, max(deadline - time(), 0))
+
+            sleep(wait)
+            poll = min(poll * 2, 1.0)
+
+        return True
+
+    def renew(self):
+        started = monotonic()
+        lease = dict(self.lease, spec=dict(self.lease.get('spec'), renewTime=now_micro()))
+        status, lease = self.locks.request('PUT', self.lease_name, body=lease)
+
+        if status == 200:
+            self.lease = lease
+            self.renewed = started
+        elif status in (404, 409):
+            self._lose('taken over')
+
+    def _lose(self, reason):
+        if not self.lost and not self.released:
+            self.lost = True
+            metrics.LOCK_LOST.inc()
+            logger.error('Lease %s lost, %s', self.name, reason)
+
+        with self.locks.lock:
+            self.locks.held.pop(self.identity, None)
+
+    def check(self):
+        """
+        Raises Lost unless the lease is still ours for certain.
+        """
+        if not self.lost and monotonic() - self.renewed > self.locks.duration:
+            self._lose('not renewed in time')
+
+        if self.lost:
+            raise Lost('Lease {name} with token {token} lost'.format(name=self.name, token=self.token))
+
+    def release(self):
+        self.released = True
+
+        with self.locks.lock:
+            self.locks.held.pop(self.identity, None)
+
+        if self.lost:
+            return
+
+        # an empty holder is free to take right away
+        lease = dict(self.lease, spec=dict(self.lease.get('spec'), holderIdentity=None))
+
+        try:
+            self.locks.request('PUT', self.lease_name, body=lease)
+        except requests.RequestException as e:
+            logger.error('Release of lease %s failed, it expires: %s', self.name, e)
+
+
+def from_config(config):
+    if config.lock_backend == 'file':
+        return FileLocks(config.lock_dir)
+
+    if config.lock_backend == 'lease':
+        return LeaseLocks(namespace=config.lock_namespace, duration=config.lock_lease_duration,
+                          identity=config.lock_identity, url=config.kubernetes_url)
+
+    return LocalLocks()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+#
+# (C) Copyright 2024 Hewlett Packard Enterprise Development LP.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+from random import random
+import logging
+import json
+import re
+import config
+
+LOG_DEBUG = config.CONFIG.log_debug
+LOG_FORMAT = config.CONFIG.log_format
+
+TEXT_FORMAT = '%(asctime)s %(name)s %(process)d %(levelname)s %(message)s'
+DATE_FORMAT = '%a, %d %b %Y %H:%M:%S +0000'
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, self.datefmt),
+            'level': record.levelname,
+            'logger': record.name,
+            'pid': record.process,
+            'message': record.getMessage()
+        }
+
+        request_id = getattr(record, 'request_id', None)
+
+        if request_id:
+            entry['request_id'] = request_id
+
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+
+        return json.dumps(entry)
+
+
+def setup():
+    handler = logging.StreamHandler()
+
+    if LOG_FORMAT == 'json':
+        handler.setFormatter(JSONFormatter(datefmt=DATE_FORMAT))
+    else:
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT, datefmt=DATE_FORMAT))
+
+    logging.basicConfig(handlers=[ handler ])
+
+
+def get_logger(name):
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.DEBUG if LOG_DEBUG else logging.INFO)
+
+    return logger
+
+
+class RequestLogger(logging.LoggerAdapter):
+    """
+    Tags records with the request ID of the handler. Level checks happen
+    before any formatting, disabled levels cost one method call.
+    """
+
+    def __init__(self, logger, handler):
+        super(RequestLogger, self).__init__(logger, {})
+        self.handler = handler
+
+    def process(self, msg, kwargs):
+        kwargs['extra'] = { 'request_id': self.handler.request_id }
+
+        return msg, kwargs
+
+
+class PayloadSampling:
+    """
+    Decides which requests log request and response payloads at debug
+    level. Rates are keyed by method and route, routes not listed are
+    always logged.
+    """
+
+    def __init__(self, rates):
+        self.routes = []
+
+        for route, rate in rates.items():
+            method, template = route.split(' ', 1)
+            pattern = re.sub('{[^}]+}', '[^/]+', template)
+            self.routes.append((method, re.compile('^{pattern}$'.format(pattern=pattern)), float(rate)))
+
+    def sample(self, method, path):
+        if not LOG_DEBUG:
+            return False
+
+        for route_method, pattern, rate in self.routes:
+            if route_method == method and pattern.match(path):
+                return random() < rate
+
+        return True
+
+
+setup()
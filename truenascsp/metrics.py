@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+#
+# (C) Copyright 2024 Hewlett Packard Enterprise Development LP.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+from os import environ, makedirs
+from time import time
+import re
+import config
+
+# workers write to memory mapped files in here, any worker can serve the sum,
+# prometheus_client finds the directory in the environment
+environ['PROMETHEUS_MULTIPROC_DIR'] = config.CONFIG.metrics_dir
+makedirs(config.CONFIG.metrics_dir, exist_ok=True)
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import multiprocess, CONTENT_TYPE_LATEST
+from prometheus_client.core import GaugeMetricFamily
+
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+REQUEST_DURATION = Histogram('truenascsp_request_duration_seconds',
+        'CSP request duration', [ 'route', 'method', 'status' ],
+        buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 180))
+
+REQUEST_ROUND_TRIPS = Histogram('truenascsp_request_backend_round_trips',
+        'Backend round trips per CSP request', [ 'route', 'method' ],
+        buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89))
+
+BACKEND_DURATION = Histogram('truenascsp_backend_request_duration_seconds',
+        'Backend round trip duration', [ 'array', 'resource', 'verb' ],
+        buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+
+BACKEND_REQUESTS = Counter('truenascsp_backend_requests_total',
+        'Backend requests', [ 'array', 'resource', 'verb', 'code' ])
+
+LOCK_WAIT = Histogram('truenascsp_lock_wait_seconds',
+        'Time spent waiting for a lock', [ 'lock' ],
+        buckets=(0.001, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60))
+
+LOCK_LOST = Counter('truenascsp_lock_lost_total',
+        'Leases lost while held, writes under them are refused')
+
+PROFILE_FAILED = Counter('truenascsp_profile_failed_total',
+        'Performance profile updates refused by the backend', [ 'array', 'resource' ])
+
+SLEEPS = Counter('truenascsp_backend_sleeps_total',
+        'Sleeps between backend retries', [ 'loop' ])
+
+SLEEP_SECONDS = Counter('truenascsp_backend_sleep_seconds_total',
+        'Seconds slept between backend retries', [ 'loop' ])
+
+CACHE_REQUESTS = Counter('truenascsp_cache_requests_total',
+        'Cache lookups', [ 'cache', 'result' ])
+
+BULKHEAD_REJECTED = Counter('truenascsp_bulkhead_rejected_total',
+        'Requests rejected with all bulkhead slots of the array taken', [ 'array' ])
+
+RECONCILER_ORPHANS = Gauge('truenascsp_reconciler_orphans',
+        'Orphaned iSCSI objects found by the last reconciler pass', [ 'array', 'kind' ],
+        multiprocess_mode='mostrecent')
+
+RECONCILER_DELETED = Counter('truenascsp_reconciler_deleted_total',
+        'Orphaned iSCSI objects deleted', [ 'array', 'kind' ])
+
+RECONCILER_PASSES = Counter('truenascsp_reconciler_passes_total',
+        'Reconciler passes by mode or failure', [ 'array', 'result' ])
+
+resource_id = re.compile('/id/.*$')
+
+
+def backend_resource(uri):
+    # pool/dataset/id/tank%2fvol -> pool/dataset
+    return resource_id.sub('', uri)
+
+
+def acquire(lock, name, deadline=None):
+    started = time()
+    acquired = lock.acquire(deadline=deadline)
+    LOCK_WAIT.labels(name).observe(time() - started)
+
+    return acquired
+
+
+class SharedState:
+    """
+    Breaker, admission and bulkhead state already lives in shared memory,
+    it's read at scrape time.
+    """
+
+    def __init__(self, breaker, admission, bulkhead):
+        self.breaker = breaker
+        self.admission = admission
+        self.bulkhead = bulkhead
+
+    def collect(self):
+        breakers = GaugeMetricFamily('truenascsp_breaker_open',
+                'Circuit state, 0 closed, 1 open, 2 half-open', labels=[ 'array' ])
+        limits = GaugeMetricFamily('truenascsp_admission_limit',
+                'Concurrent requests admitted', labels=[ 'array' ])
+        running = GaugeMetricFamily('truenascsp_admission_running',
+                'Requests in flight', labels=[ 'array' ])
+        waiting = GaugeMetricFamily('truenascsp_admission_waiting',
+                'Requests waiting for admission', labels=[ 'array' ])
+        saturation = GaugeMetricFamily('truenascsp_bulkhead_saturation',
+                'Share of the bulkhead slots taken', labels=[ 'array' ])
+
+        states = { 'closed': 0, 'open': 1, 'half-open': 2 }
+
+        for array, status in self.breaker.status().items():
+            breakers.add_metric([ array ], states.get(status.get('state')))
+
+        for array, status in self.admission.status().items():
+            limits.add_metric([ array ], status.get('limit'))
+            running.add_metric([ array ], status.get('running'))
+            waiting.add_metric([ array ], status.get('waiting'))
+
+        for array, status in self.bulkhead.status().items():
+            saturation.add_metric([ array ], status.get('saturation'))
+
+        return [ breakers, limits, running, waiting, saturation ]
+
+
+def exposition(*collectors):
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+
+    for collector in collectors:
+        registry.register(collector)
+
+    return generate_latest(registry)
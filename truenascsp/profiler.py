@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+
+#
+# (C) Copyright 2024 Hewlett Packard Enterprise Development LP.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+from os import getpid, makedirs, path, listdir, remove
+from time import time, sleep
+from threading import Lock, Thread, Timer, get_ident
+from random import random
+from uuid import uuid4
+import sys
+import io
+import cProfile
+import pstats
+import config
+
+PROFILE_DIR = config.CONFIG.profile_dir
+makedirs(PROFILE_DIR, exist_ok=True)
+
+MODES = [ 'sample', 'cprofile' ]
+
+SORT_KEYS = sorted(pstats.Stats.sort_arg_dict_default)
+
+
+class Busy(Exception):
+    pass
+
+
+def result_path(capture_id, suffix):
+    return path.join(PROFILE_DIR, '{id}.{suffix}'.format(id=capture_id, suffix=suffix))
+
+
+def collapse(frame):
+    stack = []
+
+    while frame:
+        code = frame.f_code
+        stack.append('{file}:{func}'.format(file=path.basename(code.co_filename), func=code.co_name))
+        frame = frame.f_back
+
+    return ';'.join(reversed(stack))
+
+
+class Profiler:
+    """
+    One capture at a time per worker. Results are written to PROFILE_DIR so
+    any worker may serve them.
+
+    The sampler backs off to keep the time spent sampling below max_overhead
+    of the capture. cProfile captures profile up to max_overhead of the
+    requests served by the worker until the capture ends, one request at a
+    time: only one profiler may be active in the interpreter since Python
+    3.12, requests overlapping the profiled one are served without a
+    profiler. Sampled requests are written out every flush_interval seconds.
+    """
+
+    def __init__(self, max_seconds, max_overhead, interval, sample_percent, flush_interval=10):
+        self.max_seconds = max_seconds
+        self.max_overhead = max_overhead
+        self.interval = interval
+        self.sample_percent = sample_percent
+        self.flush_interval = flush_interval
+        self.lock = Lock()
+        self.flushing = Lock()
+        self.flushed = 0
+        self.capture = None
+        self.in_flight = 0
+        self.active = False
+        self.sampled = None
+
+    def start(self, mode, seconds):
+        if mode not in MODES:
+            raise ValueError('Unknown profiling mode: {mode}'.format(mode=mode))
+
+        seconds = min(float(seconds), self.max_seconds)
+
+        with self.lock:
+            if self.capture:
+                raise Busy('Capture {id} already running in worker {pid}'.format(
+                    id=self.capture.get('id'), pid=getpid()))
+
+            self.capture = {
+                'id': uuid4().hex,
+                'mode': mode,
+                'seconds': seconds,
+                'until': time() + seconds,
+                'stats': None,
+                'stacks': {},
+                'samples': 0,
+                'overhead': 0.0,
+                'requests': 0,
+                'profiled': 0
+            }
+            capture = self.capture
+
+        open(result_path(capture.get('id'), 'running'), 'w').close()
+
+        if mode == 'sample':
+            Thread(target=self._sample, args=(capture,), daemon=True).start()
+        else:
+            Timer(seconds, self._finish_if_due).start()
+
+        return {
+            'id': capture.get('id'),
+            'mode': mode,
+            'seconds': seconds,
+            'pid': getpid()
+        }
+
+    def _sample(self, capture):
+        started = time()
+        interval = self.interval
+
+        while time() < capture.get('until'):
+            sleep(interval)
+            before = time()
+
+            for ident, frame in sys._current_frames().items():
+                if ident == get_ident():
+                    continue
+
+                stack = collapse(frame)
+                capture['stacks'][stack] = capture['stacks'].get(stack, 0) + 1
+
+            capture['samples'] += 1
+            cost = time() - before
+            capture['overhead'] += cost
+
+            # hard cap, sample less often if sampling got expensive
+            interval = max(self.interval, cost / self.max_overhead)
+
+        elapsed = time() - started
+
+        with open(result_path(capture.get('id'), 'collapsed'), 'w') as f:
+            f.write('# {samples} samples in {elapsed:.1f}s, {overhead:.2%} overhead\n'.format(
+                samples=capture.get('samples'), elapsed=elapsed,
+                overhead=capture.get('overhead') / elapsed))
+            for stack, count in sorted(capture.get('stacks').items(), key=lambda s: -s[1]):
+                f.write('{stack} {count}\n'.format(stack=stack, count=count))
+
+        self._done(capture)
+
+    def _done(self, capture):
+        with self.lock:
+            if self.capture is capture:
+                self.capture = None
+
+        try:
+            remove(result_path(capture.get('id'), 'running'))
+        except FileNotFoundError:
+            pass
+
+    def _finish_if_due(self):
+        with self.lock:
+            capture = self.capture
+
+            # requests still profiling add to the stats
+            if not capture or capture.get('mode') != 'cprofile' or \
+                    time() < capture.get('until') or self.in_flight:
+                return
+
+            self.capture = None
+
+        (capture.get('stats') or cProfile.Profile()).dump_stats(result_path(capture.get('id'), 'pstats'))
+        self._done(capture)
+
+    def enable(self):
+        """
+        Called before a request is served, returns what to pass to disable.
+        """
+        with self.lock:
+            capture = self.capture
+
+            if capture and capture.get('mode') == 'cprofile' and time() < capture.get('until'):
+                capture['requests'] += 1
+
+                # profiled requests run slower, only a share of them is
+                if capture.get('profiled') >= max(1, capture.get('requests') * self.max_overhead):
+                    return None
+            elif self.sample_percent and random() * 100 < self.sample_percent:
+                capture = None
+            else:
+                return None
+
+            if self.active:
+                return None
+
+            profile = cProfile.Profile()
+
+            try:
+                profile.enable()
+            except ValueError:
+                # another profiling tool, a debugger or coverage
+                return None
+
+            self.active = True
+
+            if capture:
+                capture['profiled'] += 1
+                self.in_flight += 1
+
+            return capture, profile
+
+    def disable(self, profiling):
+        if not profiling:
+            return
+
+        capture, profile = profiling
+        profile.disable()
+
+        with self.lock:
+            self.active = False
+
+        stats = pstats.Stats(profile)
+
+        if capture is None:
+            with self.lock:
+                if self.sampled is None:
+                    self.sampled = stats
+                else:
+                    self.sampled.add(stats)
+
+            self.flush()
+        else:
+            with self.lock:
+                if capture.get('stats') is None:
+                    capture['stats'] = stats
+                else:
+                    capture['stats'].add(stats)
+
+                self.in_flight -= 1
+
+            self._finish_if_due()
+
+    def flush(self, force=False):
+        """
+        Adds the requests sampled since the last flush to the pstats of this
+        worker, at most every flush_interval seconds unless forced. Requests
+        go on while the file is written.
+        """
+        if not self.flushing.acquire(blocking=force):
+            return
+
+        try:
+            with self.lock:
+                if self.sampled is None or (not force and time() - self.flushed < self.flush_interval):
+                    return
+
+                sampled, self.sampled = self.sampled, None
+                self.flushed = time()
+
+            filename = result_path('auto-{pid}'.format(pid=getpid()), 'pstats')
+
+            if path.exists(filename):
+                sampled.add(filename)
+
+            sampled.dump_stats(filename)
+        finally:
+            self.flushing.release()
+
+
+def running(capture_id):
+    return path.exists(result_path(capture_id, 'running'))
+
+
+def result(capture_id, sort='cumulative', limit=50):
+    """
+    Returns the capture as text, None if there's no such capture.
+    """
+    collapsed = result_path(capture_id, 'collapsed')
+
+    if path.exists(collapsed):
+        with open(collapsed) as f:
+            return f.read()
+
+    if capture_id == 'auto':
+        files = [ path.join(PROFILE_DIR, name) for name in listdir(PROFILE_DIR)
+                  if name.startswith('auto-') and name.endswith('.pstats') ]
+    else:
+        files = [ result_path(capture_id, 'pstats') ]
+
+    files = [ name for name in files if path.exists(name) ]
+
+    if not files:
+        return None
+
+    out = io.StringIO()
+    stats = pstats.Stats(*files, stream=out)
+    stats.sort_stats(sort).print_stats(limit)
+
+    return out.getvalue()
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+
+#
+# (C) Copyright 2024 Hewlett Packard Enterprise Development LP.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+from os import getpid
+from time import time, sleep
+from threading import Lock, Thread
+from multiprocessing import Lock as SharedLock
+from shared import Table, array_key
+import traceback
+import re
+import backend
+import logs
+import metrics
+
+logger = logs.get_logger(__name__)
+
+host_uuid = re.compile('^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$', re.IGNORECASE)
+
+KINDS = [ 'targetextent', 'extent', 'target', 'initiator' ]
+
+
+class Reconciler:
+    """
+    Finds iSCSI objects left behind by interrupted provisioning, unpublish
+    and delete runs and reports or deletes them. One worker at a time runs
+    a pass, arrays are visited at most once per interval across workers.
+
+    Arrays and credentials are learned from authenticated requests, an
+    array nobody talks to is left alone.
+    """
+
+    def __init__(self, mode, interval, max_deletes, delay, abandon_after=3600, deadline=170, arrays=16):
+        self.mode = mode
+        self.deadline = deadline
+        self.abandon_after = abandon_after
+        self.interval = interval
+        self.max_deletes = max_deletes
+        self.delay = delay
+        self.credentials = {}
+        self.lock = Lock()
+        self.pid = None
+
+        # created before gunicorn forks, shared by all workers
+        self.leader = SharedLock()
+        self.passes = Table(arrays, [ 'key', 'last' ])
+
+    def register(self, array, token):
+        if self.mode not in ('dry-run', 'delete'):
+            return
+
+        self.credentials[array] = token
+        self._start()
+
+    def _start(self):
+        if self.pid == getpid():
+            return
+
+        with self.lock:
+            if self.pid == getpid():
+                return
+            self.pid = getpid()
+
+        Thread(target=self._loop, name='reconciler', daemon=True).start()
+
+    def _loop(self):
+        while True:
+            sleep(min(self.interval, 60))
+
+            for array, token in list(self.credentials.items()):
+                if not self.leader.acquire(block=False):
+                    break
+
+                try:
+                    row = self.passes.row(array_key(array))
+
+                    if time() - self.passes.get(row, 'last') < self.interval:
+                        continue
+
+                    self.passes.set(row, 'last', time())
+
+                    # other replicas pass on an array being reconciled
+                    passing = backend.LOCKS.get(array, 'reconciler')
+
+                    if not passing.acquire(blocking=False):
+                        continue
+
+                    try:
+                        self.reconcile(array, token)
+                    finally:
+                        passing.release()
+                except Exception:
+                    metrics.RECONCILER_PASSES.labels(array, 'failed').inc()
+                    logger.error('Reconciliation of %s failed: %s', array, traceback.format_exc())
+                finally:
+                    self.leader.release()
+
+    def handler(self, array, token):
+        api = backend.Handler()
+        api.backend = array
+        api.token = token
+
+        return api
+
+    def orphans(self, api):
+        """
+        Returns the CSI managed iSCSI objects without a zvol, by kind.
+        """
+        # iSCSI objects first, anything created after the zvol listing belongs to a zvol in it
+        targets = api.fetch('iscsi/target', returnBy=list)
+        extents = api.fetch('iscsi/extent', returnBy=list)
+        targetextents = api.fetch('iscsi/targetextent', returnBy=list)
+        initiators = api.fetch('iscsi/initiator', returnBy=list)
+        portal = api.fetch('iscsi/portal', field='comment', value=api.target_portal, returnBy=dict)
+        zvols = api.fetch('pool/dataset', field='type', value='VOLUME', select=[ 'id', 'type' ], returnBy=list)
+
+        if None in (targets, extents, targetextents, initiators, portal, zvols):
+            raise backend.BackendUnavailable('Incomplete listing from {array}'.format(array=api.backend))
+
+        zvol_ids = set(zvol.get('id') for zvol in zvols)
+        zvol_names = set(api.xlst_name_from_id(zvol_id) for zvol_id in zvol_ids)
+
+        orphans = {}
+
+        orphans['extent'] = [ extent for extent in extents
+                if extent.get('comment') == 'Managed by HPE CSI Driver for Kubernetes' and
+                str(extent.get('disk', '')).startswith('zvol/') and
+                extent.get('disk')[len('zvol/'):] not in zvol_ids ]
+
+        orphan_extents = set(extent.get('id') for extent in orphans.get('extent'))
+        extent_ids = set(extent.get('id') for extent in extents) - orphan_extents
+        mapped = set(te.get('target') for te in targetextents if te.get('extent') in extent_ids)
+
+        # only targets shaped like ours, named after a zvol and grouped with our portal,
+        # targets without groups may still be in the making
+        orphans['target'] = [ target for target in targets
+                if target.get('name') not in zvol_names and target.get('id') not in mapped and
+                target.get('groups') and
+                all(group.get('portal') == portal.get('id') for group in target.get('groups')) ]
+
+        target_ids = set(target.get('id') for target in targets) - \
+                set(target.get('id') for target in orphans.get('target'))
+
+        orphans['targetextent'] = [ te for te in targetextents
+                if te.get('extent') not in extent_ids or te.get('target') not in target_ids ]
+
+        grouped = set(group.get('initiator') for target in targets if target.get('id') in target_ids
+                      for group in target.get('groups', []))
+        abandoned = set(group.get('initiator') for target in orphans.get('target')
+                        for group in target.get('groups', []))
+
+        # host initiators are named by node UUID, access initiators after the zvol,
+        # initiators nobody orphaned are left alone
+        orphans['initiator'] = [ initiator for initiator in initiators
+                if initiator.get('id') in abandoned and initiator.get('id') not in grouped and
+                not host_uuid.match(str(initiator.get('comment'))) and
+                initiator.get('comment') not in zvol_names ]
+
+        return orphans
+
+    def zvol_name(self, api, kind, orphan):
+        if kind == 'extent':
+            return api.xlst_name_from_id(orphan.get('disk'))
+        elif kind == 'target':
+            return orphan.get('name')
+        elif kind == 'initiator':
+            return orphan.get('comment')
+        elif kind == 'targetextent':
+            extent = api.fetch('iscsi/extent', field='id', value=orphan.get('extent'), returnBy=dict)
+
+            if extent:
+                return self.zvol_name(api, 'extent', extent)
+
+            target = api.fetch('iscsi/target', field='id', value=orphan.get('target'), returnBy=dict)
+
+            if target:
+                return target.get('name')
+
+        return None
+
+    def rollback(self, api, array):
+        """
+        Operations interrupted and not retried are rolled back before
+        looking for orphans, their objects are known for certain.
+        """
+        abandoned = backend.JOURNAL.abandoned(array, self.abandon_after)
+        metrics.RECONCILER_ORPHANS.labels(array, 'journal').set(len(abandoned))
+
+        for entry in abandoned:
+            logger.info('Abandoned %s of %s on %s: %s', entry.content.get('operation'),
+                        entry.content.get('name'), array, entry.content.get('steps'))
+
+            if self.mode != 'delete':
+                continue
+
+            lock = self.hold(api, entry.content.get('name'))
+
+            try:
+                if api.rollback(entry):
+                    metrics.RECONCILER_DELETED.labels(array, 'journal').inc()
+            finally:
+                self.release(api, lock)
+
+    def hold(self, api, name):
+        """
+        Takes the volume lock of name, the work done under it has to be
+        over within the deadline.
+        """
+        lock = backend.LOCKS.get(api.backend, 'volume/{name}'.format(name=name))
+        api.deadline = time() + self.deadline
+        api.hold(lock, 'reconciler')
+
+        return lock
+
+    def release(self, api, lock):
+        api.release(lock)
+        api.deadline = None
+
+    def mapped(self, api, orphan):
+        """
+        Whether the target and extent of a target extent are both still
+        there, None if either couldn't be fetched.
+        """
+        target = api.fetch('iscsi/target', field='id', value=orphan.get('target'), returnBy=dict)
+        extent = api.fetch('iscsi/extent', field='id', value=orphan.get('extent'), returnBy=dict)
+
+        if None in (target, extent):
+            return None
+
+        return bool(target and extent)
+
+    def delete(self, api, kind, orphan):
+        """
+        Deletes an orphan unless a zvol of its name turned up since the
+        listing. Publish and unpublish of that name must not interleave,
+        target extents are named after the zvol of their extent. A target
+        extent created between the listings of targets, extents and target
+        extents looks orphaned, it's kept while its target and extent are
+        both there and the zvol exists.
+        """
+        name = self.zvol_name(api, kind, orphan)
+        lock = self.hold(api, name) if name else None
+
+        try:
+            if kind == 'targetextent':
+                mapped = self.mapped(api, orphan)
+
+                if mapped is None or (mapped and api.zvol_exists(name)):
+                    return False
+            elif name and api.zvol_exists(name):
+                return False
+
+            api.delete('iscsi/{kind}/id/{id}'.format(kind=kind, id=orphan.get('id')))
+        finally:
+            if lock:
+                self.release(api, lock)
+
+        return True
+
+    def reconcile(self, array, token):
+        api = self.handler(array, token)
+        self.rollback(api, array)
+        orphans = self.orphans(api)
+        deletes = 0
+
+        for kind in KINDS:
+            metrics.RECONCILER_ORPHANS.labels(array, kind).set(len(orphans.get(kind)))
+
+            for orphan in orphans.get(kind):
+                logger.info('Orphaned %s on %s: %s', kind, array,
+                            orphan.get('name', orphan.get('comment', orphan.get('id'))))
+
+        if self.mode == 'delete':
+            for kind in KINDS:
+                for orphan in orphans.get(kind):
+                    if deletes >= self.max_deletes:
+                        break
+
+                    if self.delete(api, kind, orphan):
+                        metrics.RECONCILER_DELETED.labels(array, kind).inc()
+                        deletes += 1
+                        sleep(self.delay)
+
+        metrics.RECONCILER_PASSES.labels(array, self.mode).inc()
+        logger.info('Reconciled %s (%s): %s', array, self.mode,
+                    ', '.join('{n} {kind}s'.format(n=len(orphans.get(kind)), kind=kind) for kind in KINDS))
+
+        return orphans
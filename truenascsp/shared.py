@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+#
+# (C) Copyright 2024 Hewlett Packard Enterprise Development LP.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+from os import kill
+from zlib import crc32
+from multiprocessing import Array
+
+
+class Table:
+    """
+    Fixed size table of doubles in shared memory. Created before gunicorn
+    forks its workers, all workers see the same rows.
+    """
+
+    def __init__(self, rows, fields):
+        self.fields = fields
+        self.rows = rows
+        self.data = Array('d', rows * len(fields), lock=False)
+
+    def get(self, row, field):
+        return self.data[row * len(self.fields) + self.fields.index(field)]
+
+    def set(self, row, field, value):
+        self.data[row * len(self.fields) + self.fields.index(field)] = value
+
+    def row(self, key, **kwargs):
+        """
+        Finds or claims the row for key, the "key" field must come first.
+        Claimed rows are initialized with kwargs.
+        """
+        for row in range(self.rows):
+            if self.get(row, 'key') == key:
+                return row
+
+        for row in range(self.rows):
+            if not self.get(row, 'key'):
+                self.set(row, 'key', key)
+                for field, value in kwargs.items():
+                    self.set(row, field, value)
+                return row
+
+        # table is full, share a row
+        return int(key) % self.rows
+
+
+def array_key(array):
+    # zero marks an unused row
+    return crc32(array.encode()) + 1
+
+
+def pid_alive(pid):
+    try:
+        kill(int(pid), 0)
+    except OSError:
+        return False
+
+    return True
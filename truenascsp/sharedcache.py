@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+#
+# (C) Copyright 2024 Hewlett Packard Enterprise Development LP.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+from os import getpid, makedirs, path
+from time import time
+from threading import local
+import sqlite3
+import json
+import logs
+
+logger = logs.get_logger(__name__)
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS entries (array TEXT, resource TEXT, key TEXT, value TEXT,
+       stored REAL, PRIMARY KEY (array, resource, key)) WITHOUT ROWID''',
+    '''CREATE TABLE IF NOT EXISTS generations (array TEXT, resource TEXT, generation INTEGER,
+       PRIMARY KEY (array, resource)) WITHOUT ROWID'''
+]
+
+
+class SharedCache:
+    """
+    Backend lookups shared by all workers in a SQLite database, kept in
+    /dev/shm where available. Writes to a resource bump its generation,
+    lookups that started before the write aren't stored. A failing cache
+    is a miss, never an error.
+    """
+
+    def __init__(self, directory, max_entries, prune_every=100):
+        self.enabled = bool(directory)
+        self.filename = path.join(directory, 'cache.sqlite') if self.enabled else None
+        self.max_entries = max_entries
+        self.prune_every = prune_every
+        self.connections = local()
+        self.sets = 0
+
+        if self.enabled:
+            makedirs(directory, mode=0o700, exist_ok=True)
+
+    def _db(self):
+        # connections don't survive fork and aren't shared between threads
+        if getattr(self.connections, 'pid', None) != getpid():
+            db = sqlite3.connect(self.filename, timeout=5, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=OFF')
+
+            for statement in SCHEMA:
+                db.execute(statement)
+
+            self.connections.db = db
+            self.connections.pid = getpid()
+
+        return self.connections.db
+
+    def _run(self, statement, *args):
+        if not self.enabled:
+            return []
+
+        try:
+            return self._db().execute(statement, args).fetchall()
+        except sqlite3.Error as e:
+            logger.error('Shared cache failed: %s', e)
+            return []
+
+    def generation(self, array, resource):
+        row = self._run('SELECT generation FROM generations WHERE array = ? AND resource = ?',
+                        array, resource)
+
+        return row[0][0] if row else 0
+
+    def get(self, array, resource, key, ttl):
+        """
+        Returns a tuple of value and the time it was stored, or None.
+        """
+        row = self._run('SELECT value, stored FROM entries WHERE array = ? AND resource = ? AND key = ?',
+                        array, resource, key)
+
+        if not row or time() - row[0][1] > ttl:
+            return None
+
+        return json.loads(row[0][0]), row[0][1]
+
+    def set(self, array, resource, key, value, generation=None):
+        """
+        Stores value unless resource was written since generation was read.
+        """
+        if generation is None:
+            generation = self.generation(array, resource)
+
+        self._run('''INSERT OR REPLACE INTO entries (array, resource, key, value, stored)
+                     SELECT ?, ?, ?, ?, ? WHERE COALESCE((SELECT generation FROM generations
+                     WHERE array = ? AND resource = ?), 0) = ?''',
+                  array, resource, key, json.dumps(value), time(), array, resource, generation)
+
+        self.sets += 1
+
+        if self.sets % self.prune_every == 0:
+            self._run('''DELETE FROM entries WHERE (array, resource, key) IN (SELECT array, resource, key
+                         FROM entries ORDER BY stored DESC LIMIT -1 OFFSET ?)''', self.max_entries)
+
+    def invalidate(self, array, resource):
+        self._run('''INSERT INTO generations (array, resource, generation) VALUES (?, ?, 1)
+                     ON CONFLICT (array, resource) DO UPDATE SET generation = generation + 1''',
+                  array, resource)
+        self._run('DELETE FROM entries WHERE array = ? AND resource = ?', array, resource)
+
+    def count(self):
+        """
+        Number of cached lookups per array.
+        """
+        return { array: entries for array, entries in
+                 self._run('SELECT array, COUNT(*) FROM entries GROUP BY array') }
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+#
+# (C) Copyright 2024 Hewlett Packard Enterprise Development LP.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+import codecs
+import json
+import re
+
+decoder = json.JSONDecoder()
+whitespace = re.compile(r'\s*')
+separators = re.compile(r'[\s,]*')
+
+
+def items(chunks, max_length=None):
+    """
+    Yields the elements of a JSON array as they arrive in chunks of bytes,
+    only the element being parsed and the chunk it's in are held. An element
+    longer than max_length characters raises ValueError. A document that
+    isn't an array is yielded whole.
+    """
+    chunks = iter(chunks)
+    text = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    position = 0
+    array = None
+    exhausted = False
+
+    # an element cut off by the end of the buffer is tried again once twice
+    # as much of it arrived, large elements aren't decoded once per chunk
+    attempt = 0
+
+    while True:
+        position = (separators if array else whitespace).match(buffer, position).end()
+        pending = len(buffer) - position
+
+        if pending and (pending >= attempt or exhausted):
+            if array is None:
+                if buffer[position] != '[':
+                    # not a list, nothing to gain from parsing it piecemeal
+                    for chunk in chunks:
+                        buffer += text.decode(chunk)
+
+                        if max_length and len(buffer) > max_length:
+                            raise ValueError('JSON document longer than {max_length}'.format(max_length=max_length))
+
+                    yield json.loads(buffer[position:] + text.decode(b'', final=True))
+                    return
+
+                array = True
+                position += 1
+                continue
+
+            if buffer[position] == ']':
+                return
+
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                if exhausted:
+                    raise
+            else:
+                # a number cut off by the chunk boundary decodes too, wait for what follows
+                following = whitespace.match(buffer, end).end()
+
+                if buffer[following:following + 1] in (',', ']') or exhausted:
+                    yield item
+                    position = end
+                    attempt = 0
+                    continue
+
+            attempt = 2 * pending
+
+        if exhausted:
+            raise ValueError('Truncated JSON document')
+
+        if max_length and pending > max_length:
+            raise ValueError('JSON element longer than {max_length}'.format(max_length=max_length))
+
+        chunk = next(chunks, None)
+        buffer = buffer[position:] + text.decode(chunk or b'', final=chunk is None)
+        position = 0
+        exhausted = chunk is None
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+#
+# (C) Copyright 2024 Hewlett Packard Enterprise Development LP.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+from os import getpid, urandom
+from time import time
+from threading import Lock
+from contextlib import contextmanager
+import re
+
+traceparent = re.compile('^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+
+
+def new_id(size):
+    return urandom(size).hex()
+
+
+class Trace:
+    """
+    Spans of a single CSI request. The root span is the request itself,
+    backend calls and sleeps are children of whatever span is open.
+    """
+
+    def __init__(self):
+        self.trace_id = new_id(16)
+        self.parent_id = None
+        self.root = {
+            'span_id': new_id(8),
+            'parent_id': None,
+            'name': 'request',
+            'start': time(),
+            'duration': None,
+            'attributes': {}
+        }
+        self.spans = [ self.root ]
+        self.stack = [ self.root ]
+
+    def adopt(self, header):
+        """
+        Joins the trace of the caller from a W3C traceparent header.
+        """
+        match = traceparent.match(header or '')
+
+        if match and int(match.group(1), 16) and int(match.group(2), 16):
+            self.trace_id = match.group(1)
+            self.parent_id = match.group(2)
+            self.root['parent_id'] = self.parent_id
+
+    def traceparent(self):
+        return '00-{trace}-{span}-01'.format(trace=self.trace_id, span=self.root.get('span_id'))
+
+    @contextmanager
+    def span(self, name, **attributes):
+        span = {
+            'span_id': new_id(8),
+            'parent_id': self.stack[-1].get('span_id'),
+            'name': name,
+            'start': time(),
+            'duration': None,
+            'attributes': attributes
+        }
+        self.spans.append(span)
+        self.stack.append(span)
+
+        try:
+            yield span
+        except Exception as e:
+            span['attributes']['error'] = type(e).__name__
+            raise
+        finally:
+            span['duration'] = time() - span.get('start')
+            self.stack.pop()
+
+    def finish(self, name, **attributes):
+        self.root['name'] = name
+        self.root['attributes'].update(attributes)
+        self.root['duration'] = time() - self.root.get('start')
+
+    def duration(self):
+        return self.root.get('duration') or 0.0
+
+    def waterfall(self):
+        start = self.root.get('start')
+
+        return {
+            'trace_id': self.trace_id,
+            'pid': getpid(),
+            'name': self.root.get('name'),
+            'started': start,
+            'duration_ms': round(self.duration() * 1000, 1),
+            'spans': [ {
+                'span_id': span.get('span_id'),
+                'parent_id': span.get('parent_id'),
+                'name': span.get('name'),
+                'offset_ms': round((span.get('start') - start) * 1000, 1),
+                'duration_ms': round((span.get('duration') or 0.0) * 1000, 1),
+                'attributes': span.get('attributes')
+            } for span in self.spans ]
+        }
+
+    def text(self, width=60):
+        total = self.duration() or 1e-9
+        start = self.root.get('start')
+        depth = { self.root.get('span_id'): 0 }
+        lines = [ '{trace} {name} {ms:.1f}ms'.format(trace=self.trace_id,
+                  name=self.root.get('name'), ms=self.duration() * 1000) ]
+
+        for span in self.spans:
+            level = depth.get(span.get('parent_id'), -1) + 1
+            depth[span.get('span_id')] = level
+            offset = int((span.get('start') - start) / total * width)
+            length = max(1, int((span.get('duration') or 0.0) / total * width))
+            attributes = ' '.join('{k}={v}'.format(k=k, v=v) for k, v in span.get('attributes').items())
+
+            lines.append('{bar:<{width}} {ms:>9.1f}ms {indent}{name} {attributes}'.format(
+                bar=' ' * offset + '#' * length, width=width + 1,
+                ms=(span.get('duration') or 0.0) * 1000, indent='  ' * level,
+                name=span.get('name'), attributes=attributes).rstrip())
+
+        return '\n'.join(lines)
+
+    def otlp(self):
+        def value(v):
+            if isinstance(v, bool):
+                return { 'boolValue': v }
+            if isinstance(v, int):
+                return { 'intValue': str(v) }
+            if isinstance(v, float):
+                return { 'doubleValue': v }
+            return { 'stringValue': str(v) }
+
+        return [ {
+            'traceId': self.trace_id,
+            'spanId': span.get('span_id'),
+            'parentSpanId': span.get('parent_id') or '',
+            'name': span.get('name'),
+            'kind': 2 if span is self.root else 3,
+            'startTimeUnixNano': str(int(span.get('start') * 1e9)),
+            'endTimeUnixNano': str(int((span.get('start') + (span.get('duration') or 0.0)) * 1e9)),
+            'attributes': [ { 'key': k, 'value': value(v) } for k, v in span.get('attributes').items() ]
+        } for span in self.spans ]
+
+
+class SlowestTraces:
+    """
+    Keeps the slowest traces finished within the window. Per worker.
+    """
+
+    def __init__(self, size, window):
+        self.size = size
+        self.window = window
+        self.traces = []
+        self.lock = Lock()
+
+    def add(self, trace):
+        with self.lock:
+            cutoff = time() - self.window
+            self.traces = [ t for t in self.traces if t.root.get('start') >= cutoff ]
+
+            if len(self.traces) >= self.size and \
+                    trace.duration() <= self.traces[-1].duration():
+                return
+
+            self.traces.append(trace)
+            self.traces.sort(key=lambda t: t.duration(), reverse=True)
+            del self.traces[self.size:]
+
+    def get(self):
+        with self.lock:
+            return list(self.traces)
+
+
+def otlp(traces, service='truenas-csp'):
+    """
+    OTLP/JSON export request body.
+    """
+    return {
+        'resourceSpans': [ {
+            'resource': {
+                'attributes': [ { 'key': 'service.name', 'value': { 'stringValue': service } } ]
+            },
+            'scopeSpans': [ {
+                'scope': { 'name': 'truenascsp' },
+                'spans': [ span for trace in traces for span in trace.otlp() ]
+            } ]
+        } ]
+    }
@@ -23,26 +23,98 @@
 #
 
 from time import time
-from time import sleep
-from multiprocessing import Lock
 import re
 import traceback
 import json
 import falcon
 import backend
+import cache
+import metrics
+import tracing
+import profiler
+import reconciler
+
+def load_capacity(array, token, root):
+    api = backend.Handler()
+    api.backend = array
+    api.token = token
+
+    return api.root_capacity(root)
+
+
+def load_statistics(array, token, root):
+    api = backend.Handler()
+    api.backend = array
+    api.token = token
+
+    return api.root_statistics(root)
+
+
+def ping(array, token, timeout):
+    api = backend.Handler()
+    api.backend = array
+    api.token = token
+    api.deadline = time() + timeout
+
+    response = api.get('core/ping')
+
+    return response is not None and response.status_code < 500
+
+
+def prewarm(array, token=backend.CONFIG.prewarm_token):
+    api = backend.Handler()
+    api.backend = array
+    api.token = token
+
+    # facts every publish and create asks for
+    api.version()
+    api.discovery_ips()
+    api.fetch('iscsi/global')
+    api.fetch('interface')
+
+    root = api.dataset_defaults.get('root')
+    api.lookup('pool/dataset', 'id', root)
+    capacity_cache.get((array, root), array, token, root)
+
+    reconciling.register(array, token)
+    backend.HEALTH.register(array, token)
+
+
+capacity_cache = cache.RefreshCache('capacity', load_capacity,
+        interval=backend.CONFIG.capacity_refresh_interval,
+        staleness=backend.CONFIG.capacity_max_staleness,
+        store=backend.SHARED_CACHE)
+
+statistics_cache = cache.RefreshCache('statistics', load_statistics,
+        interval=backend.CONFIG.statistics_refresh_interval,
+        staleness=backend.CONFIG.statistics_max_staleness,
+        store=backend.SHARED_CACHE)
+
+profiling = profiler.Profiler(max_seconds=backend.CONFIG.profile_max_seconds,
+        max_overhead=backend.CONFIG.profile_max_overhead,
+        interval=backend.CONFIG.profile_interval,
+        sample_percent=backend.CONFIG.profile_sample_percent)
+
+slow_traces = tracing.SlowestTraces(size=backend.CONFIG.trace_slowest,
+        window=backend.CONFIG.trace_window)
+
+reconciling = reconciler.Reconciler(mode=backend.CONFIG.reconcile_mode,
+        interval=backend.CONFIG.reconcile_interval,
+        max_deletes=backend.CONFIG.reconcile_max_deletes,
+        delay=backend.CONFIG.reconcile_delete_delay,
+        abandon_after=backend.CONFIG.journal_abandon_after,
+        deadline=backend.CONFIG.default_deadline)
 
-publish_lock = Lock()
-unpublish_lock = Lock()
-hosts_lock = Lock()
 
 class Unpublish:
     def on_put(self, req, resp, volume_id):
-        unpublish_lock.acquire()
         api = req.context
+        lock = backend.LOCKS.get(api.backend, 'volume/' + api.xslt_volume_id_to_name(volume_id))
         content = req.media
-        system_version = api.version()
 
         try:
+            api.hold(lock, 'unpublish')
+            system_version = api.version()
             dataset_name = api.xslt_volume_id_to_name(volume_id)
             access_name = api.access_name.format(dataset_name=dataset_name)
 
@@ -109,15 +181,16 @@ class Unpublish:
             resp.status = falcon.HTTP_500
 
         finally:
-            unpublish_lock.release()
+            api.release(lock)
 
 
 class Publish:
     def on_put(self, req, resp, volume_id):
-        publish_lock.acquire()
         api = req.context
+        lock = backend.LOCKS.get(api.backend, 'volume/' + api.xslt_volume_id_to_name(volume_id))
 
         try:
+            api.hold(lock, 'publish')
             content = req.media
 
             dataset_name = api.xslt_volume_id_to_name(volume_id)
@@ -125,7 +198,7 @@ class Publish:
             access_name = api.access_name.format(dataset_name=dataset_name)
 
             publish = api.apply_publish(access_name, content=content,
-                    dataset=api.fetch('pool/dataset', field='id',
+                    dataset=api.lookup('pool/dataset', field='id',
                     value=dataset_id))
 
             api.logger.debug('Backend publish results: %s', publish)
@@ -164,15 +237,15 @@ class Publish:
             resp.status = falcon.HTTP_500
 
         finally:
-            publish_lock.release()
+            api.release(lock)
 
 
 class Volume:
     def on_put(self, req, resp, volume_id):
         api = req.context
         try:
-            dataset = api.fetch('pool/dataset', field='name',
-                                value=api.xslt_id_to_dataset(volume_id))
+            dataset = api.lookup('pool/dataset', field='name',
+                                 value=api.xslt_id_to_dataset(volume_id))
 
             if dataset:
                 content = req.media
@@ -185,9 +258,22 @@ class Volume:
                     req_backend.update({'comments': content.get('description')})
 
                 config = content.get('config')
+                profile = {}
+
+                if config and config.get('performance_profile'):
+                    try:
+                        profile = api.performance_profile(config.get('performance_profile'), api.version())
+                    except ValueError as e:
+                        resp.body = api.csp_error('Bad Request', str(e))
+                        resp.status = falcon.HTTP_400
+                        return
+
+                    req_backend.update(api.profile_subset(profile, 'pool/dataset', mutable=True))
 
                 if config:
                     for key in config:
+                        if key == 'performance_profile':
+                            continue
                         if key in api.dataset_mutables:
                             req_backend.update({key: config.get(key)})
                         else:
@@ -199,15 +285,24 @@ class Volume:
                             resp.status = falcon.HTTP_400
                             return
 
-                api.put(api.uri_id('pool/dataset',
+                response = api.put(api.uri_id('pool/dataset',
                                    dataset.get('name')), req_backend)
 
-                if api.req_backend.status_code != 200:
-                    resp.body = api.csp_error('Bad Request',
-                                              'TrueNAS API returned: {content}'.format(content=api.req_backend.content.decode('utf-8')))
+                if response is None or response.status_code != 200:
+                    resp.body = api.csp_error('Bad Request', api.returned(response))
                     resp.status = falcon.HTTP_500
                     return
 
+                if profile:
+                    extent = api.fetch('iscsi/extent', field='name', returnBy=dict,
+                            value=api.access_name.format(dataset_name=api.xslt_volume_id_to_name(volume_id)))
+                    refused = api.apply_profile(dataset.get('name'), profile, extent=extent)
+
+                    if refused:
+                        resp.body = api.csp_error('Bad Request', refused)
+                        resp.status = falcon.HTTP_500
+                        return
+
                 dataset = api.fetch(
                     'pool/dataset', field='name', value=api.xslt_id_to_dataset(volume_id))
                 csi_resp = api.dataset_to_volume(dataset)
@@ -223,8 +318,8 @@ class Volume:
     def on_get(self, req, resp, volume_id):
         api = req.context
         try:
-            dataset = api.fetch('pool/dataset', field='name',
-                                value=api.xslt_id_to_dataset(volume_id))
+            dataset = api.lookup('pool/dataset', field='name',
+                                 value=api.xslt_id_to_dataset(volume_id))
 
             if dataset:
                 csi_resp = api.dataset_to_volume(dataset)
@@ -249,7 +344,7 @@ class Volume:
             access_name = api.access_name.format(dataset_name=dataset_name)
 
             # delete dataset
-            dataset = api.fetch('pool/dataset', field='name', value=api.xslt_id_to_dataset(volume_id))
+            dataset = api.lookup('pool/dataset', field='name', value=api.xslt_id_to_dataset(volume_id))
 
             if dataset:
                 csi_volume = api.dataset_to_volume(dataset)
@@ -259,7 +354,19 @@ class Volume:
                         'Bad Request', 'Cannot delete a published volume')
                     resp.status = falcon.HTTP_400
                 else:
-                    if api.dataset_is_busy(dataset):
+                    busy = api.dataset_is_busy(dataset)
+
+                    # the clones no longer depend on a promoted clone's origin
+                    if busy and api.clone_promotion:
+                        try:
+                            if api.promote_clone(dataset):
+                                busy = api.dataset_is_busy(dataset)
+                        except ValueError as e:
+                            resp.body = api.csp_error('Conflict', str(e))
+                            resp.status = falcon.HTTP_409
+                            return
+
+                    if busy:
                         resp.body = api.csp_error(
                             'Conflict', '{volume_id} has snapshots with holds or dependent clones'.format(volume_id=volume_id))
                         resp.status = falcon.HTTP_409
@@ -273,7 +380,7 @@ class Volume:
                         while api.fetch('pool/dataset', field='name',
                                 value=api.xslt_id_to_dataset(volume_id)) and dataset_deletion:
                             dataset_deletion -= 1
-                            sleep(api.backend_delay)
+                            api.sleep(api.backend_delay, 'dataset_delete')
                             api.delete(api.uri_id('pool/dataset',
                               dataset.get('name')), body='{"recursive": true, "force": true}')
                             api.logger.info('Dataset deletion retried: %s', volume_id)
@@ -321,17 +428,38 @@ class Volumes:
         try:
             content = req.media
             root = content.get('config').get('root', api.dataset_defaults.get('root'))
+            profile_name = content.get('config').get('performance_profile')
+
+            try:
+                profile = api.performance_profile(profile_name,
+                        api.version() if profile_name else None)
+            except ValueError as e:
+                resp.body = api.csp_error('Bad Request', str(e))
+                resp.status = falcon.HTTP_400
+                return
 
-            if content.get('clone'):
+            # a retry after an interrupted attempt skips the dataset it created
+            entry = backend.JOURNAL.begin(api.backend, 'volume', content.get('name'))
+            dataset = api.resume(entry, 'pool/dataset')
+
+            response = None
+
+            if dataset:
+                api.logger.info('Resuming volume: %s', content.get('name'))
+            elif content.get('clone'):
                 req_backend = {
                     'snapshot': api.xslt_id_to_dataset(content.get('base_snapshot_id')),
                     'dataset_dst': '{root}/{volume_name}'.format(volume_name=content.get('name'), root=root),
                 }
-                api.post('zfs/snapshot/clone', req_backend)
+                response = api.post('zfs/snapshot/clone', req_backend)
 
                 dataset = api.fetch('pool/dataset', field='name',
                                     value='{root}/{volume_name}'.format(volume_name=content.get('name'), root=root))
             else:
+                # StorageClass parameters take precedence over the profile
+                defaults = dict(api.dataset_defaults)
+                defaults.update(api.profile_subset(profile, 'pool/dataset'))
+
                 req_backend = {
                     'type': 'VOLUME',
                     # FIXME
@@ -342,25 +470,47 @@ class Volumes:
                         ),
                     'name': '{root}/{volume_name}'.format(volume_name=content.get('name'), root=root),
                     'volsize': '{size}'.format(size=int(content.get('size'))),
-                    'volblocksize': content.get('config').get('volblocksize', api.dataset_defaults.get('volblocksize')),
-                    'sparse': json.loads(content.get('config').get('sparse', api.dataset_defaults.get('sparse')).lower()),
-                    'deduplication': content.get('config').get('deduplication', api.dataset_defaults.get('deduplication')),
-                    'sync': content.get('config').get('sync', api.dataset_defaults.get('sync')),
-                    'compression':  content.get('config').get('compression', api.dataset_defaults.get('compression'))
+                    'volblocksize': content.get('config').get('volblocksize', defaults.get('volblocksize')),
+                    'sparse': json.loads(content.get('config').get('sparse', defaults.get('sparse')).lower()),
+                    'deduplication': content.get('config').get('deduplication', defaults.get('deduplication')),
+                    'sync': content.get('config').get('sync', defaults.get('sync')),
+                    'compression':  content.get('config').get('compression', defaults.get('compression'))
                 }
-                api.post('pool/dataset', req_backend)
 
-                dataset = api.req_backend.json()
+                if defaults.get('special_small_block_size'):
+                    req_backend['special_small_block_size'] = defaults.get('special_small_block_size')
 
-            if api.req_backend.status_code != 200:
-                resp.body = api.csp_error('Bad Request',
-                                          'TrueNAS API returned: {content}'.format(content=api.req_backend.content.decode('utf-8')))
+                # the claim survives custom descriptions, FreeNAS has no user properties
+                if api.version() != 'LEGACY':
+                    req_backend['user_properties'] = api.claim_user_properties(content.get('config'))
+
+                response = api.post('pool/dataset', req_backend)
+
+                dataset = api.payload(response)
+
+            if not dataset or (response is not None and response.status_code != 200):
+                resp.body = api.csp_error('Bad Request', api.returned(response))
                 resp.status = falcon.HTTP_500
                 return
 
+            if not entry.get('pool/dataset'):
+                entry.record('pool/dataset', dataset.get('id'))
+
+            # the journal entry stays open, a retry applies the profile again
+            if profile:
+                refused = api.apply_profile(dataset.get('id'), profile, clone=content.get('clone'))
+
+                if refused:
+                    resp.body = api.csp_error('Bad Request', refused)
+                    resp.status = falcon.HTTP_500
+                    return
+
             # create target
             res = api.create_target(dataset, content=content)
 
+            if res:
+                entry.done()
+
             # respond to CSI driver
             csi_resp = api.dataset_to_volume(dataset)
             resp.body = json.dumps(csi_resp)
@@ -375,15 +525,191 @@ class Volumes:
             resp.status = falcon.HTTP_500
 
 
-class Hosts:
+class Capacity:
+    def on_get(self, req, resp):
+        api = req.context
+        try:
+            root = req.params.get('root', api.dataset_defaults.get('root'))
+
+            capacity, refreshed = capacity_cache.get((api.backend, root),
+                    api.backend, api.token, root)
+
+            if capacity:
+                csi_resp = dict(capacity, refreshed=int(refreshed))
+                resp.body = json.dumps(csi_resp)
+
+                api.logger.debug('CSP response: %s', resp.body)
+                api.logger.info('Capacity reported: %s', root)
+            else:
+                resp.body = api.csp_error(
+                    'Not found', 'Root {root} not found.'.format(root=root))
+                resp.status = falcon.HTTP_404
+
+        except Exception:
+            resp.body = api.csp_error('Exception', traceback.format_exc())
+            resp.status = falcon.HTTP_500
+
+
+class Statistics:
+    def on_get(self, req, resp):
+        api = req.context
+        try:
+            root = req.params.get('root', api.dataset_defaults.get('root'))
+
+            statistics, refreshed = statistics_cache.get((api.backend, root),
+                    api.backend, api.token, root)
+
+            csi_resp = dict(statistics, refreshed=int(refreshed))
+            resp.body = json.dumps(csi_resp)
+
+            api.logger.debug('CSP response: %s', resp.body)
+            api.logger.info('Statistics reported: %s', root)
+
+        except Exception:
+            resp.body = api.csp_error('Exception', traceback.format_exc())
+            resp.status = falcon.HTTP_500
+
+
+class Metrics:
+    def on_get(self, req, resp):
+        resp.content_type = metrics.CONTENT_TYPE
+        resp.data = metrics.exposition(metrics.SharedState(backend.BREAKER, backend.ADMISSION,
+                                                            backend.BULKHEAD))
+
+
+class Traces:
+    def on_get(self, req, resp):
+        traces = slow_traces.get()
+        view = req.params.get('format', 'json')
+
+        if view == 'text':
+            resp.content_type = falcon.MEDIA_TEXT
+            resp.body = '\n\n'.join(trace.text() for trace in traces)
+        elif view == 'otlp':
+            resp.body = json.dumps(tracing.otlp(traces))
+        else:
+            resp.body = json.dumps([ trace.waterfall() for trace in traces ])
+
+
+class Profiles:
     def on_post(self, req, resp):
-        hosts_lock.acquire()
         api = req.context
+        content = req.media or {}
+
+        try:
+            capture = profiling.start(content.get('mode', 'sample'), content.get('seconds', 30))
+        except profiler.Busy as e:
+            resp.body = api.csp_error('Conflict', str(e))
+            resp.status = falcon.HTTP_409
+            return
+        except ValueError as e:
+            resp.body = api.csp_error('Bad Request', str(e))
+            resp.status = falcon.HTTP_400
+            return
+
+        api.logger.info('Profile capture started: %s', capture)
+        resp.status = falcon.HTTP_202
+        resp.body = json.dumps(capture)
+
+
+class Profile:
+    def on_get(self, req, resp, capture_id):
+        api = req.context
+
+        if not re.match('^([0-9a-f]{32}|auto)$', capture_id):
+            resp.body = api.csp_error('Not Found', 'No such capture: {id}'.format(id=capture_id))
+            resp.status = falcon.HTTP_404
+            return
+
+        if profiler.running(capture_id):
+            resp.status = falcon.HTTP_202
+            resp.body = json.dumps({'id': capture_id, 'running': True})
+            return
+
+        sort = req.get_param('sort', default='cumulative')
+        limit = req.get_param('limit', default='50')
+
+        if sort not in profiler.SORT_KEYS or not limit.isdigit() or not int(limit):
+            resp.body = api.csp_error('Bad Request',
+                    'sort must be one of {keys} and limit a positive integer'.format(
+                        keys=', '.join(profiler.SORT_KEYS)))
+            resp.status = falcon.HTTP_400
+            return
+
+        # the requests sampled by this worker since its last flush
+        if capture_id == 'auto':
+            profiling.flush(force=True)
+
+        text = profiler.result(capture_id, sort=sort, limit=int(limit))
+
+        if text is None:
+            resp.body = api.csp_error('Not Found', 'No such capture: {id}'.format(id=capture_id))
+            resp.status = falcon.HTTP_404
+            return
+
+        resp.content_type = falcon.MEDIA_TEXT
+        resp.body = text
+
+
+class Healthz:
+    def on_get(self, req, resp):
+        backend.HEALTH.start_prewarm(prewarm)
+
+        csi_resp = {
+            'alive': True,
+            'prewarm': backend.HEALTH.prewarm_state(),
+            'arrays': backend.HEALTH.status()
+        }
+
+        resp.body = json.dumps(csi_resp)
+
+
+class Readyz:
+    def on_get(self, req, resp):
+        backend.HEALTH.start_prewarm(prewarm)
+        ready, reason = backend.HEALTH.ready(backend.BREAKER.status(), ping=ping)
+
+        csi_resp = {
+            'ready': ready,
+            'reason': reason,
+            'prewarm': backend.HEALTH.prewarm_state(),
+            'arrays': backend.HEALTH.status(),
+            'cached': backend.SHARED_CACHE.count()
+        }
+
+        resp.body = json.dumps(csi_resp)
+
+        if not ready:
+            resp.status = falcon.HTTP_503
+
+
+class Status:
+    def on_get(self, req, resp):
+        api = req.context
+
+        csi_resp = {
+            'breakers': backend.BREAKER.status(),
+            'admission': backend.ADMISSION.status(),
+            'bulkheads': backend.BULKHEAD.status()
+        }
 
+        resp.body = json.dumps(csi_resp)
+        api.logger.debug('CSP response: %s', resp.body)
+
+
+class Hosts:
+    def on_post(self, req, resp):
+        api = req.context
         content = req.media
 
         try:
-            payload = api.apply_initiator(content.get('uuid'), content=content)
+            # node plugins re-assert their host on every restart
+            payload = api.registered_initiator(content.get('uuid'), content)
+
+            if payload:
+                api.logger.info('Host initiator unchanged: %s', payload.get('comment'))
+            else:
+                payload = self.apply(api, content)
 
             csi_resp = {
                 'id': payload.get('id'),
@@ -404,20 +730,29 @@ class Hosts:
         except Exception:
             resp.body = api.csp_error('Exception', traceback.format_exc())
             resp.status = falcon.HTTP_500
+
+    def apply(self, api, content):
+        lock = backend.LOCKS.get(api.backend, 'host/{uuid}'.format(uuid=content.get('uuid')))
+
+        try:
+            api.hold(lock, 'hosts')
+            return api.apply_initiator(content.get('uuid'), content=content)
         finally:
-            hosts_lock.release()
+            api.release(lock)
 
     def on_delete(self, req, resp, host_id):
         api = req.context
+        lock = backend.LOCKS.get(api.backend, 'host/{uuid}'.format(uuid=host_id))
 
         try:
+            api.hold(lock, 'hosts')
             initiator = api.fetch(
                 'iscsi/initiator', field='comment', value=host_id)
 
             if initiator:
-                api.delete(
+                response = api.delete(
                     'iscsi/initiator/id/{id}'.format(id=str(initiator.get('id'))))
-                resp.status = api.resp_msg
+                resp.status = api.status(response)
                 api.logger.info('Host initiator deleted: %s', initiator.get('comment'))
             else:
                 api.logger.info('Host initiator not found: %s', host_id)
@@ -425,6 +760,8 @@ class Hosts:
         except Exception:
             resp.body = api.csp_error('Exception', traceback.format_exc())
             resp.status = falcon.HTTP_500
+        finally:
+            api.release(lock)
 
 
 class Tokens:
@@ -492,16 +829,16 @@ class Snapshots:
         api = req.context
 
         content = req.media
-        system_version = api.version()
 
         try:
+            system_version = api.version()
             snapshot_name = content.get('name')
             dataset_name = api.xslt_id_to_dataset(content.get('volume_id'))
 
             # TrueNAS API is broken
-            snapshot = api.fetch('zfs/snapshot', field='name',
-                                 value='{dataset_name}@{snapshot_name}'.format(dataset_name=dataset_name,
-                                                                               snapshot_name=snapshot_name))
+            snapshot = api.lookup('zfs/snapshot', field='name',
+                                  value='{dataset_name}@{snapshot_name}'.format(dataset_name=dataset_name,
+                                                                                snapshot_name=snapshot_name))
 
             api.logger.debug('Snapshot exists: %s', snapshot)
 
@@ -510,11 +847,10 @@ class Snapshots:
                     'name': snapshot_name,
                     'dataset': dataset_name,
                 }
-                api.post('zfs/snapshot', req_backend)
+                response = api.post('zfs/snapshot', req_backend)
 
-                if api.req_backend.status_code != 200:
-                    resp.body = api.csp_error('Bad Request',
-                                              'TrueNAS API returned: {content}'.format(content=api.req_backend.content.decode('utf-8')))
+                if response is None or response.status_code != 200:
+                    resp.body = api.csp_error('Bad Request', api.returned(response))
                     resp.status = falcon.HTTP_500
                     return
 
@@ -545,14 +881,14 @@ class Snapshots:
             csi_resp = []
 
             if req.params.get('name'):
-                snapshot = api.fetch('zfs/snapshot', field='snapshot_name',
+                snapshot = api.lookup('zfs/snapshot', field='snapshot_name',
                         extras={"holds": True}, value=api.xslt_id_to_dataset(req.params.get('name')))
 
                 if snapshot and snapshot.get('holds'):
                     csi_resp = [api.snapshot_to_snapshot(snapshot)]
             else:
                 # assuming too much here FIXME
-                snapshots = api.fetch('zfs/snapshot', field='dataset',
+                snapshots = api.lookup('zfs/snapshot', field='dataset',
                         extras={"holds": True }, returnBy=list, value=api.xslt_id_to_dataset(req.params.get('volume_id')))
 
                 for snapshot in snapshots:
@@ -583,11 +919,11 @@ class Snapshot:
     def on_get(self, req, resp, snapshot_id):
         api = req.context
         try:
-            snapshot = api.fetch('zfs/snapshot', field='id',
-                                 value=api.xslt_id_to_dataset(snapshot_id))
+            snapshot = api.find_snapshot(snapshot_id)
 
             if snapshot:
                 csi_resp = api.snapshot_to_snapshot(snapshot)
+                csi_resp['id'] = snapshot_id
                 resp.body = json.dumps(csi_resp)
 
                 api.logger.debug('CSP response: %s', resp.body)
@@ -604,12 +940,10 @@ class Snapshot:
 
     def on_delete(self, req, resp, snapshot_id):
         api = req.context
-        system_version = api.version()
 
         try:
-            snapshot = api.fetch('zfs/snapshot', field='id',
-                                 value=api.xslt_id_to_dataset(snapshot_id),
-                                 returnBy=dict)
+            system_version = api.version()
+            snapshot = api.find_snapshot(snapshot_id)
 
             if snapshot and isinstance(snapshot, dict):
                 snapshot_clones = api.backend_retries
@@ -617,9 +951,9 @@ class Snapshot:
                 # pretend snapshot is deleted if it has clones, but wait first
                 while int(snapshot.get('properties').get('numclones').get('value')) > 0 and snapshot_clones:
                     api.logger.info('Snapshot has clones, waiting: %s', snapshot_id)
-                    sleep(api.backend_delay)
+                    api.sleep(api.backend_delay, 'snapshot_clones')
                     snapshot = api.fetch('zfs/snapshot', field='id',
-                                     value=api.xslt_id_to_dataset(snapshot_id))
+                                     value=snapshot.get('id'))
                     snapshot_clones -= 1
 
                     if snapshot_clones == 0:
@@ -646,9 +980,9 @@ class Snapshot:
                 snapshot_deletion = api.backend_retries
 
                 while api.fetch('zfs/snapshot', field='id',
-                        value=api.xslt_id_to_dataset(snapshot_id)) and snapshot_deletion:
+                        value=snapshot.get('id')) and snapshot_deletion:
                     snapshot_deletion -= 1
-                    sleep(api.backend_delay)
+                    api.sleep(api.backend_delay, 'snapshot_delete')
                     api.delete(api.uri_id('zfs/snapshot', snapshot.get('id')))
                     api.logger.info('Snapshot deletion retried: %s', snapshot_id)
 